@@ -0,0 +1,91 @@
+"""
+Certificate issuance - in-process signing versus the CA signing service
+
+local    PKIManager.create_user_cert with CA_SIGNING = "local" (reads ca.key per cert)
+service  concurrent clients calling request_certificate against CertificateSigner
+         threads on the in-memory broker, for each --workers count and batch size
+
+Reports certificates/sec. Signers here are threads in one process, so CPU
+bound signing (RSA CA) cannot scale past one core; run ca_service.py
+--workers N (separate processes) for that.
+Run: python benchmarks/bench_ca_service.py [--certs N] [--ca-key-type rsa|ed25519]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ca_service
+import pki_manager
+import rabbitmq_manager
+from fake_broker import InMemoryBroker
+
+PASSWORD = "secret"  # Every benchmark user's password - no LDAP here
+
+def bench_local(count):
+    pki = pki_manager.PKIManager(signing="local")
+    start = time.perf_counter()
+    for i in range(count):
+        pki.create_user_cert(f"local{i:05d}", key_type="x25519")
+    return count / (time.perf_counter() - start)
+
+def bench_service(count, workers, batch, clients, run_id):
+    ca_service.SIGN_BATCH = batch
+    signers = [ca_service.CertificateSigner(authenticate=lambda user, password: password == PASSWORD)
+               for _ in range(workers)]
+    threads = [threading.Thread(target=signer.run, daemon=True) for signer in signers]
+    for thread in threads:
+        thread.start()
+    
+    # Client side of create_user_cert: key generation and the RPC round trips
+    # (challenge, then the signing request)
+    pki = pki_manager.PKIManager(signing="service", key_source="keystore")
+    names = [f"svc{run_id}_{i:05d}" for i in range(count)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        list(pool.map(pki.create_user_cert, names, ["x25519"] * count, [PASSWORD] * count))
+    rate = count / (time.perf_counter() - start)
+    
+    missing = sum(1 for name in names if pki.keystore.get(name) is None)
+    for signer in signers:
+        signer.stop()
+    for thread in threads:
+        thread.join()
+    return rate, missing
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--certs", type=int, default=200)
+    parser.add_argument("--clients", type=int, default=32, help="concurrent requesting clients")
+    parser.add_argument("--ca-key-type", default="rsa", choices=["rsa", "ed25519"])
+    args = parser.parse_args()
+    
+    logging.getLogger("chat").setLevel(logging.WARNING)
+    broker = InMemoryBroker()
+    rabbitmq_manager.pika.BlockingConnection = broker.connect
+    ca_service.CA_RABBITMQ_USER = "chat_ca"  # The fake broker has no accounts
+    
+    with tempfile.TemporaryDirectory() as pki_dir:
+        pki_manager.PKI_PATH = Path(pki_dir)
+        pki_manager.CA_KEY_TYPE = args.ca_key_type
+        
+        print(f"{'mode':<28}{'certs/sec':>10}")
+        print(f"{'local (ca.key per cert)':<28}{bench_local(args.certs):>10.0f}")
+        
+        run_id = 0
+        for workers in (1, 2, 4):
+            for batch in (1, ca_service.SIGN_BATCH):
+                run_id += 1
+                rate, missing = bench_service(args.certs, workers, batch, args.clients, run_id)
+                note = f"  ({missing} missing!)" if missing else ""
+                print(f"{f'service workers={workers} batch={batch}':<28}{rate:>10.0f}{note}")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,74 @@
+"""
+Measure pre-encryption compression on text-heavy chat traffic
+
+Run: python benchmarks/bench_compression.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.primitives import serialization
+import compression
+from pki_manager import generate_key
+from session_manager import SessionManager
+from wire_format import pack_message
+
+# A pasted log excerpt - typical of long chat messages
+PASTE = "\n".join(
+    f"2024-05-{day:02d} 12:{minute:02d}:07 INFO rabbitmq_manager: Message sent to user_{minute % 7} "
+    f"(queue depth {minute * 3}, latency {minute % 13}.{day}ms)"
+    for day in range(1, 8) for minute in range(60)
+)
+SHORT = "Hello, this is a typical short chat message!"
+
+def run(text, rounds, compress_enabled, priv_path, pub_der):
+    """Return (bytes on the wire per message, seconds per round trip)"""
+    alice = SessionManager("alice", priv_path, lambda user: pub_der)
+    bob = SessionManager("bob", priv_path, lambda user: pub_der)
+    alice.set_compression("bob", compress_enabled)
+    
+    # First message carries the session key - keep it out of the timing
+    bob.decrypt("alice", alice.encrypt("bob", text))
+    
+    start = time.perf_counter()
+    for _ in range(rounds):
+        cipher_text = alice.encrypt("bob", text)
+        body = pack_message("alice", cipher_text)
+        bob.decrypt("alice", cipher_text)
+    return len(body), (time.perf_counter() - start) / rounds
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    
+    key = generate_key("x25519")
+    with tempfile.TemporaryDirectory() as directory:
+        priv_path = os.path.join(directory, "bench.key")
+        with open(priv_path, 'wb') as f:
+            f.write(key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption()
+            ))
+        pub_der = key.public_key().public_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        
+        print(f"Threshold {compression.COMPRESSION_THRESHOLD} bytes, {rounds} rounds\n")
+        print(f"{'message':<8}{'mode':<10}{'plain':>9}{'wire':>9}{'round trip':>14}")
+        for name, text in (("short", SHORT), ("paste", PASTE)):
+            modes = [("off", False, False), ("zlib", True, False)]
+            if compression.zstandard is not None:
+                modes.append(("zstd", True, True))
+            
+            for mode, enabled, zstd in modes:
+                compression.USE_ZSTD = zstd
+                compression.ZSTD_THRESHOLD = 0
+                wire, seconds = run(text, rounds, enabled, priv_path, pub_der)
+                print(f"{name:<8}{mode:<10}{len(text.encode('utf-8')):>8}B{wire:>8}B{seconds * 1e6:>12.1f}us")
+
+if __name__ == "__main__":
+    main()
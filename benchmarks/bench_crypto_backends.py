@@ -0,0 +1,101 @@
+"""
+RSA crypto backends side by side: OpenSSL (cryptography) vs PyCryptodome
+
+Times each crypto_manager backend operation - key generation, key import,
+OAEP encrypt/decrypt and PSS sign/verify - across message sizes, plus the
+cost of importing each library into a fresh interpreter, and names the
+faster backend per row. Select one with CHAT_CRYPTO_BACKEND.
+Run: python benchmarks/bench_crypto_backends.py [--rounds N] [--bits 2048]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.primitives import serialization
+from crypto_manager import BACKENDS, get_backend
+from pki_manager import generate_key
+
+# Largest OAEP-SHA256 plaintext for the key size is bits/8 - 66
+ENCRYPT_SIZES = (16, 64)
+SIGN_SIZES = (64, 1024, 65536)
+
+LIBRARY_IMPORTS = {
+    "openssl": "from cryptography.hazmat.primitives.asymmetric import padding, rsa",
+    "pycryptodome": "from Crypto.PublicKey import RSA; from Crypto.Cipher import PKCS1_OAEP; "
+                    "from Crypto.Signature import pss",
+}
+
+def timed(fn, rounds):
+    """Mean seconds per call"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds
+
+def library_import(name, rounds=5):
+    """Seconds to import the backend's library, minus interpreter startup"""
+    def run(code):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True)
+        return time.perf_counter() - start
+    baseline = min(run("pass") for _ in range(rounds))
+    return max(0.0, min(run(LIBRARY_IMPORTS[name]) for _ in range(rounds)) - baseline)
+
+def bench_backend(backend, rounds, bits):
+    """{(operation, size): seconds} for one backend"""
+    key = generate_key("rsa", rsa_bits=bits)
+    pub_der = key.public_key().public_bytes(
+        serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    pub_pem = key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    priv_pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    )
+    public = backend.import_public_key(pub_der)
+    private = backend.import_private_key(priv_pem)
+    
+    results = {
+        ("library import", ""): library_import(backend.name),
+        ("keygen", ""): timed(lambda: backend.generate_rsa(bits), max(1, rounds // 50)),
+        ("import public DER", ""): timed(lambda: backend.import_public_key(pub_der), rounds),
+        ("import public PEM", ""): timed(lambda: backend.import_public_key(pub_pem), rounds),
+        ("import private PEM", ""): timed(lambda: backend.import_private_key(priv_pem), max(1, rounds // 10)),
+    }
+    for size in ENCRYPT_SIZES + (bits // 8 - 66,):
+        data = os.urandom(size)
+        cipher_text = backend.rsa_encrypt(public, data)
+        assert backend.rsa_decrypt(private, cipher_text) == data
+        results[("encrypt", size)] = timed(lambda: backend.rsa_encrypt(public, data), rounds)
+        results[("decrypt", size)] = timed(lambda: backend.rsa_decrypt(private, cipher_text), rounds)
+    for size in SIGN_SIZES:
+        data = os.urandom(size)
+        signature = backend.sign(private, data)
+        assert backend.verify(public, data, signature)
+        results[("sign", size)] = timed(lambda: backend.sign(private, data), rounds)
+        results[("verify", size)] = timed(lambda: backend.verify(public, data, signature), rounds)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--bits", type=int, default=2048)
+    args = parser.parse_args()
+    
+    names = list(BACKENDS)
+    results = {name: bench_backend(get_backend(name), args.rounds, args.bits) for name in names}
+    
+    print(f"RSA-{args.bits}, {args.rounds} rounds, microseconds per operation\n")
+    print(f"{'operation':<20}{'bytes':>7}" + "".join(f"{name:>14}" for name in names) + f"{'fastest':>14}")
+    for operation, size in results[names[0]]:
+        row = {name: results[name][(operation, size)] for name in names}
+        fastest = min(row, key=row.get)
+        print(f"{operation:<20}{size:>7}" + "".join(f"{row[name] * 1e6:>14.1f}" for name in names) + f"{fastest:>14}")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
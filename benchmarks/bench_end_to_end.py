@@ -0,0 +1,150 @@
+"""
+End-to-end chat benchmark against in-process broker and LDAP stand-ins
+
+Send path:    SessionManager.encrypt -> MQ.send_message -> publish
+Receive path: consume -> unpack -> SessionManager.decrypt -> history
+
+Reports msgs/sec, p50/p99 end-to-end latency and peak Python memory.
+Run: python benchmarks/bench_end_to_end.py [--messages N] [--key-type rsa|x25519]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ldap_manager
+import metrics
+import outbox
+import pki_manager
+import rabbitmq_manager
+from fake_broker import InMemoryBroker
+from fake_ldap import FakeDirectory
+from session_manager import SessionManager
+from wire_format import unpack_message
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list"""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+def report(name, count, elapsed, latencies, peak_bytes):
+    """Print one result row"""
+    print(f"{name:<14}{count:>8}{count / elapsed:>12.0f}"
+          f"{percentile(latencies, 50) * 1e3:>10.2f}ms{percentile(latencies, 99) * 1e3:>10.2f}ms"
+          f"{peak_bytes / 1024:>10.0f}KB")
+
+def bench_login(directory, rounds):
+    """LDAPManager.authenticate against the fake directory"""
+    ldap = ldap_manager.LDAPManager()
+    latencies = []
+    
+    start = time.perf_counter()
+    for _ in range(rounds):
+        t = time.perf_counter()
+        assert ldap.authenticate("alice", "secret1")
+        latencies.append(time.perf_counter() - t)
+    return time.perf_counter() - start, latencies
+
+def bench_messages(pki, count, text):
+    """Send count messages alice -> bob through real MQ objects, return timings"""
+    alice_mq = rabbitmq_manager.MQ("alice")
+    bob_mq = rabbitmq_manager.MQ("bob")
+    alice = SessionManager("alice", pki.get_user_key_path("alice"), pki.get_user_public_key)
+    bob = SessionManager("bob", pki.get_user_key_path("bob"), pki.get_user_public_key)
+    
+    sent_at = {}
+    latencies = []
+    history = {}
+    done = threading.Event()
+    
+    def callback(body):
+        # Same work as ChatClient's listener: unpack, decrypt, store in history
+        sender, message_id, encrypted_msg = unpack_message(body)
+        decrypted = bob.decrypt(sender, encrypted_msg)
+        history.setdefault(sender, []).append({
+            'type': 'received',
+            'text': decrypted,
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        })
+        seq = int(decrypted.split(' ', 1)[0])
+        latencies.append(time.perf_counter() - sent_at[seq])
+        if len(latencies) == count:
+            done.set()
+    
+    threading.Thread(target=bob_mq.listen, args=(callback,), daemon=True).start()
+    time.sleep(0.2)  # Let the consumer attach
+    
+    start = time.perf_counter()
+    for seq in range(count):
+        sent_at[seq] = time.perf_counter()
+        alice_mq.send_message("bob", alice.encrypt("bob", f"{seq} {text}"))
+    
+    done.wait(timeout=max(30, count))
+    elapsed = time.perf_counter() - start
+    
+    alice_mq.close()
+    bob_mq.close()
+    return elapsed, latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--size", type=int, default=64, help="message text size in bytes")
+    parser.add_argument("--key-type", default="rsa", choices=["rsa", "x25519"])
+    parser.add_argument("--metrics", action="store_true", help="dump the metrics registry afterwards")
+    args = parser.parse_args()
+    
+    # Connection chatter would otherwise be mixed into the report
+    logging.getLogger("chat").setLevel(logging.WARNING)
+    
+    broker = InMemoryBroker()
+    directory = FakeDirectory()
+    directory.add_user(f"uid=alice,{ldap_manager.BASE_DN}", "secret1", uid="alice")
+    
+    # Route every connection to the stand-ins
+    rabbitmq_manager.pika.BlockingConnection = broker.connect
+    ldap_manager.Server = directory.server
+    ldap_manager.Connection = directory.connection
+    
+    with tempfile.TemporaryDirectory() as pki_dir:
+        pki_manager.PKI_PATH = Path(pki_dir)
+        outbox.OUTBOX_PATH = Path(pki_dir) / "outbox"
+        pki_manager.CA_KEY_TYPE = "ed25519" if args.key_type == "x25519" else "rsa"
+        pki_manager.CA_SIGNING = "local"
+        
+        pki = pki_manager.PKIManager()
+        for user in ("alice", "bob"):
+            pki.create_user_cert(user, key_type=args.key_type)
+        
+        print(f"{args.messages} messages of {args.size} bytes, {args.key_type} keys\n")
+        print(f"{'path':<14}{'count':>8}{'msgs/sec':>12}{'p50':>12}{'p99':>12}{'peak mem':>12}")
+        
+        tracemalloc.start()
+        elapsed, latencies = bench_login(directory, args.messages)
+        report("ldap login", args.messages, elapsed, latencies, tracemalloc.get_traced_memory()[1])
+        
+        tracemalloc.reset_peak()
+        elapsed, latencies = bench_messages(pki, args.messages, "x" * args.size)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        
+        if len(latencies) < args.messages:
+            print(f"Only {len(latencies)}/{args.messages} messages arrived")
+        report("send+receive", len(latencies), elapsed, latencies, peak)
+        print(f"\nBroker: {broker.published} publishes, {broker.published_bytes} bytes")
+        
+        if args.metrics:
+            print()
+            print(metrics.REGISTRY.render())
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,128 @@
+"""
+File transfer throughput and memory - one sender, one receiver, no network
+
+--transport loopback  uses transport.LoopbackTransport
+--transport rabbitmq  runs the real MQ code against the in-memory broker
+--loss P              drops a fraction P of chunks at the receiver to exercise go-back/resume
+
+Sends a random file of each --sizes (MB) and reports MB/s plus peak Python
+heap (tracemalloc), which should stay flat as the file grows.
+Run: python benchmarks/bench_file_transfer.py [--sizes 8,64] [--transport T] [--loss 0.01]
+"""
+import argparse
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import outbox
+import pki_manager
+import rabbitmq_manager
+import file_transfer
+from chat_client import ChatClient
+from fake_broker import InMemoryBroker
+from transport import LoopbackHub
+
+def write_random_file(path, size_mb):
+    """Incompressible test file, written 1 MB at a time"""
+    with open(path, 'wb') as f:
+        for _ in range(size_mb):
+            f.write(os.urandom(1024 * 1024))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="8,64", help="comma separated file sizes in MB")
+    parser.add_argument("--transport", default="loopback", choices=["loopback", "rabbitmq"])
+    parser.add_argument("--loss", type=float, default=0.0, help="fraction of chunks dropped on arrival")
+    args = parser.parse_args()
+    
+    logging.getLogger("chat").setLevel(logging.WARNING)
+    if args.loss:
+        file_transfer.ACK_TIMEOUT = 1  # Lost tail chunks are only noticed by the timeout
+    if args.transport == "loopback":
+        make_transport = LoopbackHub().transport
+    else:
+        broker = InMemoryBroker()
+        rabbitmq_manager.pika.BlockingConnection = broker.connect
+        make_transport = rabbitmq_manager.MQ
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        pki_manager.PKI_PATH = tmp / "pki"
+        outbox.OUTBOX_PATH = tmp / "outbox"
+        pki_manager.CA_KEY_TYPE = "ed25519"
+        pki_manager.CA_SIGNING = "local"
+        
+        pki = pki_manager.PKIManager()
+        for name in ("alice", "bob"):
+            pki.create_user_cert(name, key_type="x25519")
+        
+        alice = ChatClient("alice", pki=pki, transport=make_transport("alice"))
+        bob = ChatClient("bob", pki=pki, transport=make_transport("bob"))
+        bob.files.download_dir = tmp / "downloads"
+        
+        finished = {}
+        done = threading.Event()
+        def on_file(event):
+            if event['direction'] == 'in' and event['state'] == 'offered':
+                bob.accept_file(event['id'])
+            if event['direction'] == 'in' and event['state'] in ('done', 'failed'):
+                finished[event['id']] = event
+                done.set()
+        bob.on_file = on_file
+        
+        if args.loss:
+            rng = random.Random(42)
+            handle_chunk = bob.files.handle_chunk
+            def lossy(sender, data):
+                if rng.random() >= args.loss:
+                    handle_chunk(sender, data)
+            bob.files.handle_chunk = lossy
+        
+        alice.start()
+        bob.start()
+        time.sleep(0.5)  # Let consumers attach
+        
+        print(f"{'size':>8} {'seconds':>9} {'MB/s':>8} {'peak heap':>10} {'resent':>7}  result")
+        for size_mb in (int(s) for s in args.sizes.split(",")):
+            path = tmp / f"random_{size_mb}mb.bin"
+            write_random_file(path, size_mb)
+            resent = file_transfer.FILE_CHUNKS_RESENT.value
+            done.clear()
+            
+            tracemalloc.start()
+            start = time.perf_counter()
+            transfer_id = alice.send_file("bob", path)
+            done.wait(timeout=max(120, size_mb * 2))
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            
+            event = finished.get(transfer_id)
+            if event is None:
+                result = "timed out"
+            elif event['state'] == 'done':
+                ok = file_transfer._file_sha256(event['path']).digest() == file_transfer._file_sha256(path).digest()
+                result = "ok" if ok else "CORRUPT"
+                os.remove(event['path'])
+            else:
+                result = event['state']
+            print(f"{size_mb:>6}MB {elapsed:>9.2f} {size_mb / elapsed:>8.1f} "
+                  f"{peak / 1024 ** 2:>8.1f}MB {file_transfer.FILE_CHUNKS_RESENT.value - resent:>7}  {result}")
+            os.remove(path)
+        
+        # ru_maxrss is KB on Linux
+        print(f"\nMax RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f}MB")
+        alice.close()
+        bob.close()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,101 @@
+"""
+Certificate lookup through the key directory service versus the shared keystore
+
+Runs KeyDirectoryService on the in-memory broker and measures a directory
+client (PKIManager with key_source="directory"): cold lookups, one batched
+lookup for a whole group, cached lookups and ETag revalidation.
+Run: python benchmarks/bench_key_directory.py [--users N]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import key_directory
+import pki_manager
+import rabbitmq_manager
+from fake_broker import InMemoryBroker
+from bench_end_to_end import percentile
+
+def cached_latencies(pki, names, rounds):
+    """Per-call latency of get_user_public_key once everything is cached"""
+    latencies = []
+    for _ in range(rounds):
+        for name in names:
+            start = time.perf_counter()
+            pki.get_user_public_key(name)
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    args = parser.parse_args()
+    
+    logging.getLogger("chat").setLevel(logging.WARNING)
+    broker = InMemoryBroker()
+    rabbitmq_manager.pika.BlockingConnection = broker.connect
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        pki_manager.PKI_PATH = Path(tmp) / "pki"
+        pki_manager.KEY_PATH = Path(tmp) / "keys"
+        pki_manager.CA_KEY_TYPE = "ed25519"
+        key_directory.KEY_CACHE_FILE = Path(tmp) / "key_cache.json"
+        
+        shared = pki_manager.PKIManager(signing="local")
+        pki_manager.CA_FINGERPRINT = pki_manager.ca_fingerprint(shared._load_ca_cert())  # Shipped with clients
+        names = [f"user{i:04d}" for i in range(args.users)]
+        for name in names:
+            shared.create_user_cert(name, key_type="x25519")
+        
+        service = key_directory.KeyDirectoryService()
+        thread = threading.Thread(target=service.run, daemon=True)
+        thread.start()
+        
+        client = pki_manager.PKIManager(signing="service", key_source="directory")
+        
+        cold = names[:50]
+        start = time.perf_counter()
+        for name in cold:
+            client.get_user_public_key(name)
+        print(f"cold lookup, one request each:  {(time.perf_counter() - start) / len(cold) * 1e3:8.2f} ms/user")
+        
+        start = time.perf_counter()
+        client.prefetch_public_keys(names)
+        print(f"batch lookup of {len(names)} users:     {(time.perf_counter() - start) * 1e3:8.2f} ms total")
+        for name in names:
+            client.get_user_public_key(name)  # CA verification, once per certificate
+        
+        latencies = cached_latencies(client, names, 50)
+        print(f"cached lookup (directory):      p50 {percentile(latencies, 50) * 1e6:6.1f} us, "
+              f"p99 {percentile(latencies, 99) * 1e6:6.1f} us")
+        
+        latencies = cached_latencies(shared, names, 50)
+        print(f"cached lookup (keystore file):  p50 {percentile(latencies, 50) * 1e6:6.1f} us, "
+              f"p99 {percentile(latencies, 99) * 1e6:6.1f} us")
+        
+        client.keystore.refresh(force=True)
+        sent = broker.published_bytes
+        start = time.perf_counter()
+        client.prefetch_public_keys(names)
+        print(f"ETag revalidation of {len(names)} users: {(time.perf_counter() - start) * 1e3:8.2f} ms, "
+              f"{broker.published_bytes - sent} bytes on the wire")
+        
+        restarted = pki_manager.PKIManager(signing="service", key_source="directory")
+        sent = broker.published_bytes
+        start = time.perf_counter()
+        restarted.prefetch_public_keys(names)
+        print(f"after restart (cache file):     {(time.perf_counter() - start) * 1e3:8.2f} ms, "
+              f"{broker.published_bytes - sent} bytes on the wire")
+        
+        service.stop()
+        thread.join()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,66 @@
+"""
+Compare RSA and X25519 user keys: key generation, encrypt, decrypt, wire size
+
+Run: python benchmarks/bench_key_types.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.primitives import serialization
+from pki_manager import generate_key
+from crypto_manager import encrypt, decrypt
+
+MESSAGE = "Hello, this is a typical short chat message!"
+
+def timed(func, rounds):
+    """Average seconds per call over rounds"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds
+
+def bench(key_type, rounds):
+    """Benchmark one key type, return result row"""
+    keygen = timed(lambda: generate_key(key_type), max(1, rounds // 20))
+    
+    key = generate_key(key_type)
+    pub_der = key.public_key().public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    
+    with tempfile.NamedTemporaryFile(suffix='.key', delete=False) as f:
+        f.write(key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        ))
+        priv_path = f.name
+    
+    try:
+        cipher_text = encrypt(MESSAGE, pub_der)
+        assert decrypt(cipher_text, priv_path) == MESSAGE
+        
+        enc = timed(lambda: encrypt(MESSAGE, pub_der), rounds)
+        dec = timed(lambda: decrypt(cipher_text, priv_path), rounds)
+    finally:
+        os.remove(priv_path)
+    
+    return key_type, keygen, enc, dec, len(pub_der), len(cipher_text)
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    
+    print(f"Message: {len(MESSAGE.encode('utf-8'))} bytes, {rounds} rounds\n")
+    print(f"{'key type':<10}{'keygen':>12}{'encrypt':>12}{'decrypt':>12}{'pubkey':>10}{'wire':>8}")
+    for key_type in ("rsa", "x25519"):
+        name, keygen, enc, dec, pub_size, wire = bench(key_type, rounds)
+        print(f"{name:<10}{keygen * 1e6:>10.0f}us{enc * 1e6:>10.0f}us{dec * 1e6:>10.0f}us"
+              f"{pub_size:>9}B{wire:>7}B")
+
+if __name__ == "__main__":
+    main()
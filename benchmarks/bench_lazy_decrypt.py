@@ -0,0 +1,92 @@
+"""
+Backlog catch-up - decrypting every message on arrival versus lazily
+
+A receiver comes online to --messages messages spread over --senders
+conversations (plus group chat). Measures the listener's CPU time to take
+in the backlog eagerly and with lazy_decrypt, then the cost of opening one
+conversation and of opening all of them.
+Run: python benchmarks/bench_lazy_decrypt.py [--messages N] [--senders K] [--size BYTES]
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import outbox
+import pki_manager
+from chat_client import ChatClient, GROUP_CHAT, GROUP_PREFIX
+from session_manager import ROUTE_CHAT, ROUTE_GROUP
+from transport import LoopbackHub
+from wire_format import pack_message
+
+def backlog(pki, hub, receiver, senders, count, size):
+    """Message bodies as the receiver's listener would get them"""
+    clients = {name: ChatClient(name, pki=pki, transport=hub.transport(name)) for name in senders}
+    bodies = []
+    for i in range(count):
+        sender = random.choice(senders)
+        text = f"{i} " + "".join(random.choice("abcdefghij klmnop") for _ in range(size))
+        if i % 10 == 0:
+            cipher_text = clients[sender].sessions.encrypt(receiver, f"{GROUP_PREFIX}{sender}: {text}", ROUTE_GROUP)
+        else:
+            cipher_text = clients[sender].sessions.encrypt(receiver, text, ROUTE_CHAT)
+        bodies.append(pack_message(sender, cipher_text))
+    return bodies
+
+def ingest(client, bodies):
+    """CPU seconds for the listener callback to take in every body"""
+    start = time.process_time()
+    for body in bodies:
+        client._handle_message(body)
+    return time.process_time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--senders", type=int, default=20)
+    parser.add_argument("--size", type=int, default=200, help="characters per message")
+    parser.add_argument("--key-type", default="x25519", choices=["rsa", "x25519"])
+    args = parser.parse_args()
+    
+    logging.getLogger("chat").setLevel(logging.WARNING)
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as pki_dir:
+        pki_manager.PKI_PATH = Path(pki_dir)
+        outbox.OUTBOX_PATH = Path(pki_dir) / "outbox"
+        pki_manager.CA_KEY_TYPE = "ed25519" if args.key_type == "x25519" else "rsa"
+        pki_manager.CA_SIGNING = "local"
+        
+        pki = pki_manager.PKIManager()
+        senders = [f"sender{i:03d}" for i in range(args.senders)]
+        for name in senders + ["receiver"]:
+            pki.create_user_cert(name, key_type=args.key_type)
+        hub = LoopbackHub()
+        bodies = backlog(pki, hub, "receiver", senders, args.messages, args.size)
+        
+        print(f"{args.messages} messages of ~{args.size} chars from {args.senders} senders\n")
+        for lazy in (False, True):
+            # Separate session key stores - the second client must not inherit the first one's sessions
+            outbox.OUTBOX_PATH = Path(pki_dir) / f"outbox_{lazy}"
+            client = ChatClient("receiver", pki=pki, transport=hub.transport("receiver"), lazy_decrypt=lazy)
+            cpu = ingest(client, bodies)
+            
+            start = time.process_time()
+            client.history(senders[0])
+            open_one = time.process_time() - start
+            
+            start = time.process_time()
+            for conversation in senders + [GROUP_CHAT]:
+                client.history(conversation)
+            open_all = time.process_time() - start + open_one
+            
+            print(f"{'lazy' if lazy else 'eager':<6} arrival {cpu * 1e3:8.1f} ms CPU ({cpu / len(bodies) * 1e6:5.1f} us/msg)  "
+                  f"open one chat {open_one * 1e3:7.1f} ms  open all {open_all * 1e3:7.1f} ms")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,111 @@
+"""
+Capacity test - many headless ChatClients in one process, no network
+
+--transport loopback  uses transport.LoopbackTransport (zero-network baseline)
+--transport rabbitmq  runs the real MQ code against the in-memory broker
+
+Every client sends --messages messages to random peers; reports delivery
+throughput, end-to-end latency and thread count.
+Run: python benchmarks/bench_many_clients.py [--users N] [--messages M] [--transport T]
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import outbox
+import pki_manager
+import rabbitmq_manager
+from chat_client import ChatClient
+from fake_broker import InMemoryBroker
+from transport import LoopbackHub
+from bench_end_to_end import percentile
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=5, help="messages sent by each user")
+    parser.add_argument("--key-type", default="x25519", choices=["rsa", "x25519"])
+    parser.add_argument("--transport", default="loopback", choices=["loopback", "rabbitmq"])
+    args = parser.parse_args()
+    
+    logging.getLogger("chat").setLevel(logging.WARNING)
+    if args.transport == "loopback":
+        hub = LoopbackHub()
+        make_transport = hub.transport
+    else:
+        broker = InMemoryBroker()
+        rabbitmq_manager.pika.BlockingConnection = broker.connect
+        make_transport = rabbitmq_manager.MQ
+    
+    with tempfile.TemporaryDirectory() as pki_dir:
+        pki_manager.PKI_PATH = Path(pki_dir)
+        outbox.OUTBOX_PATH = Path(pki_dir) / "outbox"
+        pki_manager.CA_KEY_TYPE = "ed25519" if args.key_type == "x25519" else "rsa"
+        pki_manager.CA_SIGNING = "local"
+        
+        # One PKIManager (one keystore map) shared by every client
+        pki = pki_manager.PKIManager()
+        names = [f"user{i:04d}" for i in range(args.users)]
+        start = time.perf_counter()
+        for name in names:
+            pki.create_user_cert(name, key_type=args.key_type)
+        print(f"Issued {args.users} certificates in {time.perf_counter() - start:.1f}s")
+        
+        expected = args.users * args.messages
+        latencies = []
+        lock = threading.Lock()
+        done = threading.Event()
+        
+        def on_message(conversation, entry):
+            sent = float(entry['text'].split(' ', 1)[0])
+            with lock:
+                latencies.append(time.perf_counter() - sent)
+                if len(latencies) == expected:
+                    done.set()
+        
+        start = time.perf_counter()
+        clients = []
+        for name in names:
+            client = ChatClient(name, pki=pki, transport=make_transport(name))
+            client.on_message = on_message
+            client.start()
+            clients.append(client)
+        print(f"Started {args.users} clients in {time.perf_counter() - start:.1f}s, "
+              f"{threading.active_count()} threads")
+        
+        time.sleep(0.5)  # Let consumers attach
+        rng = random.Random(42)
+        start = time.perf_counter()
+        for _ in range(args.messages):
+            for client in clients:
+                peer = rng.choice(names)
+                while peer == client.username:
+                    peer = rng.choice(names)
+                client.send_message(peer, f"{time.perf_counter()} hello {peer}")
+        
+        done.wait(timeout=max(60, expected))
+        elapsed = time.perf_counter() - start
+        
+        print(f"\nDelivered {len(latencies)}/{expected} messages in {elapsed:.2f}s "
+              f"({len(latencies) / elapsed:.0f} msgs/sec)")
+        if latencies:
+            print(f"Latency p50 {percentile(latencies, 50) * 1e3:.1f}ms, "
+                  f"p99 {percentile(latencies, 99) * 1e3:.1f}ms")
+        if args.transport == "loopback":
+            print(f"Hub: {hub.delivered} messages, {hub.delivered_bytes} bytes")
+        else:
+            print(f"Broker: {broker.published} publishes, {broker.published_bytes} bytes")
+        
+        for client in clients:
+            client.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+UI-thread latency during broker stalls
+
+A 10 ms "frame" loop on the main thread stands in for Tk's event loop and
+announces presence every --announce-every frames, while a background thread
+periodically freezes the in-memory broker (as a slow or blocked RabbitMQ
+would). Frame lag shows whether presence publishing blocks the UI thread.
+
+--mode queued   MQ.announce_presence (send worker publishes)
+--mode inline   publish on the calling thread, as ChatApp's timer used to
+Run: python benchmarks/bench_presence_stall.py [--mode queued|inline]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import outbox
+import rabbitmq_manager
+from fake_broker import InMemoryBroker
+from bench_end_to_end import percentile
+
+FRAME = 0.01
+
+def stall_broker(broker, stall, every, stop):
+    """Hold the broker lock for stall seconds every every seconds"""
+    while not stop.wait(every):
+        with broker.cond:
+            time.sleep(stall)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", default="queued", choices=["queued", "inline"])
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--stall", type=float, default=0.5, help="broker stall length in seconds")
+    parser.add_argument("--announce-every", type=int, default=10, help="frames between announcements")
+    args = parser.parse_args()
+    
+    logging.getLogger("chat").setLevel(logging.WARNING)
+    broker = InMemoryBroker()
+    rabbitmq_manager.pika.BlockingConnection = broker.connect
+    
+    with tempfile.TemporaryDirectory() as directory:
+        outbox.OUTBOX_PATH = Path(directory)
+        mq = rabbitmq_manager.MQ("alice")
+        
+        if args.mode == "queued":
+            announce = mq.announce_presence
+        else:
+            def announce(status='online'):
+                with mq._lock:
+                    mq._publish_presence(status)
+        
+        stop = threading.Event()
+        threading.Thread(target=stall_broker, args=(broker, args.stall, 1.0, stop), daemon=True).start()
+        
+        lags = []
+        frame = 0
+        due = time.perf_counter() + FRAME
+        end = time.perf_counter() + args.seconds
+        while time.perf_counter() < end:
+            time.sleep(max(0, due - time.perf_counter()))
+            frame += 1
+            if frame % args.announce_every == 0:
+                announce('online')
+            
+            # Lag = how late this frame finished, like a Tk after() tick
+            now = time.perf_counter()
+            lags.append(now - due)
+            due = now + FRAME
+        
+        stop.set()
+        mq.close()
+    
+    print(f"{args.mode}: {len(lags)} frames, {args.stall * 1e3:.0f} ms broker stall every second")
+    print(f"frame lag p50 {percentile(lags, 50) * 1e3:.1f} ms, p99 {percentile(lags, 99) * 1e3:.1f} ms, "
+          f"max {max(lags) * 1e3:.1f} ms")
+
+if __name__ == "__main__":
+    main()
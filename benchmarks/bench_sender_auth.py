@@ -0,0 +1,106 @@
+"""
+Cost of sender authentication per message
+
+Sessions are authenticated once, on their key message (RSA-PSS signature,
+or an X25519 MAC); later messages ride on the authenticated session key.
+Reports sign/verify cost per session, the amortized cost per message for
+a few session lengths, and certificate validation cold vs cached.
+Run: python benchmarks/bench_sender_auth.py [--rounds N]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pki_manager
+import session_manager
+from crypto_manager import authenticate, verify_authenticator
+from pki_manager import generate_key
+from bench_sessions import write_key
+
+MESSAGE = "Hello, this is a typical short chat message!"
+
+def timed(fn, rounds):
+    """Mean seconds per call"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds
+
+def bench_pair(directory, sender_type, recipient_type, rounds):
+    sender_path, sender_pub = write_key(generate_key(sender_type), directory, f"s_{sender_type}")
+    recipient_path, recipient_pub = write_key(generate_key(recipient_type), directory, f"r_{recipient_type}")
+    data = os.urandom(300)  # ~ session key header
+    
+    signature = authenticate(data, sender_path, recipient_pub)
+    if signature is None:
+        print(f"{sender_type:>7} -> {recipient_type:<7} cannot authenticate (accepted unsigned)")
+        return
+    assert verify_authenticator(data, signature, recipient_path, sender_pub)
+    
+    sign = timed(lambda: authenticate(data, sender_path, recipient_pub), rounds)
+    verify = timed(lambda: verify_authenticator(data, signature, recipient_path, sender_pub), rounds)
+    per_session = sign + verify
+    amortized = "  ".join(f"{per_session / n * 1e6:8.2f}us" for n in (1, 10, session_manager.SESSION_MAX_MESSAGES))
+    print(f"{sender_type:>7} -> {recipient_type:<7} sign {sign * 1e6:8.1f}us  verify {verify * 1e6:8.1f}us  "
+          f"{len(signature):>4}B  per msg {amortized}")
+
+def bench_session_overhead(directory, key_type, rounds):
+    """Whole first message (wrap + sign + verify + unwrap) with and without authentication"""
+    path, pub = write_key(generate_key(key_type), directory, f"sess_{key_type}")
+    
+    def first_message():
+        alice = session_manager.SessionManager("alice", path, lambda user: pub)
+        bob = session_manager.SessionManager("bob", path, lambda user: pub)
+        bob.decrypt("alice", alice.encrypt("bob", MESSAGE))
+    
+    authenticated = timed(first_message, rounds)
+    original = session_manager.authenticate
+    session_manager.authenticate = lambda data, priv_path, pub_key: None  # Unsigned SESSION_KEY
+    session_manager.REQUIRE_AUTHENTICATED = False
+    try:
+        unsigned = timed(first_message, rounds)
+    finally:
+        session_manager.authenticate = original
+        session_manager.REQUIRE_AUTHENTICATED = True
+    print(f"{key_type:>7} first message: {unsigned * 1e6:8.1f}us unsigned, {authenticated * 1e6:8.1f}us signed")
+
+def bench_certificates(rounds):
+    """PKIManager validates a sender certificate chain once, then serves it from cache"""
+    with tempfile.TemporaryDirectory() as pki_dir:
+        pki_manager.PKI_PATH = Path(pki_dir)
+        pki_manager.CA_KEY_TYPE = "rsa"
+        pki = pki_manager.PKIManager(signing="local")
+        pki.create_user_cert("alice", key_type="x25519")
+        
+        def cold():
+            pki._verified.clear()
+            pki._key_cache.clear()
+            pki.get_user_public_key("alice")
+        
+        print(f"\ncertificate validation: cold {timed(cold, rounds) * 1e6:8.1f}us, "
+              f"cached {timed(lambda: pki.get_user_public_key('alice'), rounds * 10) * 1e6:8.1f}us")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+    
+    logging.getLogger("chat").setLevel(logging.WARNING)
+    print(f"per msg = per-session cost spread over sessions of 1, 10 and "
+          f"{session_manager.SESSION_MAX_MESSAGES} messages\n")
+    with tempfile.TemporaryDirectory() as directory:
+        for sender_type, recipient_type in [("rsa", "rsa"), ("rsa", "x25519"), ("x25519", "x25519"), ("x25519", "rsa")]:
+            bench_pair(directory, sender_type, recipient_type, args.rounds)
+        print()
+        for key_type in ("rsa", "x25519"):
+            bench_session_overhead(directory, key_type, max(1, args.rounds // 4))
+    bench_certificates(max(1, args.rounds // 4))
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
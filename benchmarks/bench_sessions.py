@@ -0,0 +1,65 @@
+"""
+Compare per-message public-key encryption with per-peer session keys
+
+Run: python benchmarks/bench_sessions.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.primitives import serialization
+from pki_manager import generate_key
+from crypto_manager import encrypt, decrypt
+from session_manager import SessionManager
+
+MESSAGE = "Hello, this is a typical short chat message!"
+
+def write_key(key, directory, name):
+    """Save private key PEM, return (path, public key DER)"""
+    path = os.path.join(directory, f"{name}.key")
+    with open(path, 'wb') as f:
+        f.write(key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        ))
+    pub_der = key.public_key().public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return path, pub_der
+
+def per_message(rounds, priv_path, pub_der):
+    """Seconds per message round trip with encrypt/decrypt on every message"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        decrypt(encrypt(MESSAGE, pub_der), priv_path)
+    return (time.perf_counter() - start) / rounds
+
+def with_sessions(rounds, priv_path, pub_der):
+    """Seconds per message round trip through SessionManager (first message included)"""
+    alice = SessionManager("alice", priv_path, lambda user: pub_der)
+    bob = SessionManager("bob", priv_path, lambda user: pub_der)
+    
+    start = time.perf_counter()
+    for _ in range(rounds):
+        bob.decrypt("alice", alice.encrypt("bob", MESSAGE))
+    return (time.perf_counter() - start) / rounds
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    
+    print(f"{rounds} messages per run\n")
+    print(f"{'key type':<10}{'per-message':>14}{'session':>12}{'speedup':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for key_type in ("rsa", "x25519"):
+            priv_path, pub_der = write_key(generate_key(key_type), directory, key_type)
+            slow = per_message(rounds, priv_path, pub_der)
+            fast = with_sessions(rounds, priv_path, pub_der)
+            print(f"{key_type:<10}{slow * 1e6:>12.0f}us{fast * 1e6:>10.1f}us{slow / fast:>9.0f}x")
+
+if __name__ == "__main__":
+    main()
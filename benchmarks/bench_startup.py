@@ -0,0 +1,107 @@
+"""
+Cold start benchmark
+
+1. Import profile of the login screen (python -X importtime, fresh interpreter)
+2. Cost of the subsystems LoginApp now defers (LDAP, PKI with and without a CA)
+3. Time to first window via main.py (needs a display)
+
+Run: python benchmarks/bench_startup.py [--runs N]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Should not be loaded before the user logs in
+HEAVY_MODULES = ("ldap3", "cryptography", "Crypto", "pika", "pki_manager", "ldap_manager")
+
+def import_profile(module):
+    """Parse -X importtime output into {module: (self us, cumulative us, depth)}"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    profile = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        profile[name.strip()] = (int(own), int(cumulative), depth)
+    return profile
+
+def bench_imports(runs):
+    """Median cumulative import time of ui.login and which heavy modules it pulls in"""
+    totals = []
+    profile = {}
+    for _ in range(runs):
+        profile = import_profile("ui.login")
+        totals.append(profile["ui.login"][1] if "ui.login" in profile else 0)
+    
+    print(f"import ui.login: {statistics.median(totals) / 1e3:.1f} ms (median of {runs})")
+    loaded = [name for name in HEAVY_MODULES if name in profile]
+    print(f"heavy modules loaded at import: {', '.join(loaded) or 'none'}")
+    
+    top = sorted((item for item in profile.items() if item[1][2] <= 1), key=lambda item: -item[1][1])[:8]
+    for name, (_, cumulative, _) in top:
+        print(f"  {name:<30}{cumulative / 1e3:>8.1f} ms")
+
+def bench_deferred():
+    """What the first login (or the background warm-up) pays instead"""
+    import pki_manager
+    
+    start = time.perf_counter()
+    import ldap_manager
+    ldap_manager.LDAPManager()
+    print(f"\nLDAPManager (import ldap3):     {(time.perf_counter() - start) * 1e3:8.1f} ms")
+    
+    with tempfile.TemporaryDirectory() as pki_dir:
+        pki_manager.PKI_PATH = Path(pki_dir)
+        start = time.perf_counter()
+        pki_manager.PKIManager(signing="local")
+        print(f"PKIManager, creating the CA:    {(time.perf_counter() - start) * 1e3:8.1f} ms")
+        
+        start = time.perf_counter()
+        pki_manager.PKIManager(signing="local")
+        print(f"PKIManager, existing CA:        {(time.perf_counter() - start) * 1e3:8.1f} ms")
+
+def bench_first_window(runs):
+    """main.py until the login window is drawn"""
+    if sys.platform != "win32" and not os.environ.get("DISPLAY"):
+        print("\ntime to first window: skipped (no display)")
+        return
+    
+    env = dict(os.environ, CHAT_STARTUP_EXIT="1")
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "main.py"], cwd=ROOT, env=env,
+                                capture_output=True, text=True)
+        wall = time.perf_counter() - start
+        for line in result.stdout.splitlines():
+            if line.startswith("mark") and "first window" in line:
+                times.append(float(line.split()[-2]))
+        if not times:
+            print(f"\nmain.py failed:\n{result.stderr}")
+            return
+    print(f"\ntime to first window: {statistics.median(times):.1f} ms in-process, "
+          f"{wall * 1e3:.0f} ms wall incl. interpreter (median of {runs})")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    
+    bench_imports(args.runs)
+    bench_deferred()
+    bench_first_window(args.runs)
+
+if __name__ == "__main__":
+    main()
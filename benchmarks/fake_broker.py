@@ -0,0 +1,185 @@
+"""
+In-process stand-in for a RabbitMQ broker
+
+Implements the subset of pika's BlockingConnection/channel API used by
+rabbitmq_manager and ui.chat, so the real MQ code runs with no network.
+"""
+import itertools
+import threading
+import time
+from collections import deque
+
+class _Method:
+    """Stand-in for pika method frames"""
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+class _DeclareOk:
+    """Result of queue_declare"""
+    def __init__(self, queue, message_count=0):
+        self.method = _Method(queue=queue, message_count=message_count)
+
+class InMemoryBroker:
+    """Queues, fanout exchanges and consumers shared by all fake connections"""
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queues = {}     # queue name -> deque of (properties, body)
+        self.exchanges = {}  # exchange name -> set of bound queue names
+        self.consumers = {}  # queue name -> [(channel, callback, consumer tag)] competing consumers
+        self.published = 0
+        self.published_bytes = 0
+        self._ids = itertools.count(1)
+    
+    def connect(self, parameters=None):
+        """Factory with the same signature as pika.BlockingConnection"""
+        return FakeConnection(self)
+    
+    def next_id(self):
+        """Unique id for delivery tags, consumer tags and server-named queues"""
+        return next(self._ids)
+    
+    def publish(self, exchange, routing_key, body, properties):
+        """Route a message to a queue (default exchange) or every bound queue (fanout)"""
+        with self.cond:
+            if exchange == '':
+                targets = [routing_key] if routing_key in self.queues else []
+            else:
+                targets = list(self.exchanges.get(exchange, ()))
+            
+            for name in targets:
+                self.queues[name].append((properties, body))
+            
+            self.published += 1
+            self.published_bytes += len(body)
+            self.cond.notify_all()
+
+class FakeConnection:
+    """Stand-in for pika.BlockingConnection"""
+    def __init__(self, broker):
+        self.broker = broker
+        self.channels = []
+        self.is_open = True
+    
+    @property
+    def is_closed(self):
+        return not self.is_open
+    
+    def add_callback_threadsafe(self, callback):
+        callback()
+    
+    def channel(self):
+        channel = FakeChannel(self)
+        self.channels.append(channel)
+        return channel
+    
+    def process_data_events(self, time_limit=0):
+        """Deliver messages waiting on queues consumed by this connection"""
+        broker = self.broker
+        deadline = time.monotonic() + (time_limit or 0)
+        
+        with broker.cond:
+            while True:
+                deliveries = self._collect()
+                remaining = deadline - time.monotonic()
+                if deliveries or remaining <= 0 or not self.is_open:
+                    break
+                broker.cond.wait(remaining)
+        
+        # Callbacks run outside the broker lock, like pika's dispatch
+        for channel, callback, tag, queue, properties, body in deliveries:
+            method = _Method(delivery_tag=broker.next_id(), routing_key=queue,
+                             consumer_tag=tag, redelivered=False)
+            callback(channel, method, properties, body)
+    
+    def _collect(self):
+        """Pop all deliverable messages (caller holds the broker lock)"""
+        deliveries = []
+        for queue, consumers in list(self.broker.consumers.items()):
+            for channel, callback, tag in consumers:
+                if channel.connection is not self:
+                    continue
+                # Prefetch caps what one consumer takes per pass, leaving the rest to competitors
+                messages = self.broker.queues.get(queue)
+                taken = 0
+                while messages and (not channel.prefetch or taken < channel.prefetch):
+                    properties, body = messages.popleft()
+                    deliveries.append((channel, callback, tag, queue, properties, body))
+                    taken += 1
+        return deliveries
+    
+    def close(self):
+        with self.broker.cond:
+            for channel in self.channels:
+                channel.is_open = False
+            self.is_open = False
+            # A closed connection's consumers stop competing for messages
+            for queue, consumers in list(self.broker.consumers.items()):
+                consumers[:] = [consumer for consumer in consumers if consumer[0].connection is not self]
+                if not consumers:
+                    del self.broker.consumers[queue]
+            self.broker.cond.notify_all()
+
+class FakeChannel:
+    """Stand-in for pika's BlockingChannel"""
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.is_open = True
+        self.prefetch = 0
+        self._consuming = False
+    
+    @property
+    def is_closed(self):
+        return not self.is_open
+    
+    def basic_qos(self, prefetch_count=0, **kwargs):
+        self.prefetch = prefetch_count
+    
+    def queue_declare(self, queue='', durable=False, exclusive=False, arguments=None, **kwargs):
+        with self.broker.cond:
+            if not queue:
+                queue = f"amq.gen-{self.broker.next_id()}"
+            messages = self.broker.queues.setdefault(queue, deque())
+            return _DeclareOk(queue, len(messages))
+    
+    def exchange_declare(self, exchange, exchange_type='direct', **kwargs):
+        with self.broker.cond:
+            self.broker.exchanges.setdefault(exchange, set())
+    
+    def queue_bind(self, queue, exchange, routing_key=None, **kwargs):
+        with self.broker.cond:
+            self.broker.exchanges.setdefault(exchange, set()).add(queue)
+    
+    def basic_publish(self, exchange, routing_key, body, properties=None, **kwargs):
+        if not self.is_open:
+            raise ConnectionError("Channel is closed")
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.broker.publish(exchange, routing_key, body, properties)
+    
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, **kwargs):
+        tag = f"ctag-{self.broker.next_id()}"
+        with self.broker.cond:
+            self.broker.consumers.setdefault(queue, []).append((self, on_message_callback, tag))
+        return tag
+    
+    def basic_cancel(self, consumer_tag):
+        with self.broker.cond:
+            for queue, consumers in list(self.broker.consumers.items()):
+                consumers[:] = [consumer for consumer in consumers if consumer[2] != consumer_tag]
+                if not consumers:
+                    del self.broker.consumers[queue]
+    
+    def basic_ack(self, delivery_tag=0, **kwargs):
+        pass
+    
+    def start_consuming(self):
+        self._consuming = True
+        while self._consuming and self.is_open:
+            self.connection.process_data_events(time_limit=1)
+    
+    def stop_consuming(self):
+        self._consuming = False
+    
+    def close(self):
+        self.is_open = False
\ No newline at end of file
@@ -0,0 +1,64 @@
+"""
+In-process stand-in for the LDAP directory
+
+Replaces ldap3's Server/Connection in ldap_manager so authentication and
+registration run with no network.
+"""
+from ldap3.core.exceptions import LDAPBindError
+
+class _Attribute:
+    def __init__(self, value):
+        self.value = value
+
+class _Entry:
+    def __init__(self, attributes):
+        for name, value in attributes.items():
+            setattr(self, name, _Attribute(value))
+
+class FakeDirectory:
+    """Users keyed by DN, shared by every fake connection"""
+    def __init__(self):
+        self.entries = {}  # dn -> attributes
+    
+    def add_user(self, dn, password, **attributes):
+        attributes['userPassword'] = password
+        self.entries[dn] = attributes
+    
+    def server(self, host, get_info=None):
+        """Factory with the same signature as ldap3.Server"""
+        return self
+    
+    def connection(self, server, user=None, password=None, auto_bind=False, **kwargs):
+        """Factory with the same signature as ldap3.Connection"""
+        return FakeConnection(self, user, password, auto_bind)
+
+class FakeConnection:
+    """Stand-in for ldap3.Connection"""
+    def __init__(self, directory, user, password, auto_bind):
+        self.directory = directory
+        self.bound = False
+        self.entries = []
+        
+        if auto_bind:
+            entry = directory.entries.get(user)
+            if entry is None or entry.get('userPassword') != password:
+                raise LDAPBindError("invalid credentials")
+            self.bound = True
+    
+    def search(self, base, search_filter, search_scope=None, attributes=None):
+        """Supports the (uid=...) and (objectClass=...) filters ldap_manager uses"""
+        key, _, value = search_filter.strip('()').partition('=')
+        self.entries = [
+            _Entry(attrs) for dn, attrs in self.directory.entries.items()
+            if dn.endswith(base) and (key == 'objectClass' or attrs.get(key) == value)
+        ]
+        return bool(self.entries)
+    
+    def add(self, dn, attributes=None, **kwargs):
+        if dn in self.directory.entries:
+            return False
+        self.directory.entries[dn] = dict(attributes or {})
+        return True
+    
+    def unbind(self):
+        self.bound = False
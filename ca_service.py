@@ -0,0 +1,523 @@
+import argparse
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import sqlite3
+import struct
+import threading
+import time
+import uuid
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.exceptions import InvalidSignature, InvalidTag
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, padding, rsa, x25519
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+import pki_manager
+from rabbitmq_manager import (pika, open_first, RABBITMQ_NODES, RABBITMQ_USER, _close_quietly,
+                              ConnectionSupervisor, TransportClosed)
+from logger import get_logger
+import metrics
+
+log = get_logger("ca")
+
+# RPC queue consumed by the signing service. Requests expire unanswered
+# after SIGN_TIMEOUT, when the requesting client has given up anyway
+CA_RPC_QUEUE = "chat_ca_sign"
+SIGN_TIMEOUT = 30
+
+# Broker account of the signing service. Clients share one account, so only
+# a separate one - with permissions_commands() applied - keeps other clients
+# from consuming (and swallowing) signing requests
+CA_RABBITMQ_USER = os.environ.get("CHAT_CA_RABBITMQ_USER", "")
+CA_RABBITMQ_PASS = os.environ.get("CHAT_CA_RABBITMQ_PASS", "")
+
+# Requests signed per round - their certificates share one keystore write.
+# A partial batch waits BATCH_WAIT seconds for more requests
+SIGN_BATCH = 64
+BATCH_WAIT = 0.02
+
+MAX_USERNAME_LENGTH = 64
+
+# Every request carries the user's LDAP password, checked with a bind. A user
+# who already has a certificate is only re-issued one for a request signed by
+# the currently certified key ('renewal'), or once an admin approved it with
+# ca_service.py --approve USER (valid for APPROVAL_TTL)
+APPROVAL_TTL = 24 * 3600
+
+# Every request starts with a challenge: an X25519 key the service derives
+# from ca.key (so any signer worker knows it), signed by the CA. The request,
+# password included, is sealed to it with a key made for that one request,
+# so nobody else reading the queue learns it. X25519 keys cannot sign a CSR;
+# they also prove possession with a MAC keyed by a DH with the challenge key.
+# A challenge is good for CHALLENGE_TTL seconds
+CHALLENGE_TTL = 2 * SIGN_TIMEOUT
+CHALLENGE = struct.Struct(">Q16s")  # issue time, random
+
+CERTS_ISSUED = metrics.counter("chat_ca_certs_issued_total", "User certificates issued by the signing service")
+SIGN_REJECTED = metrics.counter("chat_ca_requests_rejected_total", "Signing requests refused (bad CSR, name mismatch)")
+SIGN_BATCH_SIZE = metrics.histogram(
+    "chat_ca_batch_size", "Signing requests handled per round",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250)
+)
+
+def _b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+def _signed_data(request):
+    """Bytes covered by the renewal signature and the X25519 possession MAC"""
+    covered = {k: v for k, v in request.items() if k not in ('password', 'renewal', 'pop')}
+    return json.dumps(covered, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+def _pop_mac(shared_secret, data):
+    key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"chat-ca-pop").derive(shared_secret)
+    return hmac.new(key, data, hashlib.sha256).digest()
+
+def _request_cipher(shared_secret, challenge):
+    """AES-GCM for one sealed request - its key is used once, so the nonce is fixed"""
+    return AESGCM(HKDF(algorithm=hashes.SHA256(), length=32, salt=challenge, info=b"chat-ca-request").derive(shared_secret))
+
+def _sign(private_key, data):
+    if isinstance(private_key, rsa.RSAPrivateKey):
+        return private_key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        return private_key.sign(data)
+    raise ValueError("X25519 keys cannot sign a renewal - ask an admin to approve the re-issue")
+
+def _verify(public_key, signature, data):
+    try:
+        if isinstance(public_key, rsa.RSAPublicKey):
+            public_key.verify(signature, data, padding.PKCS1v15(), hashes.SHA256())
+        elif isinstance(public_key, ed25519.Ed25519PublicKey):
+            public_key.verify(signature, data)
+        else:
+            return False
+        return True
+    except InvalidSignature:
+        return False
+
+def challenge_key(ca_key, challenge):
+    """X25519 key for one challenge - the same in every process holding ca.key"""
+    ca_der = ca_key.private_bytes(
+        serialization.Encoding.DER, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    )
+    seed = HKDF(algorithm=hashes.SHA256(), length=32, salt=challenge, info=b"chat-ca-challenge").derive(ca_der)
+    return x25519.X25519PrivateKey.from_private_bytes(seed)
+
+def build_request(username, user_key, password=None, challenge=None, current_key=None):
+    """
+    Signing request body for user_key
+    Keys that can sign (RSA, Ed25519) send a CSR as proof of possession;
+    X25519 keys send their public key and a MAC from a DH with challenge
+    (the service's reply to build_challenge). current_key, the key of the
+    user's current certificate, signs a renewal.
+    """
+    request = {'username': username, 'time': int(time.time())}
+    if isinstance(user_key, x25519.X25519PrivateKey):
+        request['public_key'] = _b64(pki_manager.public_key_der(user_key))
+        if challenge is not None:
+            request['challenge'] = challenge['challenge']
+    else:
+        csr = x509.CertificateSigningRequestBuilder().subject_name(
+            x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, username)])
+        ).sign(user_key, pki_manager.signing_hash(user_key))
+        request['csr'] = _b64(csr.public_bytes(serialization.Encoding.DER))
+    
+    data = _signed_data(request)
+    if 'challenge' in request:
+        challenge_public = x25519.X25519PublicKey.from_public_bytes(base64.b64decode(challenge['public_key']))
+        request['pop'] = _b64(_pop_mac(user_key.exchange(challenge_public), data))
+    if current_key is not None:
+        request['renewal'] = _b64(_sign(current_key, data))
+    if password is not None:
+        request['password'] = password
+    return json.dumps(request).encode('utf-8')
+
+def build_challenge(username):
+    """Request body asking for a challenge (the only request sent in the clear)"""
+    return json.dumps({'op': 'challenge', 'username': username}).encode('utf-8')
+
+def verify_challenge(challenge, ca_cert):
+    """Check the service's challenge reply is signed by our CA - raises ValueError otherwise"""
+    try:
+        signed = base64.b64decode(challenge['challenge']) + base64.b64decode(challenge['public_key'])
+        signature = base64.b64decode(challenge['signature'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Malformed challenge from the CA signing service")
+    if not _verify(ca_cert.public_key(), signature, signed):
+        raise ValueError("Challenge is not signed by the CA - refusing to send the request")
+
+def seal_request(body, challenge):
+    """Encrypt a request body to the challenge key (see verify_challenge)"""
+    ephemeral = x25519.X25519PrivateKey.generate()
+    challenge_bytes = base64.b64decode(challenge['challenge'])
+    challenge_public = x25519.X25519PublicKey.from_public_bytes(base64.b64decode(challenge['public_key']))
+    cipher = _request_cipher(ephemeral.exchange(challenge_public), challenge_bytes)
+    return json.dumps({
+        'challenge': challenge['challenge'],
+        'ephemeral': _b64(ephemeral.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)),
+        'sealed': _b64(cipher.encrypt(bytes(12), body, challenge_bytes))
+    }).encode('utf-8')
+
+def parse_request(body):
+    """Request dict from a body, with a valid username - raises ValueError otherwise"""
+    try:
+        request = json.loads(body)
+        username = request['username']
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Malformed signing request")
+    if not isinstance(request, dict) or not isinstance(username, str) or not 0 < len(username) <= MAX_USERNAME_LENGTH:
+        raise ValueError("Invalid username")
+    return request
+
+def request_public_key(request):
+    """Public key a request asks to certify - raises ValueError if it is not acceptable"""
+    username = request['username']
+    if 'csr' in request:
+        csr = x509.load_der_x509_csr(base64.b64decode(request['csr']))
+        if not csr.is_signature_valid:
+            raise ValueError(f"CSR for {username} has an invalid signature")
+        common_names = csr.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+        if not common_names or common_names[0].value != username:
+            raise ValueError(f"CSR subject does not match {username}")
+        return csr.public_key()
+    
+    public_key = serialization.load_der_public_key(base64.b64decode(request['public_key']))
+    if not isinstance(public_key, x25519.X25519PublicKey):
+        raise ValueError(f"Request for {username} must carry a CSR")
+    return public_key
+
+class Approvals:
+    """Admin approvals to re-issue a user's certificate - each is used once"""
+    def __init__(self, path=None):
+        self.path = path or pki_manager.PKI_PATH / "ca_approvals.db"
+        self._db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS approvals (username TEXT PRIMARY KEY, expires REAL NOT NULL)")
+    
+    def approve(self, username, ttl=APPROVAL_TTL):
+        self._db.execute("INSERT OR REPLACE INTO approvals VALUES (?, ?)", (username, time.time() + ttl))
+    
+    def consume(self, username):
+        """True (and the approval is gone) if username has an unexpired approval"""
+        cursor = self._db.execute("DELETE FROM approvals WHERE username = ? AND expires > ?",
+                                  (username, time.time()))
+        return cursor.rowcount == 1
+
+class CertificateSigner:
+    """
+    CA signing service - the only process that reads ca.key
+    Loads the CA once, consumes CA_RPC_QUEUE and signs up to SIGN_BATCH
+    requests per round: their certificates go into the keystore with one
+    write and fsync, then each requester gets its reply. Several signers
+    (processes or hosts with the PKI share) can consume the same queue.
+    authenticate(username, password) defaults to an LDAP bind.
+    """
+    def __init__(self, nodes=None, authenticate=None):
+        self.nodes = nodes or RABBITMQ_NODES
+        self.pki = pki_manager.PKIManager(signing="local", key_source="keystore")  # Creates the CA on first run
+        self.ca_key, self.ca_cert = pki_manager.load_ca()
+        if authenticate is None:
+            from ldap_manager import LDAPManager
+            authenticate = LDAPManager().authenticate
+        self.authenticate = authenticate
+        self.approvals = Approvals()
+        self._stopping = threading.Event()
+    
+    def challenge(self):
+        """Fresh challenge, signed by the CA (no state - see challenge_key)"""
+        challenge = CHALLENGE.pack(int(time.time()), os.urandom(16))
+        public_key = challenge_key(self.ca_key, challenge).public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw
+        )
+        return {'challenge': _b64(challenge), 'public_key': _b64(public_key),
+                'signature': _b64(_sign(self.ca_key, challenge + public_key))}
+    
+    def _challenge_key(self, encoded):
+        """(challenge, our X25519 key for it) - raises ValueError once it expired"""
+        challenge = base64.b64decode(encoded)
+        issued, _ = CHALLENGE.unpack(challenge)
+        if not 0 <= time.time() - issued <= CHALLENGE_TTL:
+            raise ValueError("Challenge expired")
+        return challenge, challenge_key(self.ca_key, challenge)
+    
+    def _unseal(self, body):
+        """Plaintext of a sealed request body, or None if body is not sealed"""
+        try:
+            envelope = json.loads(body)
+        except ValueError:
+            raise ValueError("Malformed signing request")
+        if not isinstance(envelope, dict) or 'sealed' not in envelope:
+            return None
+        try:
+            challenge, key = self._challenge_key(envelope['challenge'])
+            ephemeral = x25519.X25519PublicKey.from_public_bytes(base64.b64decode(envelope['ephemeral']))
+            sealed = base64.b64decode(envelope['sealed'])
+        except (KeyError, TypeError, struct.error, binascii.Error):
+            raise ValueError("Malformed signing request")
+        try:
+            return _request_cipher(key.exchange(ephemeral), challenge).decrypt(bytes(12), sealed, challenge)
+        except InvalidTag:
+            raise ValueError("Signing request could not be decrypted")
+    
+    def _check_possession(self, request, public_key):
+        """X25519 requests must MAC the request with a DH against a fresh challenge"""
+        if not isinstance(public_key, x25519.X25519PublicKey):
+            return  # The CSR signature proved it
+        try:
+            challenge, key = self._challenge_key(request['challenge'])
+            pop = base64.b64decode(request['pop'])
+        except (KeyError, TypeError, struct.error, binascii.Error):
+            raise ValueError(f"Request for {request['username']} has no proof of possession")
+        shared_secret = key.exchange(public_key)
+        if not hmac.compare_digest(pop, _pop_mac(shared_secret, _signed_data(request))):
+            raise ValueError(f"Proof of possession failed for {request['username']}")
+    
+    def _check_reissue(self, request, public_key, issued):
+        """A user with a certificate needs a renewal signed by its key, or an admin approval"""
+        username = request['username']
+        if username in issued:
+            raise ValueError(f"Another request for {username} is in this batch")
+        current = self.pki.keystore.get(username)
+        if current is None:
+            return
+        
+        if bytes(current[1]) == pki_manager.public_key_der(public_key):
+            # Same key (e.g. a request redelivered after we died mid-batch) - nothing changes hands
+            log.info("Re-issuing certificate for %s with its current key", username)
+        elif 'renewal' in request:
+            current_key = serialization.load_der_public_key(current[1])
+            if not _verify(current_key, base64.b64decode(request['renewal']), _signed_data(request)):
+                raise ValueError(f"Renewal for {username} is not signed by the current key")
+            log.info("Renewing certificate for %s", username)
+        elif self.approvals.consume(username):
+            log.info("Re-issuing certificate for %s (approved by an admin)", username)
+        else:
+            raise ValueError(f"{username} already has a certificate - re-issuing needs a renewal "
+                             f"signed by the current key, or an admin approval")
+    
+    def sign_batch(self, bodies):
+        """Sign request bodies and publish the certificates, return one reply per body"""
+        replies = []
+        entries = []
+        issued = set()
+        for body in bodies:
+            try:
+                plain = self._unseal(body)
+                request = parse_request(body if plain is None else plain)
+                if request.get('op') == 'challenge':
+                    replies.append(self.challenge())
+                    continue
+                if plain is None:
+                    raise ValueError("Signing requests must be encrypted to the CA (see verify_challenge)")
+                
+                username = request['username']
+                public_key = request_public_key(request)
+                password = request.get('password')
+                if not isinstance(password, str) or not password or not self.authenticate(username, password):
+                    raise ValueError(f"Authentication failed for {username}")
+                self._check_possession(request, public_key)
+                self._check_reissue(request, public_key, issued)
+                cert_der = pki_manager.issue_certificate(username, public_key, self.ca_key, self.ca_cert)
+            except Exception as e:
+                SIGN_REJECTED.inc()
+                log.warning("Refused signing request: %s", e)
+                replies.append({'error': str(e)})
+                continue
+            
+            issued.add(username)
+            entries.append((username, pki_manager.public_key_der(public_key), cert_der))
+            replies.append({'certificate': _b64(cert_der)})
+        
+        # Published before anyone is answered - a reply means the keystore has it
+        if entries:
+            self.pki.keystore.append_many(entries)
+        CERTS_ISSUED.inc(len(entries))
+        SIGN_BATCH_SIZE.observe(len(bodies))
+        return replies
+    
+    def run(self):
+        """Serve signing requests until stop(), reconnecting (in node order) after a broker failure"""
+        if not CA_RABBITMQ_USER:
+            log.warning("CA signing service uses the clients' broker account, so any client can consume %s. "
+                        "Set CHAT_CA_RABBITMQ_USER (see ca_service.py --permissions)", CA_RPC_QUEUE)
+        
+        pending = []  # (method, properties, body) received this round
+        
+        def setup(channel):
+            # Deliveries of a lost channel are redelivered - their tags are no good now
+            pending.clear()
+            channel.queue_declare(queue=CA_RPC_QUEUE, durable=True)
+            channel.basic_qos(prefetch_count=SIGN_BATCH)
+            channel.basic_consume(
+                queue=CA_RPC_QUEUE,
+                on_message_callback=lambda ch, method, properties, body: pending.append((method, properties, body))
+            )
+            log.info("CA signing service consuming %s", CA_RPC_QUEUE)
+        
+        supervisor = ConnectionSupervisor(
+            "CA signer", lambda: open_first(self.nodes, username=CA_RABBITMQ_USER, password=CA_RABBITMQ_PASS),
+            setup, self._stopping
+        )
+        try:
+            while not self._stopping.is_set():
+                try:
+                    channel = supervisor.get_channel()
+                    self._serve_round(supervisor.conn, channel, pending)
+                except TransportClosed:
+                    break
+                except Exception as e:
+                    if self._stopping.is_set():
+                        break
+                    supervisor.mark_lost(e)
+        finally:
+            supervisor.close()
+    
+    def _serve_round(self, connection, channel, pending):
+        """Wait up to a second for requests, then sign one batch and answer it"""
+        connection.process_data_events(time_limit=1)
+        if not pending:
+            return
+        if len(pending) < SIGN_BATCH:
+            connection.process_data_events(time_limit=BATCH_WAIT)  # Let a burst fill the batch
+        
+        batch = pending[:SIGN_BATCH]
+        del pending[:SIGN_BATCH]
+        replies = self.sign_batch([body for _, _, body in batch])
+        
+        for (method, properties, _), reply in zip(batch, replies):
+            if properties.reply_to:
+                channel.basic_publish(
+                    exchange='',
+                    routing_key=properties.reply_to,
+                    body=json.dumps(reply),
+                    properties=pika.BasicProperties(correlation_id=properties.correlation_id)
+                )
+        # Unacked requests are redelivered (and re-issued) if we die mid-batch
+        channel.basic_ack(delivery_tag=batch[-1][0].delivery_tag, multiple=True)
+    
+    def stop(self):
+        self._stopping.set()
+
+def permissions_commands(ca_user=None, client_user=RABBITMQ_USER):
+    """
+    rabbitmqctl commands giving the signing service its own account: only it
+    may consume (read) or redeclare (configure) CA_RPC_QUEUE; clients may
+    still publish to it and use everything else
+    """
+    ca_user = ca_user or CA_RABBITMQ_USER or "chat_ca"
+    everything_else = f"^(?!{CA_RPC_QUEUE}$).*"
+    return [
+        f"rabbitmqctl add_user {ca_user} <password>",
+        f"rabbitmqctl set_permissions -p / {ca_user} '^{CA_RPC_QUEUE}$' '^amq\\.default$' '^{CA_RPC_QUEUE}$'",
+        f"rabbitmqctl set_permissions -p / {client_user} '{everything_else}' '.*' '{everything_else}'",
+    ]
+
+def request_certificate(username, user_key, password, ca_cert, timeout=SIGN_TIMEOUT, nodes=None, current_key=None):
+    """
+    Ask the signing service to certify user_key (blocks), return the certificate DER
+    The request (and password) is only sent sealed to a challenge signed by ca_cert.
+    """
+    connection = open_first(nodes or RABBITMQ_NODES)
+    try:
+        channel = connection.channel()
+        try:
+            # Clients may not declare the queue (see permissions_commands) - only check it exists
+            channel.queue_declare(queue=CA_RPC_QUEUE, passive=True)
+        except pika.exceptions.ChannelClosedByBroker as e:
+            if e.reply_code != 404:
+                raise
+            raise TimeoutError(f"The CA signing service has never run (no {CA_RPC_QUEUE} queue)\n"
+                               f"Is ca_service.py running?") from e
+        reply_queue = channel.queue_declare(queue='', exclusive=True).method.queue
+        
+        replies = {}  # correlation id -> reply
+        def on_reply(ch, method, properties, body):
+            replies[properties.correlation_id] = json.loads(body)
+        channel.basic_consume(queue=reply_queue, on_message_callback=on_reply, auto_ack=True)
+        
+        def call(body):
+            correlation_id = uuid.uuid4().hex
+            channel.basic_publish(
+                exchange='',
+                routing_key=CA_RPC_QUEUE,
+                body=body,
+                properties=pika.BasicProperties(
+                    reply_to=reply_queue,
+                    correlation_id=correlation_id,
+                    expiration=str(int(timeout * 1000))
+                )
+            )
+            
+            deadline = time.monotonic() + timeout
+            while correlation_id not in replies:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        f"No reply from the CA signing service within {timeout:.0f}s\n"
+                        f"Is ca_service.py running?"
+                    )
+                connection.process_data_events(time_limit=remaining)
+            
+            reply = replies.pop(correlation_id)
+            if 'error' in reply:
+                raise ValueError(f"Certificate request refused: {reply['error']}")
+            return reply
+        
+        # The challenge key carries the sealed request (and X25519 keys' proof of possession)
+        challenge = call(build_challenge(username))
+        verify_challenge(challenge, ca_cert)
+        reply = call(seal_request(build_request(username, user_key, password, challenge, current_key), challenge))
+    finally:
+        _close_quietly(connection)
+    
+    return base64.b64decode(reply['certificate'])
+
+def _run_signer():
+    try:
+        CertificateSigner().run()
+    except KeyboardInterrupt:
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="CA signing service")
+    parser.add_argument("--workers", type=int, default=1, help="signer processes consuming the request queue")
+    parser.add_argument("--approve", metavar="USER",
+                        help=f"allow one re-issue of USER's certificate within {APPROVAL_TTL // 3600}h, then exit")
+    parser.add_argument("--permissions", action="store_true",
+                        help="print the rabbitmqctl commands that reserve the request queue for this service, then exit")
+    args = parser.parse_args()
+    
+    if args.permissions:
+        print("\n".join(permissions_commands()))
+        return
+    
+    # Create the CA (if missing) once, before workers race for it
+    pki_manager.PKIManager(signing="local", key_source="keystore")
+    if args.approve:
+        Approvals().approve(args.approve)
+        print(f"Approved re-issuing the certificate of {args.approve}")
+        return
+    
+    metrics.start_exporter()
+    
+    if args.workers == 1:
+        _run_signer()
+        return
+    
+    workers = [multiprocessing.Process(target=_run_signer, daemon=True) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
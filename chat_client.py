@@ -0,0 +1,333 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+from pki_manager import PKIManager
+from session_manager import SessionManager, InboundKeyStore, route_of, ROUTE_CHAT, ROUTE_GROUP, ROUTE_CONTROL
+from file_transfer import FileTransfers, FILE_PREFIX, is_file_chunk, describe
+from wire_format import unpack_message
+from dedup import RecentIds
+from logger import get_logger
+import metrics
+
+log = get_logger("client")
+
+DUPLICATES_DROPPED = metrics.counter("chat_duplicates_dropped_total", "Redelivered messages dropped by message id")
+MESSAGES_SEALED = metrics.counter("chat_messages_sealed_total", "Messages stored encrypted on arrival (lazy decryption)")
+MESSAGES_OPENED = metrics.counter("chat_messages_opened_total", "Sealed messages decrypted when their conversation was read")
+
+# Store incoming chat messages encrypted and decrypt them when their
+# conversation is displayed (CHAT_LAZY_DECRYPT=1). Control messages and
+# messages from older clients (no routing hint) are decrypted on arrival
+LAZY_DECRYPT = os.environ.get("CHAT_LAZY_DECRYPT") == "1"
+
+GROUP_CHAT = "__GROUP_CHAT__"
+GROUP_PREFIX = "[GROUP] "
+
+def _default_transport(username):
+    """RabbitMQ unless a transport is given (imported lazily - pika is optional for tests)"""
+    from rabbitmq_manager import MQ
+    return MQ(username)
+
+def _timestamp(when=None):
+    return (datetime.fromtimestamp(when) if when else datetime.now()).strftime("%Y-%m-%d %H:%M:%S")
+
+def _group_text(decrypted):
+    """Message text of a "[GROUP] sender: message" plaintext"""
+    decrypted = decrypted[len(GROUP_PREFIX):]
+    return decrypted.split(': ', 1)[1] if ': ' in decrypted else decrypted
+
+class ChatClient:
+    """
+    Headless chat client - owns the transport, PKI and session crypto and the history
+    No Tk dependency, so many instances can run in one process (bots, bridges,
+    load tests). Callbacks run on background threads:
+      on_message(conversation, entry)      - conversation is a username or GROUP_CHAT
+      on_presence(username, online, changed)
+      on_file(event)                       - file transfer progress (see FileTransfers);
+                                             incoming offers wait for accept_file/decline_file
+    With lazy_decrypt, received entries arrive with text None and a sealed
+    ciphertext; history() decrypts them when the conversation is read.
+    Received entries nothing authenticated (X25519 sender, RSA recipient)
+    carry 'unverified': True.
+    """
+    def __init__(self, username, pki=None, transport=None, lazy_decrypt=None):
+        self.username = username
+        self.lazy_decrypt = LAZY_DECRYPT if lazy_decrypt is None else lazy_decrypt
+        self.pki = pki or PKIManager()
+        self.transport = transport or _default_transport(username)
+        self.sessions = SessionManager(
+            username,
+            self.pki.get_user_key_path(username),
+            self.pki.get_user_public_key,
+            InboundKeyStore.for_user(username)  # Queued messages stay readable across restarts
+        )
+        
+        # A lost message may have carried the session key - start a new session
+        self.transport.on_undelivered = self.sessions.reset_peer
+        
+        self.active_users = {}
+        self.user_instances = {}  # Last seen client instance per user
+        self.message_history = {}  # Store messages per conversation
+        self.unread = {}  # conversation -> messages received since mark_read
+        self._history_lock = threading.Lock()
+        self._open_lock = threading.Lock()  # One thread decrypts a sealed entry
+        self._seen_ids = RecentIds()  # Message ids already delivered
+        self._sealed_ids = RecentIds()  # Message ids stored sealed, not yet opened
+        self.files = FileTransfers(username, self.transport, self._send_control)
+        self.files.on_event = self._handle_file_event
+        
+        self.on_message = None
+        self.on_presence = None
+        self.on_file = None
+    
+    def start(self):
+        """Start message and presence listeners and the periodic online announcement"""
+        threading.Thread(target=self.transport.listen, args=(self._handle_message,), daemon=True).start()
+        threading.Thread(target=self.transport.listen_presence, args=(self._handle_presence,), daemon=True).start()
+        self.transport.start_presence_heartbeat()
+        # Resumed downloads re-hash their partial files - not on the caller's (UI) thread
+        threading.Thread(target=self.files.resume_incoming, daemon=True).start()
+    
+    def announce_presence(self, status='online'):
+        """Tell everyone we are online/offline"""
+        self.transport.announce_presence(status)
+    
+    def close(self):
+        """Announce offline and close the broker connection"""
+        self.files.close()
+        self.transport.close()  # Announces offline itself
+        self.sessions.close()
+    
+    def list_users(self):
+        """Get all other users with a published certificate"""
+        users = self.pki.list_users()
+        users.discard(self.username)
+        return users
+    
+    def has_user(self, username):
+        """Check if username has a published, valid certificate"""
+        return self.pki.get_user_public_key(username) is not None
+    
+    def prefetch_users(self, usernames):
+        """Look up many users' certificates in one request, so has_user is then answered from the cache"""
+        self.pki.prefetch_public_keys(usernames)
+    
+    def history(self, conversation):
+        """Get a copy of a conversation's history, decrypting what is still sealed"""
+        with self._history_lock:
+            entries = list(self.message_history.get(conversation, ()))
+        self.open_entries(entries)
+        return entries
+    
+    def open_entries(self, entries):
+        """Decrypt sealed entries in place (a failed one becomes a warning)"""
+        with self._open_lock:
+            for entry in entries:
+                sealed = entry.get('sealed')
+                if sealed is None:
+                    continue
+                message_id = entry.pop('message_id', None)
+                try:
+                    decrypted = sealed.open()
+                    entry['text'] = _group_text(decrypted) if entry['type'] == 'group' else decrypted
+                    entry['timestamp'] = _timestamp(entry['time'])
+                    # Only authenticated messages mark their id as seen
+                    if message_id is not None:
+                        self._seen_ids.add(message_id)
+                except Exception as e:
+                    log.warning("Could not decrypt message from %s: %s", entry.get('sender'), e)
+                    entry['type'] = 'warning'
+                    entry['text'] = f"⚠️  A message from {entry.get('sender')} could not be decrypted"
+                del entry['sealed']
+                MESSAGES_OPENED.inc()
+    
+    def prefetch(self, conversation):
+        """Decrypt a conversation's sealed messages in the background (e.g. on hover)"""
+        threading.Thread(target=self.history, args=(conversation,), daemon=True).start()
+    
+    def unread_count(self, conversation):
+        with self._history_lock:
+            return self.unread.get(conversation, 0)
+    
+    def mark_read(self, conversation):
+        with self._history_lock:
+            self.unread.pop(conversation, None)
+    
+    def add_history(self, conversation, entry):
+        """Append an entry (message, info or warning) to a conversation"""
+        with self._history_lock:
+            self.message_history.setdefault(conversation, []).append(entry)
+    
+    def send_message(self, to_user, text):
+        """Encrypt and queue a private message, return its history entry"""
+        self._send(to_user, text, ROUTE_CHAT)
+        
+        entry = {'type': 'sent', 'text': text, 'timestamp': _timestamp()}
+        self.add_history(to_user, entry)
+        log.debug("Sent %d chars to %s", len(text), to_user)
+        return entry
+    
+    def send_group_message(self, text):
+        """Send to every registered user, return (history entry, recipients reached)"""
+        users = self.list_users()
+        if not users:
+            return None, 0
+        
+        # Create group message with sender info
+        group_msg = f"{GROUP_PREFIX}{self.username}: {text}"
+        self.prefetch_users(users)  # One directory request, not one per member
+        messages = []
+        for user in users:
+            try:
+                if self.has_user(user):
+                    messages.append((user, self.sessions.encrypt(user, group_msg, ROUTE_GROUP)))
+            except Exception as e:
+                log.warning("Failed to encrypt for %s: %s", user, e)
+        sent_count = self.transport.publish_group(messages)
+        for user, _ in messages[sent_count:]:
+            self.sessions.reset_peer(user)  # Not queued - their session key never went out
+        
+        entry = {'type': 'group', 'sender': self.username, 'text': text, 'timestamp': _timestamp()}
+        self.add_history(GROUP_CHAT, entry)
+        log.debug("Group broadcast of %d chars to %d users", len(text), sent_count)
+        return entry, sent_count
+    
+    def send_file(self, to_user, path):
+        """Stream a file to a user in the background, return the transfer id"""
+        return self.files.send_file(to_user, path)
+    
+    def accept_file(self, transfer_id):
+        """Receive a file offered in an 'offered' on_file event"""
+        return self.files.accept(transfer_id)
+    
+    def decline_file(self, transfer_id):
+        """Refuse a file offered in an 'offered' on_file event"""
+        return self.files.decline(transfer_id)
+    
+    def _send_control(self, to_user, text):
+        """Session message that is not shown in the conversation (file offers and acks)"""
+        self._send(to_user, text, ROUTE_CONTROL)
+    
+    def _send(self, to_user, text, route):
+        """Encrypt and queue one session message"""
+        encrypted = self.sessions.encrypt(to_user, text, route)
+        try:
+            self.transport.send_message(to_user, encrypted)
+        except Exception:
+            # Rejected (e.g. SendQueueFull) - the next message starts a fresh session
+            self.sessions.reset_peer(to_user)
+            raise
+    
+    def _handle_file_event(self, event):
+        """Record transfer start/end in the peer's conversation, then notify"""
+        text = describe(event)
+        if text:
+            self.add_history(event['peer'], {'type': 'info', 'text': text, 'timestamp': None})
+        if self.on_file:
+            self.on_file(event)
+    
+    def _handle_message(self, body):
+        """Transport listener callback - decrypt, store in history, notify"""
+        try:
+            # Binary frame (or legacy JSON) - ciphertext is not copied
+            sender, message_id, encrypted_msg = unpack_message(body)
+            
+            # File chunks carry their own transfer key and index - no session, no dedup
+            if message_id is not None and is_file_chunk(encrypted_msg):
+                self.files.handle_chunk(sender, encrypted_msg)
+                return
+            
+            # Retries and outbox replay deliver at least once - show each message once
+            if message_id is not None and (message_id in self._seen_ids or message_id in self._sealed_ids):
+                DUPLICATES_DROPPED.inc()
+                log.debug("Dropped duplicate message from %s", sender)
+                return
+            
+            route = route_of(encrypted_msg)
+            if self.lazy_decrypt and route in (ROUTE_CHAT, ROUTE_GROUP):
+                # Keep the ciphertext - only the session key message costs anything now
+                sealed = self.sessions.seal(sender, encrypted_msg)
+                if message_id is not None:
+                    self._sealed_ids.add(message_id)  # A redelivery is not stored twice
+                MESSAGES_SEALED.inc()
+                entry = {
+                    'type': 'group' if route == ROUTE_GROUP else 'received',
+                    'sender': sender,
+                    'text': None,
+                    'timestamp': None,  # Formatted when opened
+                    'time': time.time(),
+                    'size': len(sealed),
+                    'sealed': sealed,
+                    'message_id': message_id
+                }
+                if not sealed.verified:
+                    entry['unverified'] = True
+                self._store_received(GROUP_CHAT if route == ROUTE_GROUP else sender, entry)
+                return
+            
+            # Decrypt with the sender's session key
+            decrypted, verified = self.sessions.decrypt_verified(sender, encrypted_msg)
+            
+            # Only authenticated messages mark their id as seen
+            if message_id is not None:
+                self._seen_ids.add(message_id)
+            
+            # Route comes from the authenticated header, never from what the sender typed
+            if route == ROUTE_CONTROL:
+                if decrypted.startswith(FILE_PREFIX):
+                    self.files.handle_control(sender, decrypted[len(FILE_PREFIX):])
+                else:
+                    log.warning("Unknown control message from %s", sender)
+                return
+            
+            if route == ROUTE_GROUP:
+                # Format: [GROUP] sender: message
+                conversation = GROUP_CHAT
+                entry = {'type': 'group', 'sender': sender, 'text': _group_text(decrypted), 'timestamp': _timestamp()}
+                log.debug("Group message received from %s", sender)
+            else:
+                conversation = sender
+                entry = {'type': 'received', 'text': decrypted, 'timestamp': _timestamp()}
+                log.debug("Message received from %s", sender)
+            if not verified:
+                entry['unverified'] = True  # Sender's key could not sign the session
+            
+            self._store_received(conversation, entry)
+        except Exception:
+            log.exception("Error receiving message")
+    
+    def _store_received(self, conversation, entry):
+        """Add a received entry to history and the unread count, then notify"""
+        # Store message in history even if nobody is looking at it
+        with self._history_lock:
+            self.message_history.setdefault(conversation, []).append(entry)
+            self.unread[conversation] = self.unread.get(conversation, 0) + 1
+            
+        if self.on_message:
+            self.on_message(conversation, entry)
+    
+    def _handle_presence(self, username, status, instance=None):
+        """Transport presence callback - track who is online"""
+        if username == self.username:
+            return
+        
+        online = (status == 'online')
+        log.debug("Presence update: %s is now %s", username, status)
+        
+        # Peer went offline or restarted - its session keys are gone,
+        # so the next message to it must establish a new session
+        changed = (self.active_users.get(username) != online or
+                   self.user_instances.get(username) != instance)
+        if changed:
+            self.sessions.reset_peer(username)
+        self.user_instances[username] = instance
+        self.active_users[username] = online
+        
+        if self.on_presence:
+            self.on_presence(username, online, changed)
+    
+    def is_online(self, username):
+        """Check last known presence of a user"""
+        return self.active_users.get(username, False)
\ No newline at end of file
@@ -0,0 +1,69 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Codec byte stored in front of the (encrypted) plaintext
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+# Only messages at least this large are compressed. Short messages - the
+# ones likely to hold a typed secret next to text an attacker could inject -
+# are never compressed, so their ciphertext length leaks nothing about content
+COMPRESSION_THRESHOLD = 1024
+
+# zstd is faster than zlib on large payloads. Receivers need the zstandard
+# package to read it, so enable only once every client has it installed
+USE_ZSTD = False
+ZSTD_THRESHOLD = 64 * 1024
+
+# Refuse to inflate beyond this (decompression bomb guard)
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+
+def compress(data):
+    """Compress data if large enough and worth it, return (codec, payload)"""
+    if len(data) < COMPRESSION_THRESHOLD:
+        return CODEC_NONE, data
+    
+    if USE_ZSTD and zstandard is not None and len(data) >= ZSTD_THRESHOLD:
+        codec, packed = CODEC_ZSTD, zstandard.ZstdCompressor(level=3).compress(data)
+    else:
+        codec, packed = CODEC_ZLIB, zlib.compress(data, 6)
+    
+    # Incompressible data (already compressed, random) goes out as-is
+    if len(packed) >= len(data):
+        return CODEC_NONE, data
+    return codec, packed
+
+def decompress(codec, payload):
+    """Reverse of compress"""
+    if codec == CODEC_NONE:
+        return payload
+    
+    if codec == CODEC_ZLIB:
+        inflater = zlib.decompressobj()
+        data = inflater.decompress(payload, MAX_DECOMPRESSED_SIZE)
+        if inflater.unconsumed_tail:
+            raise ValueError("Decompressed message too large")
+        return data
+    
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("Message is zstd-compressed but zstandard is not installed")
+        chunks = []
+        total = 0
+        with zstandard.ZstdDecompressor().stream_reader(payload) as reader:
+            while True:
+                chunk = reader.read(65536)
+                if not chunk:
+                    break
+                total += len(chunk)
+                if total > MAX_DECOMPRESSED_SIZE:
+                    raise ValueError("Decompressed message too large")
+                chunks.append(chunk)
+        return b''.join(chunks)
+    
+    raise ValueError(f"Unknown compression codec: {codec}")
\ No newline at end of file
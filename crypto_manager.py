@@ -1,27 +1,274 @@
-from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_OAEP
-from Crypto.Hash import SHA256
+import hmac
+import os
+from functools import lru_cache
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import x25519
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
-def encrypt(msg, pub_path):
+ECIES_INFO = b"chat-ecies-x25519-aesgcm"
+# Every ECIES message uses a fresh ephemeral key, hence a fresh AES key,
+# so a fixed nonce is safe and saves 12 bytes per message
+ECIES_NONCE = bytes(12)
+
+# X25519 keys cannot sign: a sender proves its key with a MAC keyed from the
+# static-static exchange, which only the sender and the recipient can compute
+AUTH_INFO = b"chat-session-auth-x25519"
+
+# Library for RSA keys: "openssl" (cryptography, also used by the PKI) or
+# "pycryptodome". Both produce the same OAEP and PSS wire formats, so peers
+# need not agree; benchmarks/bench_crypto_backends.py compares them
+CRYPTO_BACKEND = os.environ.get("CHAT_CRYPTO_BACKEND", "openssl")
+
+# RSA-PSS salt = digest length (PyCryptodome's default, fixed for both backends)
+PSS_SALT_LENGTH = 32
+
+class OpenSSLBackend:
+    """RSA through cryptography (OpenSSL) - the same library as the PKI"""
+    name = "openssl"
+    
+    def __init__(self):
+        from cryptography.hazmat.primitives.asymmetric import padding, rsa
+        self._rsa = rsa
+        self._oaep = padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None
+        )
+        self._pss = padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=PSS_SALT_LENGTH)
+    
+    def generate_rsa(self, bits=2048):
+        return self._rsa.generate_private_key(public_exponent=65537, key_size=bits)
+    
+    @staticmethod
+    def import_public_key(key_data):
+        if key_data.startswith(b'-----'):
+            return serialization.load_pem_public_key(key_data)
+        return serialization.load_der_public_key(key_data)
+    
+    @staticmethod
+    def import_private_key(key_data):
+        # Only our own key file is loaded here; OpenSSL's RSA consistency
+        # check would cost ~60ms per load for no gain
+        return serialization.load_pem_private_key(key_data, password=None, unsafe_skip_rsa_key_validation=True)
+    
+    def rsa_encrypt(self, key, data):
+        return key.encrypt(data, self._oaep)
+    
+    def rsa_decrypt(self, key, data):
+        return key.decrypt(data, self._oaep)
+    
+    def sign(self, key, data):
+        return key.sign(data, self._pss, hashes.SHA256())
+    
+    def verify(self, key, data, signature):
+        try:
+            key.verify(signature, data, self._pss, hashes.SHA256())
+            return True
+        except InvalidSignature:
+            return False
+
+class PyCryptodomeBackend:
+    """RSA through PyCryptodome - X25519 keys still go through cryptography"""
+    name = "pycryptodome"
+    
+    def __init__(self):
+        from Crypto.PublicKey import RSA
+        from Crypto.Cipher import PKCS1_OAEP
+        from Crypto.Hash import SHA256
+        from Crypto.Signature import pss
+        self._RSA, self._PKCS1_OAEP, self._SHA256, self._pss = RSA, PKCS1_OAEP, SHA256, pss
+    
+    def generate_rsa(self, bits=2048):
+        return self._RSA.generate(bits)
+    
+    def import_public_key(self, key_data):
+        try:
+            return self._RSA.import_key(key_data)
+        except ValueError:
+            return OpenSSLBackend.import_public_key(key_data)
+    
+    def import_private_key(self, key_data):
+        try:
+            return self._RSA.import_key(key_data)
+        except ValueError:
+            return OpenSSLBackend.import_private_key(key_data)
+    
+    def rsa_encrypt(self, key, data):
+        return self._PKCS1_OAEP.new(key, hashAlgo=self._SHA256).encrypt(data)
+    
+    def rsa_decrypt(self, key, data):
+        return self._PKCS1_OAEP.new(key, hashAlgo=self._SHA256).decrypt(data)
+    
+    def sign(self, key, data):
+        return self._pss.new(key, salt_bytes=PSS_SALT_LENGTH).sign(self._SHA256.new(data))
+    
+    def verify(self, key, data, signature):
+        try:
+            self._pss.new(key, salt_bytes=PSS_SALT_LENGTH).verify(self._SHA256.new(data), signature)
+            return True
+        except (ValueError, TypeError):
+            return False
+
+BACKENDS = {"openssl": OpenSSLBackend, "pycryptodome": PyCryptodomeBackend}
+
+_backend = None
+
+def get_backend(name=None):
+    """The active backend, or a fresh instance of the named one"""
+    global _backend
+    if name is not None:
+        return BACKENDS[name]()
+    if _backend is None:
+        _backend = BACKENDS[CRYPTO_BACKEND]()
+    return _backend
+
+def set_backend(name):
+    """Switch backends - parsed keys belong to one backend, so the key caches are dropped"""
+    global _backend, CRYPTO_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown crypto backend: {name}")
+    CRYPTO_BACKEND = name
+    _backend = None
+    _import_public_key.cache_clear()
+    _import_private_key.cache_clear()
+
+@lru_cache(maxsize=256)
+def _import_public_key(key_data):
+    """Parse a public key once - repeated sends to the same peer reuse it"""
+    return get_backend().import_public_key(key_data)
+
+@lru_cache(maxsize=16)
+def _import_private_key(key_data):
+    """Parse a private key once - the key file is still read on every call"""
+    return get_backend().import_private_key(key_data)
+
+def _ecies_key(shared_secret, ephemeral_pub, recipient_pub):
+    """Derive the AES-256 key for one ECIES message"""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=ECIES_INFO + ephemeral_pub + recipient_pub
+    ).derive(shared_secret)
+
+def _ecies_encrypt(data, pub_key):
     """
-    Encrypt message using recipient's public key (RSA)
+    ECIES with X25519 + HKDF-SHA256 + AES-GCM
+    Output: ephemeral public key (32) | ciphertext | tag (16)
     """
-    with open(pub_path, 'r') as f:
-        pub_key = RSA.import_key(f.read())
+    ephemeral = x25519.X25519PrivateKey.generate()
+    ephemeral_pub = ephemeral.public_key().public_bytes(
+        serialization.Encoding.Raw, serialization.PublicFormat.Raw
+    )
+    recipient_pub = pub_key.public_bytes(
+        serialization.Encoding.Raw, serialization.PublicFormat.Raw
+    )
     
-    cipher = PKCS1_OAEP.new(pub_key, hashAlgo=SHA256)
-    encrypted = cipher.encrypt(msg.encode('utf-8'))
+    key = _ecies_key(ephemeral.exchange(pub_key), ephemeral_pub, recipient_pub)
+    return ephemeral_pub + AESGCM(key).encrypt(ECIES_NONCE, data, None)
+
+def _ecies_decrypt(data, priv_key):
+    """Reverse of _ecies_encrypt"""
+    ephemeral_pub = data[:32]
+    recipient_pub = priv_key.public_key().public_bytes(
+        serialization.Encoding.Raw, serialization.PublicFormat.Raw
+    )
     
-    return encrypted
+    shared = priv_key.exchange(x25519.X25519PublicKey.from_public_bytes(ephemeral_pub))
+    key = _ecies_key(shared, ephemeral_pub, recipient_pub)
+    return AESGCM(key).decrypt(ECIES_NONCE, data[32:], None)
+
+def encrypt_bytes(data, pub_key):
+    """
+    Encrypt raw bytes using recipient's public key (RSA-OAEP or X25519 ECIES)
+    pub_key is either DER/PEM key bytes (from PKIManager.get_user_public_key)
+    or the path of a PEM public key file
+    """
+    if not isinstance(pub_key, bytes):
+        with open(pub_key, 'rb') as f:
+            pub_key = f.read()
+    key = _import_public_key(pub_key)
+    
+    # The algorithm follows the recipient's key, so mixed RSA/EC peers work
+    if isinstance(key, x25519.X25519PublicKey):
+        return _ecies_encrypt(data, key)
+    
+    return get_backend().rsa_encrypt(key, data)
+
+def decrypt_bytes(cipher_text, priv_path):
+    """
+    Decrypt raw bytes using own private key (RSA-OAEP or X25519 ECIES)
+    """
+    cipher_text = bytes(cipher_text)  # May be a memoryview into the message body
+    with open(priv_path, 'rb') as f:
+        priv_key = _import_private_key(f.read())
+    
+    if isinstance(priv_key, x25519.X25519PrivateKey):
+        return _ecies_decrypt(cipher_text, priv_key)
+    
+    return get_backend().rsa_decrypt(priv_key, cipher_text)
+
+def encrypt(msg, pub_key):
+    """
+    Encrypt message using recipient's public key (RSA-OAEP or X25519 ECIES)
+    """
+    return encrypt_bytes(msg.encode('utf-8'), pub_key)
 
 def decrypt(cipher_text, priv_path):
     """
-    Decrypt message using own private key (RSA)
+    Decrypt message using own private key (RSA-OAEP or X25519 ECIES)
+    """
+    return decrypt_bytes(cipher_text, priv_path).decode('utf-8')
+
+def _load_private_key(priv_path):
+    with open(priv_path, 'rb') as f:
+        return _import_private_key(f.read())
+
+def _auth_key(shared_secret, sender_pub, recipient_pub):
+    """MAC key for one sender/recipient pair of X25519 keys"""
+    raw = serialization.Encoding.Raw, serialization.PublicFormat.Raw
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=AUTH_INFO + sender_pub.public_bytes(*raw) + recipient_pub.public_bytes(*raw)
+    ).derive(shared_secret)
+
+def can_authenticate(sender_key_is_x25519, recipient_key_is_x25519):
+    """RSA senders sign; X25519 senders need an X25519 recipient for the MAC"""
+    return not sender_key_is_x25519 or recipient_key_is_x25519
+
+def is_x25519(key):
+    """Check a public key (DER/PEM bytes) or private key path"""
+    if isinstance(key, bytes):
+        return isinstance(_import_public_key(key), x25519.X25519PublicKey)
+    return isinstance(_load_private_key(key), x25519.X25519PrivateKey)
+
+def authenticate(data, priv_path, recipient_pub):
+    """
+    Prove data comes from the owner of priv_path: RSA-PSS signature, or for
+    X25519 an HMAC-SHA256 only recipient_pub's owner can check.
+    Returns None if the key pair cannot do either (X25519 sender, RSA recipient)
     """
-    with open(priv_path, 'r') as f:
-        priv_key = RSA.import_key(f.read())
+    priv_key = _load_private_key(priv_path)
+    if isinstance(priv_key, x25519.X25519PrivateKey):
+        peer_key = _import_public_key(recipient_pub)
+        if not isinstance(peer_key, x25519.X25519PublicKey):
+            return None
+        key = _auth_key(priv_key.exchange(peer_key), priv_key.public_key(), peer_key)
+        return hmac.new(key, data, 'sha256').digest()
     
-    cipher = PKCS1_OAEP.new(priv_key, hashAlgo=SHA256)
-    decrypted = cipher.decrypt(cipher_text)
+    return get_backend().sign(priv_key, data)
+
+def verify_authenticator(data, tag, priv_path, sender_pub):
+    """Check an authenticate() tag from the owner of sender_pub (we are the recipient)"""
+    sender_key = _import_public_key(sender_pub)
+    tag = bytes(tag)
+    if isinstance(sender_key, x25519.X25519PublicKey):
+        priv_key = _load_private_key(priv_path)
+        if not isinstance(priv_key, x25519.X25519PrivateKey):
+            return False
+        key = _auth_key(priv_key.exchange(sender_key), sender_key, priv_key.public_key())
+        return hmac.compare_digest(hmac.new(key, data, 'sha256').digest(), tag)
     
-    return decrypted.decode('utf-8')
\ No newline at end of file
+    return get_backend().verify(sender_key, data, tag)
\ No newline at end of file
@@ -0,0 +1,37 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Remember message ids this long / this many, whichever runs out first.
+# Redeliveries (send retries, outbox replay, broker requeue) arrive well inside it
+DEDUP_WINDOW = 24 * 3600
+DEDUP_MAX_IDS = 100000
+
+class RecentIds:
+    """Bounded, time-windowed set of recently seen message ids"""
+    def __init__(self, window=DEDUP_WINDOW, max_ids=DEDUP_MAX_IDS):
+        self.window = window
+        self.max_ids = max_ids
+        self._ids = OrderedDict()  # id -> time last seen, oldest first
+        self._lock = threading.Lock()
+    
+    def _expire(self, now):
+        """Drop ids past the window or over capacity (caller holds the lock)"""
+        ids = self._ids
+        while ids and (len(ids) > self.max_ids or next(iter(ids.values())) < now - self.window):
+            ids.popitem(last=False)
+    
+    def __contains__(self, message_id):
+        with self._lock:
+            self._expire(time.monotonic())
+            return message_id in self._ids
+    
+    def add(self, message_id):
+        with self._lock:
+            now = time.monotonic()
+            self._ids[message_id] = now
+            self._ids.move_to_end(message_id)
+            self._expire(now)
+    
+    def __len__(self):
+        return len(self._ids)
\ No newline at end of file
@@ -0,0 +1,517 @@
+import base64
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import uuid
+from pathlib import Path
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from send_queue import SendQueueFull, SendQueueClosed, PRIORITY_BULK
+from logger import get_logger
+import metrics
+
+log = get_logger("files")
+
+# Envelope type of a file chunk (session envelopes use 0x01/0x02). Chunks
+# bypass the session: each transfer has its own key, sent in the offer
+FILE_CHUNK = 0x10
+CHUNK_HEADER = struct.Struct(">B16sQ")  # envelope type, transfer id, chunk index
+
+# Offers and acks travel as session messages starting with this prefix
+FILE_PREFIX = "[FILE] "
+
+# Plaintext bytes per chunk - one chunk is one AMQP message
+CHUNK_SIZE = 64 * 1024
+
+# Flow control: chunks in flight before the sender waits for an ack (4 MB),
+# and how often the receiver acks. No ack within ACK_TIMEOUT resends from the
+# first unacknowledged chunk; MAX_STALLS timeouts in a row fail the transfer
+WINDOW = 64
+ACK_EVERY = 16
+ACK_TIMEOUT = 30
+MAX_STALLS = 5
+
+# Incoming files are written here as <id>.part plus an <id>.json resume record
+DOWNLOAD_PATH = Path.home() / "Downloads" / "chat"
+
+MAX_FILE_SIZE = 4 * 1024 ** 3
+
+FILE_BYTES_SENT = metrics.counter("chat_file_bytes_sent_total", "File bytes encrypted and queued for sending")
+FILE_BYTES_RECEIVED = metrics.counter("chat_file_bytes_received_total", "File bytes decrypted and written to disk")
+FILE_CHUNKS_RESENT = metrics.counter("chat_file_chunks_resent_total", "File chunks sent again after a timeout or resume")
+
+def is_file_chunk(data):
+    """Check if a message body (ciphertext part) is a file chunk"""
+    return len(data) > CHUNK_HEADER.size and data[0] == FILE_CHUNK
+
+def _nonce(index):
+    """96-bit GCM nonce from the chunk index (every transfer has its own key)"""
+    return bytes(4) + struct.pack(">Q", index)
+
+def _aad(header, sender, recipient):
+    """Bind the chunk header and both usernames to the ciphertext"""
+    return bytes(header) + f"{sender}>{recipient}".encode('utf-8')
+
+def _file_sha256(path, size=None, digest=None):
+    """Hash a file (or its first size bytes) in CHUNK_SIZE reads - constant memory"""
+    digest = digest or hashlib.sha256()
+    with open(path, 'rb') as f:
+        remaining = float('inf') if size is None else size
+        while remaining > 0:
+            block = f.read(int(min(CHUNK_SIZE, remaining)))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest
+
+def _valid_offer(offer):
+    """Offers must describe a file we can receive with this client's chunk layout"""
+    try:
+        size, chunk_size, chunks = offer['size'], offer['chunk_size'], offer['chunks']
+        return (len(bytes.fromhex(offer['id'])) == 16 and
+                len(base64.b64decode(offer['key'], validate=True)) == 32 and
+                isinstance(offer['name'], str) and len(offer['sha256']) == 64 and
+                0 <= size <= MAX_FILE_SIZE and chunk_size == CHUNK_SIZE and
+                chunks == (size + CHUNK_SIZE - 1) // CHUNK_SIZE)
+    except (KeyError, TypeError, ValueError):
+        return False
+
+def format_size(size):
+    """Human readable byte count"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+def describe(event):
+    """One line for the conversation, or None for progress events"""
+    name, state = event['name'], event['state']
+    if state == 'offered':
+        if event['direction'] == 'out':
+            return f"📎 Offering {name} ({format_size(event['size'])})"
+        return f"📎 {event['peer']} offers {name} ({format_size(event['size'])})"
+    if state == 'accepted':
+        verb = "Sending" if event['direction'] == 'out' else "Receiving"
+        return f"📎 {verb} {name} ({format_size(event['size'])})"
+    if state == 'declined':
+        return f"✗ {name} was declined" if event['direction'] == 'out' else f"✗ Declined {name}"
+    if state == 'done':
+        return f"✓ {name} delivered" if event['direction'] == 'out' else f"✓ Saved {name} to {event['path']}"
+    if state == 'failed':
+        return f"⚠️ Transfer of {name} failed"
+    return None
+
+def _unique_path(directory, name):
+    """directory/name, or 'name (1)', 'name (2)'... if it exists"""
+    path = directory / name
+    stem, suffix = path.stem, path.suffix
+    n = 1
+    while path.exists():
+        path = directory / f"{stem} ({n}){suffix}"
+        n += 1
+    return path
+
+class _OutgoingFile:
+    """A file we are sending - go-back-N state guarded by cond"""
+    def __init__(self, peer, path):
+        self.id = uuid.uuid4().bytes
+        self.peer = peer
+        self.path = Path(path)
+        self.size = self.path.stat().st_size
+        self.chunks = (self.size + CHUNK_SIZE - 1) // CHUNK_SIZE
+        self.key = AESGCM.generate_key(bit_length=256)
+        self.aead = AESGCM(self.key)
+        self.sha256 = None  # Hashed on the offer thread
+        self.next = 0   # Next chunk to send
+        self.acked = 0  # Chunks the receiver has written
+        self.running = False
+        self.cond = threading.Condition()
+    
+    def offer(self):
+        return {
+            'op': 'offer',
+            'id': self.id.hex(),
+            'name': self.path.name,
+            'size': self.size,
+            'chunk_size': CHUNK_SIZE,
+            'chunks': self.chunks,
+            'key': base64.b64encode(self.key).decode('ascii'),
+            'sha256': self.sha256
+        }
+
+class _IncomingFile:
+    """A file we are receiving - chunks are written and hashed in order, so memory stays constant"""
+    def __init__(self, sender, offer, directory, received=0):
+        self.id = bytes.fromhex(offer['id'])
+        self.sender = sender
+        self.offer = offer
+        self.name = Path(offer['name']).name or "file"  # No directories from the peer
+        self.size = offer['size']
+        self.chunk_size = offer['chunk_size']
+        self.chunks = offer['chunks']
+        self.aead = AESGCM(base64.b64decode(offer['key']))
+        self.part_path = directory / f"{offer['id']}.part"
+        self.state_path = directory / f"{offer['id']}.json"
+        self.next = received  # Chunks written so far
+        self.nacked = False   # Asked the sender to go back since the last chunk
+        self.lock = threading.Lock()
+        self.digest = hashlib.sha256()  # Of the chunks written so far
+        self.file = None
+    
+    def open(self):
+        """Open the .part file; a resumed download re-hashes what it already has"""
+        if self.part_path.exists():
+            self.file = open(self.part_path, 'r+b')
+            _file_sha256(self.part_path, min(self.next * self.chunk_size, self.size), self.digest)
+        else:
+            self.file = open(self.part_path, 'w+b')
+    
+    def save_state(self):
+        """Write the resume record (offer + chunks received)"""
+        record = {'sender': self.sender, 'offer': self.offer, 'received': self.next}
+        tmp = self.state_path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(record))
+        os.replace(tmp, self.state_path)
+
+class FileTransfers:
+    """
+    Streaming, end-to-end encrypted file transfer for one ChatClient
+    The offer (name, size, sha256 and a fresh AES-256 key) goes through the
+    peer's session. Nothing is written until the receiver accept()s it; the
+    file then follows as AES-GCM chunks read through mmap and queued at bulk
+    priority, with at most WINDOW chunks unacknowledged. The receiver writes
+    chunks straight to disk and keeps a resume record, so an interrupted
+    transfer continues from the last acked chunk.
+    on_event(event) gets dicts with id, direction ('out'/'in'), peer, name,
+    size, bytes, state ('offered', 'accepted', 'declined', 'progress',
+    'done', 'failed') and path. An incoming 'offered' waits for accept(id)
+    or decline(id).
+    """
+    def __init__(self, username, transport, send_control, download_dir=None):
+        self.username = username
+        self.transport = transport
+        self.send_control = send_control  # (peer, text) -> send through the session
+        self.download_dir = Path(download_dir or DOWNLOAD_PATH)
+        self._outgoing = {}  # transfer id -> _OutgoingFile
+        self._incoming = {}  # transfer id -> _IncomingFile
+        self._offers = {}    # transfer id -> _IncomingFile waiting for accept/decline
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()  # Set by close()
+        self.on_event = None
+    
+    def _notify(self, transfer, direction, state, done_bytes, path=None):
+        if not self.on_event:
+            return
+        peer = transfer.peer if direction == 'out' else transfer.sender
+        name = transfer.path.name if direction == 'out' else transfer.name
+        try:
+            self.on_event({
+                'id': transfer.id.hex(), 'direction': direction, 'peer': peer,
+                'name': name, 'size': transfer.size, 'bytes': min(done_bytes, transfer.size),
+                'state': state, 'path': str(path) if path else None
+            })
+        except Exception:
+            log.exception("File event callback failed")
+    
+    def _send_json(self, peer, message):
+        self.send_control(peer, FILE_PREFIX + json.dumps(message, separators=(',', ':')))
+    
+    # Sending
+    
+    def send_file(self, peer, path):
+        """Hash and offer a file to peer from a background thread, return the transfer id"""
+        transfer = _OutgoingFile(peer, path)
+        with self._lock:
+            self._outgoing[transfer.id] = transfer
+        threading.Thread(target=self._offer, args=(transfer,), daemon=True).start()
+        return transfer.id.hex()
+    
+    def _offer(self, transfer):
+        """Send the offer - chunks go out once the receiver accepts it (first ack)"""
+        try:
+            transfer.sha256 = _file_sha256(transfer.path).hexdigest()
+            self._send_json(transfer.peer, transfer.offer())
+        except Exception:
+            log.exception("Offering %s to %s failed", transfer.path.name, transfer.peer)
+            with self._lock:
+                self._outgoing.pop(transfer.id, None)
+            self._notify(transfer, 'out', 'failed', 0)
+            return
+        log.info("Offered %s (%d bytes, %d chunks) to %s", transfer.path.name, transfer.size, transfer.chunks, transfer.peer)
+        self._notify(transfer, 'out', 'offered', 0)
+    
+    def _start_sender(self, transfer):
+        with transfer.cond:
+            if transfer.running:
+                return
+            transfer.running = True
+        threading.Thread(target=self._run_sender, args=(transfer,), daemon=True).start()
+    
+    def _run_sender(self, transfer):
+        """Send chunks, keeping at most WINDOW of them unacknowledged"""
+        state = 'failed'
+        try:
+            with open(transfer.path, 'rb') as f:
+                # mmap slices copy one chunk at a time - the file is never read whole
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if transfer.size else b''
+                try:
+                    state = self._send_chunks(transfer, data)
+                finally:
+                    if transfer.size:
+                        data.close()
+        except Exception:
+            log.exception("Sending %s to %s failed", transfer.path.name, transfer.peer)
+        finally:
+            with transfer.cond:
+                transfer.running = False
+            if state == 'done':
+                with self._lock:
+                    self._outgoing.pop(transfer.id, None)
+            self._notify(transfer, 'out', state, transfer.acked * CHUNK_SIZE)
+    
+    def _send_chunks(self, transfer, data):
+        """Go-back-N loop - returns 'done' or 'failed'"""
+        stalls = 0
+        while True:
+            with transfer.cond:
+                if transfer.acked >= transfer.chunks:
+                    return 'done'
+                if self._stopping.is_set():
+                    return 'failed'
+                if transfer.next >= transfer.chunks or transfer.next - transfer.acked >= WINDOW:
+                    acked = transfer.acked
+                    if not transfer.cond.wait(ACK_TIMEOUT) and transfer.acked == acked:
+                        stalls += 1
+                        if stalls > MAX_STALLS:
+                            return 'failed'
+                        # Chunks (or the acks) were lost - resend from the gap
+                        log.warning("No ack from %s for %s, resending from chunk %d",
+                                    transfer.peer, transfer.path.name, transfer.acked)
+                        FILE_CHUNKS_RESENT.inc(transfer.next - transfer.acked)
+                        transfer.next = transfer.acked
+                    elif transfer.acked > acked:
+                        stalls = 0
+                    continue
+                index = transfer.next
+                transfer.next += 1
+            
+            header = CHUNK_HEADER.pack(FILE_CHUNK, transfer.id, index)
+            plain = data[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE]
+            chunk = header + transfer.aead.encrypt(_nonce(index), plain, _aad(header, self.username, transfer.peer))
+            try:
+                # Bounded bulk class: blocks while the queue is full, chat goes first
+                self.transport.send_message(transfer.peer, chunk, PRIORITY_BULK)
+            except SendQueueFull:
+                with transfer.cond:
+                    transfer.next = min(transfer.next, index)  # Retry this chunk
+                continue
+            except SendQueueClosed:
+                return 'failed'
+            FILE_BYTES_SENT.inc(len(plain))
+    
+    def _handle_ack(self, sender, message):
+        """Receiver progress - slide the window, or go back on a resume request"""
+        with self._lock:
+            transfer = self._outgoing.get(bytes.fromhex(message['id']))
+        if transfer is None or transfer.peer != sender:
+            log.debug("Ack for unknown transfer from %s", sender)
+            return
+        
+        received = min(int(message['next']), transfer.chunks)
+        with transfer.cond:
+            if received > transfer.acked:
+                transfer.acked = received
+            if message.get('resume') and received < transfer.next:
+                FILE_CHUNKS_RESENT.inc(transfer.next - received)
+                transfer.next = transfer.acked
+            transfer.cond.notify_all()
+        
+        if message.get('resume'):
+            if not received and not transfer.running and not transfer.next:
+                self._notify(transfer, 'out', 'accepted', 0)
+            self._start_sender(transfer)  # Accepted, or restart a transfer that had given up
+        elif received < transfer.chunks:
+            self._notify(transfer, 'out', 'progress', received * CHUNK_SIZE)
+    
+    # Receiving
+    
+    def handle_control(self, sender, text):
+        """Offer or ack (session message text after FILE_PREFIX)"""
+        message = json.loads(text)
+        op = message.get('op')
+        if op == 'offer':
+            self._handle_offer(sender, message)
+        elif op == 'ack':
+            self._handle_ack(sender, message)
+        elif op == 'decline':
+            self._handle_decline(sender, message)
+        else:
+            log.warning("Unknown file message %r from %s", op, sender)
+    
+    def _handle_offer(self, sender, offer):
+        """Validate an offer and hold it until the user accepts or declines it"""
+        if not _valid_offer(offer):
+            log.warning("Refused malformed file offer %r from %s", offer.get('name'), sender)
+            return
+        incoming = _IncomingFile(sender, offer, self.download_dir)
+        with self._lock:
+            if incoming.id in self._incoming or incoming.id in self._offers:
+                return  # Redelivered offer
+            self._offers[incoming.id] = incoming
+        
+        log.info("%s offers %s (%d bytes)", sender, incoming.name, incoming.size)
+        self._notify(incoming, 'in', 'offered', 0)
+    
+    def accept(self, transfer_id):
+        """Start receiving an offered file - the ack asks the sender to stream it"""
+        with self._lock:
+            incoming = self._offers.pop(bytes.fromhex(transfer_id), None)
+        if incoming is None:
+            return False
+        
+        self.download_dir.mkdir(parents=True, exist_ok=True)
+        incoming.open()
+        incoming.file.truncate(incoming.size)
+        incoming.save_state()
+        with self._lock:
+            self._incoming[incoming.id] = incoming
+        
+        log.info("Receiving %s (%d bytes) from %s", incoming.name, incoming.size, incoming.sender)
+        self._notify(incoming, 'in', 'accepted', 0)
+        self._send_ack(incoming, resume=True)
+        if incoming.chunks == 0:
+            with incoming.lock:
+                self._finish(incoming)
+        return True
+    
+    def decline(self, transfer_id):
+        """Refuse an offered file and tell the sender"""
+        with self._lock:
+            incoming = self._offers.pop(bytes.fromhex(transfer_id), None)
+        if incoming is None:
+            return False
+        try:
+            self._send_json(incoming.sender, {'op': 'decline', 'id': incoming.offer['id']})
+        except Exception as e:
+            log.warning("File decline to %s failed: %s", incoming.sender, e)
+        self._notify(incoming, 'in', 'declined', 0)
+        return True
+    
+    def _handle_decline(self, sender, message):
+        with self._lock:
+            transfer = self._outgoing.get(bytes.fromhex(message['id']))
+            if transfer is None or transfer.peer != sender:
+                return
+            del self._outgoing[transfer.id]
+        log.info("%s declined %s", sender, transfer.path.name)
+        self._notify(transfer, 'out', 'declined', 0)
+    
+    def handle_chunk(self, sender, data):
+        """Decrypt one chunk and write it in place - only the next expected chunk is accepted"""
+        _, transfer_id, index = CHUNK_HEADER.unpack_from(data)
+        with self._lock:
+            incoming = self._incoming.get(transfer_id)
+        if incoming is None or incoming.sender != sender:
+            log.debug("Chunk for unknown transfer from %s", sender)
+            return
+        
+        with incoming.lock:
+            if index != incoming.next:
+                # Gap: a chunk was lost, ask once to go back to it. Earlier
+                # indexes are duplicates from a go-back and need nothing
+                if index > incoming.next and not incoming.nacked:
+                    incoming.nacked = True
+                    self._send_ack(incoming, resume=True)
+                return
+            
+            header = data[:CHUNK_HEADER.size]
+            plain = incoming.aead.decrypt(_nonce(index), data[CHUNK_HEADER.size:],
+                                          _aad(header, sender, self.username))
+            incoming.file.seek(index * incoming.chunk_size)
+            incoming.file.write(plain)
+            incoming.digest.update(plain)
+            incoming.next += 1
+            incoming.nacked = False
+            FILE_BYTES_RECEIVED.inc(len(plain))
+            
+            if incoming.next == incoming.chunks:
+                self._finish(incoming)
+            elif incoming.next % ACK_EVERY == 0:
+                incoming.file.flush()
+                incoming.save_state()
+                self._send_ack(incoming)
+                self._notify(incoming, 'in', 'progress', incoming.next * incoming.chunk_size)
+    
+    def _send_ack(self, incoming, resume=False):
+        try:
+            self._send_json(incoming.sender, {'op': 'ack', 'id': incoming.offer['id'],
+                                              'next': incoming.next, 'resume': resume})
+        except Exception as e:
+            log.warning("File ack to %s failed: %s", incoming.sender, e)
+    
+    def _finish(self, incoming):
+        """Check the hash of what was written, move the file into place and send the final ack (caller holds incoming.lock)"""
+        incoming.file.close()
+        with self._lock:
+            self._incoming.pop(incoming.id, None)
+        
+        if incoming.digest.hexdigest() != incoming.offer['sha256']:
+            log.error("Checksum mismatch for %s from %s", incoming.name, incoming.sender)
+            incoming.part_path.unlink()
+            incoming.state_path.unlink()
+            self._notify(incoming, 'in', 'failed', incoming.size)
+            return
+        
+        path = _unique_path(self.download_dir, incoming.name)
+        os.replace(incoming.part_path, path)
+        incoming.state_path.unlink()
+        self._send_ack(incoming)
+        log.info("Received %s from %s", path, incoming.sender)
+        self._notify(incoming, 'in', 'done', incoming.size, path)
+    
+    def resume_incoming(self):
+        """Reopen unfinished downloads and ask their senders to continue"""
+        if not self.download_dir.is_dir():
+            return 0
+        
+        resumed = 0
+        for state_path in self.download_dir.glob("*.json"):
+            try:
+                record = json.loads(state_path.read_text())
+                incoming = _IncomingFile(record['sender'], record['offer'], self.download_dir, record['received'])
+                incoming.open()
+            except Exception as e:
+                log.warning("Skipping resume record %s: %s", state_path.name, e)
+                continue
+            with self._lock:
+                if incoming.id in self._incoming:
+                    incoming.file.close()
+                    continue
+                self._incoming[incoming.id] = incoming
+            self._send_ack(incoming, resume=True)
+            resumed += 1
+        return resumed
+    
+    def close(self):
+        """Stop sending - unfinished downloads keep their resume records"""
+        self._stopping.set()
+        with self._lock:
+            outgoing = list(self._outgoing.values())
+        for transfer in outgoing:
+            with transfer.cond:
+                transfer.cond.notify_all()
+        with self._lock:
+            incoming, self._incoming = list(self._incoming.values()), {}
+            self._offers.clear()
+        for transfer in incoming:
+            with transfer.lock:
+                transfer.file.close()
+    
+    def pending(self):
+        """Transfer ids still in progress, (outgoing, incoming)"""
+        with self._lock:
+            return [t.hex() for t in self._outgoing], [t.hex() for t in self._incoming]
\ No newline at end of file
@@ -0,0 +1,45 @@
+import bisect
+import hashlib
+
+# Virtual points per node - smooths the share of keys each node owns
+RING_REPLICAS = 100
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+class HashRing:
+    """
+    Consistent hash ring mapping keys (usernames) to nodes
+    Adding or removing a node only moves the keys that node owns.
+    """
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        self.nodes = list(dict.fromkeys(nodes))
+        if not self.nodes:
+            raise ValueError("HashRing needs at least one node")
+        
+        points = sorted(
+            (_hash(f"{node}#{i}"), node)
+            for node in self.nodes
+            for i in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+    
+    def node_for(self, key):
+        """Node owning key"""
+        return self.nodes_for(key)[0]
+    
+    def nodes_for(self, key):
+        """Every node in failover order for key - owner first"""
+        if len(self.nodes) == 1:
+            return list(self.nodes)
+        
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        ordered = []
+        for offset in range(len(self._owners)):
+            node = self._owners[(index + offset) % len(self._owners)]
+            if node not in ordered:
+                ordered.append(node)
+                if len(ordered) == len(self.nodes):
+                    break
+        return ordered
\ No newline at end of file
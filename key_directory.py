@@ -0,0 +1,371 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import pki_manager
+from keystore import KeyStore
+from rabbitmq_manager import pika, open_first, RABBITMQ_NODES, _close_quietly, ConnectionSupervisor, TransportClosed
+from logger import get_logger
+import metrics
+
+log = get_logger("keys")
+
+# RPC queue served by the key directory (next to the keystore on the PKI share)
+KEY_DIRECTORY_QUEUE = "chat_key_directory"
+DIRECTORY_TIMEOUT = 5
+
+# Client cache: certificates younger than KEY_CACHE_TTL are used without
+# asking; older ones are revalidated by ETag. Unknown users are remembered
+# for MISSING_TTL, the user list for USERS_TTL. After a failed request the
+# directory is not asked again for DIRECTORY_RETRY seconds - lookups are
+# answered from the cache instead of each waiting DIRECTORY_TIMEOUT
+KEY_CACHE_TTL = 300
+MISSING_TTL = 5
+USERS_TTL = 30
+DIRECTORY_RETRY = 30
+
+# Local, per-machine cache file (next to the outbox)
+KEY_CACHE_FILE = Path.home() / ".chat" / "key_cache.json"
+
+# Requests a directory worker takes at once
+DIRECTORY_PREFETCH = 64
+
+DIRECTORY_REQUESTS = metrics.counter("chat_key_directory_requests_total", "Requests answered by the key directory")
+KEY_CACHE_HITS = metrics.counter("chat_key_cache_hits_total", "Certificate lookups answered from the local cache")
+KEY_CACHE_MISSES = metrics.counter("chat_key_cache_misses_total", "Certificate lookups that needed the key directory")
+KEY_LOOKUP_SECONDS = metrics.histogram("chat_key_lookup_seconds", "Round trip of one key directory request")
+
+def certificate_etag(cert_der):
+    """Version of a certificate - changes whenever it is re-issued"""
+    return hashlib.sha256(bytes(cert_der)).hexdigest()[:32]
+
+def _b64(data):
+    return base64.b64encode(bytes(data)).decode('ascii')
+
+class KeyDirectoryService:
+    """
+    Key directory daemon - serves the keystore over RabbitMQ RPC
+    Requests are JSON on KEY_DIRECTORY_QUEUE, answered on reply_to:
+      {"users": [...], "known": {user: etag}}  -> {"certs": {user: {etag, pub, cert}},
+                                                   "unchanged": [...], "missing": [...]}
+      {"list": true}                           -> {"users": [...]}
+      {"ca": true}                             -> {"ca": PEM}
+    Run it on a host with the PKI share; clients then need no mount at all.
+    """
+    def __init__(self, nodes=None):
+        self.nodes = nodes or RABBITMQ_NODES
+        self.keystore = KeyStore(pki_manager.PKI_PATH / "keystore.db")
+        self._stopping = threading.Event()
+    
+    def handle(self, request):
+        """Answer one decoded request"""
+        DIRECTORY_REQUESTS.inc()
+        if request.get('ca'):
+            return {'ca': (pki_manager.PKI_PATH / "ca.crt").read_text()}
+        if request.get('list'):
+            return {'users': sorted(self.keystore.users())}
+        
+        known = request.get('known') or {}
+        reply = {'certs': {}, 'unchanged': [], 'missing': []}
+        for username in request.get('users', ()):
+            entry = self.keystore.get(username)
+            if entry is None:
+                reply['missing'].append(username)
+                continue
+            _, pub_der, cert_der = entry
+            etag = certificate_etag(cert_der)
+            if known.get(username) == etag:
+                reply['unchanged'].append(username)
+            else:
+                reply['certs'][username] = {'etag': etag, 'pub': _b64(pub_der), 'cert': _b64(cert_der)}
+        return reply
+    
+    def run(self):
+        """Serve requests until stop(), reconnecting (in node order) after a broker failure"""
+        def on_request(ch, method, properties, body):
+            try:
+                reply = self.handle(json.loads(body))
+            except Exception as e:
+                log.warning("Bad key directory request: %s", e)
+                reply = {'error': str(e)}
+            if properties.reply_to:
+                ch.basic_publish(
+                    exchange='',
+                    routing_key=properties.reply_to,
+                    body=json.dumps(reply),
+                    properties=pika.BasicProperties(correlation_id=properties.correlation_id)
+                )
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+        
+        def setup(channel):
+            channel.queue_declare(queue=KEY_DIRECTORY_QUEUE)
+            channel.basic_qos(prefetch_count=DIRECTORY_PREFETCH)
+            channel.basic_consume(queue=KEY_DIRECTORY_QUEUE, on_message_callback=on_request)
+            log.info("Key directory serving %s from %s", KEY_DIRECTORY_QUEUE, self.keystore.path)
+        
+        supervisor = ConnectionSupervisor("key directory", lambda: open_first(self.nodes), setup, self._stopping)
+        try:
+            while not self._stopping.is_set():
+                try:
+                    supervisor.get_channel()
+                    supervisor.conn.process_data_events(time_limit=1)
+                except TransportClosed:
+                    break
+                except Exception as e:
+                    if self._stopping.is_set():
+                        break
+                    supervisor.mark_lost(e)
+        finally:
+            supervisor.close()
+    
+    def stop(self):
+        self._stopping.set()
+
+class _Entry:
+    """Cached certificate (or known absence) and when it was last validated"""
+    __slots__ = ('etag', 'pub_der', 'cert_der', 'checked')
+    
+    def __init__(self, etag, pub_der, cert_der, checked):
+        self.etag = etag
+        self.pub_der = pub_der
+        self.cert_der = cert_der
+        self.checked = checked
+
+class KeyDirectory:
+    """
+    Client of the key directory service with a local, validating cache
+    Same lookup interface as KeyStore (get, users, refresh), so PKIManager
+    uses either. Fresh entries are a dict lookup; stale ones are revalidated
+    in one batched request carrying their ETags, so an unchanged certificate
+    is not sent again. The cache file survives restarts; its entries start
+    out stale. If the directory is unreachable, stale entries are served
+    and it is not asked again for DIRECTORY_RETRY seconds.
+    """
+    def __init__(self, cache_path=None, nodes=None, ttl=KEY_CACHE_TTL):
+        self.path = Path(cache_path) if cache_path else None
+        self.nodes = nodes or RABBITMQ_NODES
+        self.ttl = ttl
+        self._entries = {}  # username -> _Entry (pub_der None: no such user)
+        self._users = None
+        self._users_checked = 0
+        self._ca_pem = None
+        self._lock = threading.Lock()      # Cache
+        self._rpc_lock = threading.Lock()  # Connection - pika is not thread safe
+        self._connection = None
+        self._channel = None
+        self._reply_queue = None
+        self._replies = {}
+        self._retry_at = 0  # monotonic time before which the directory is considered down
+        self._load()
+    
+    # Cache file
+    
+    def _load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            data = json.loads(self.path.read_text())
+            for username, (etag, pub, cert) in data.get('certs', {}).items():
+                self._entries[username] = _Entry(etag, base64.b64decode(pub), base64.b64decode(cert), 0)
+            self._ca_pem = data.get('ca')
+        except Exception as e:
+            log.warning("Ignoring key cache %s: %s", self.path, e)
+    
+    def _save(self):
+        """Write the cache file (caller holds the cache lock)"""
+        if self.path is None:
+            return
+        data = {
+            'ca': self._ca_pem,
+            'certs': {
+                username: [entry.etag, _b64(entry.pub_der), _b64(entry.cert_der)]
+                for username, entry in self._entries.items() if entry.pub_der is not None
+            }
+        }
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix('.tmp')
+            tmp.write_text(json.dumps(data))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.warning("Cannot write key cache %s: %s", self.path, e)
+    
+    # RPC
+    
+    def _connect(self):
+        """Open the RPC connection and reply queue (caller holds the RPC lock)"""
+        self._connection = open_first(self.nodes)
+        self._channel = self._connection.channel()
+        self._reply_queue = self._channel.queue_declare(queue='', exclusive=True).method.queue
+        
+        def on_reply(ch, method, properties, body):
+            if properties.correlation_id in self._replies:
+                self._replies[properties.correlation_id] = json.loads(body)
+        self._channel.basic_consume(queue=self._reply_queue, on_message_callback=on_reply, auto_ack=True)
+    
+    def _call(self, request):
+        """One request/reply round trip - reconnects once if the connection went away"""
+        with self._rpc_lock, KEY_LOOKUP_SECONDS.time():
+            if time.monotonic() < self._retry_at:
+                raise ConnectionError("Key directory unavailable (backing off)")
+            try:
+                return self._call_once(request)
+            except Exception as e:
+                self._retry_at = time.monotonic() + DIRECTORY_RETRY
+                log.warning("Key directory unavailable, using cached keys for %ds: %s", DIRECTORY_RETRY, e)
+                raise
+    
+    def _call_once(self, request):
+        for attempt in range(2):
+            try:
+                if self._connection is None or self._connection.is_closed:
+                    self._connect()
+                return self._round_trip(request)
+            except TimeoutError:
+                raise
+            except Exception as e:
+                _close_quietly(self._connection)
+                self._connection = None
+                if attempt:
+                    raise
+                log.warning("Key directory connection lost, reconnecting: %s", e)
+    
+    def _round_trip(self, request):
+        correlation_id = uuid.uuid4().hex
+        self._replies[correlation_id] = None
+        try:
+            self._channel.basic_publish(
+                exchange='',
+                routing_key=KEY_DIRECTORY_QUEUE,
+                body=json.dumps(request),
+                properties=pika.BasicProperties(
+                    reply_to=self._reply_queue,
+                    correlation_id=correlation_id,
+                    expiration=str(DIRECTORY_TIMEOUT * 1000)
+                )
+            )
+            deadline = time.monotonic() + DIRECTORY_TIMEOUT
+            while self._replies[correlation_id] is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("No reply from the key directory - is key_directory.py running?")
+                self._connection.process_data_events(time_limit=remaining)
+            reply = self._replies[correlation_id]
+        finally:
+            self._replies.pop(correlation_id, None)
+        
+        if 'error' in reply:
+            raise ValueError(f"Key directory error: {reply['error']}")
+        return reply
+    
+    # Lookups
+    
+    def _fresh(self, entry, now):
+        ttl = self.ttl if entry.pub_der is not None else MISSING_TTL
+        return now - entry.checked < ttl
+    
+    def get_many(self, usernames):
+        """
+        {username: (etag, public key DER, certificate DER)} for the users that
+        exist - everything not fresh in the cache is fetched in one request
+        """
+        now = time.monotonic()
+        with self._lock:
+            stale = [u for u in dict.fromkeys(usernames)
+                     if u not in self._entries or not self._fresh(self._entries[u], now)]
+            known = {u: self._entries[u].etag for u in stale
+                     if u in self._entries and self._entries[u].pub_der is not None}
+        
+        if stale:
+            KEY_CACHE_MISSES.inc(len(stale))
+            try:
+                reply = self._call({'users': stale, 'known': known})
+            except Exception as e:
+                # Keep working on what we have - certificates are still CA-verified
+                log.debug("Key directory lookup failed: %s", e)
+                reply = None
+            
+            if reply is not None:
+                now = time.monotonic()
+                with self._lock:
+                    for username, cert in reply['certs'].items():
+                        self._entries[username] = _Entry(
+                            cert['etag'], base64.b64decode(cert['pub']), base64.b64decode(cert['cert']), now
+                        )
+                    for username in reply['unchanged']:
+                        if username in self._entries:
+                            self._entries[username].checked = now
+                    for username in reply['missing']:
+                        self._entries[username] = _Entry(None, None, None, now)
+                    if reply['certs'] or reply['missing']:
+                        self._save()
+        
+        KEY_CACHE_HITS.inc(len(usernames) - len(stale))
+        with self._lock:
+            result = {}
+            for username in usernames:
+                entry = self._entries.get(username)
+                if entry is not None and entry.pub_der is not None:
+                    result[username] = (entry.etag, entry.pub_der, entry.cert_der)
+            return result
+    
+    def get(self, username):
+        """(etag, public key DER, certificate DER) for username, or None - KeyStore.get interface"""
+        entry = self._entries.get(username)
+        if entry is not None and self._fresh(entry, time.monotonic()):
+            KEY_CACHE_HITS.inc()
+            if entry.pub_der is None:
+                return None
+            return entry.etag, entry.pub_der, entry.cert_der
+        return self.get_many([username]).get(username)
+    
+    def users(self):
+        """Every registered username (cached for USERS_TTL)"""
+        now = time.monotonic()
+        if self._users is None or now - self._users_checked >= USERS_TTL:
+            try:
+                self._users = set(self._call({'list': True})['users'])
+                self._users_checked = now
+            except Exception as e:
+                if self._users is None:
+                    raise
+                log.debug("Key directory unavailable, using cached user list: %s", e)
+        return set(self._users)
+    
+    def ca_certificate(self, force=False):
+        """CA certificate PEM as the directory gave it (kept in the cache file) - PKIManager checks it"""
+        if self._ca_pem is None or force:
+            pem = self._call({'ca': True})['ca']
+            with self._lock:
+                self._ca_pem = pem
+                self._save()
+        return self._ca_pem.encode('ascii')
+    
+    def refresh(self, force=False):
+        """Mark everything stale (force) so the next lookup revalidates"""
+        if not force:
+            return
+        with self._lock:
+            for entry in self._entries.values():
+                entry.checked = 0
+            self._users = None
+    
+    def close(self):
+        with self._rpc_lock:
+            _close_quietly(self._connection)
+            self._connection = None
+
+def main():
+    metrics.start_exporter()
+    try:
+        KeyDirectoryService().run()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,233 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from logger import get_logger
+
+log = get_logger("keystore")
+
+MAGIC = b"CKS1"
+# Record: magic | header | username | public key | certificate | CRC32 of
+# header through certificate. The magic lets a reader resync after a torn
+# or interleaved append; records from before it (no magic, no CRC) are only
+# read at the start of the file
+RECORD_MAGIC = b"\xa5KR2"
+# Record header: username length, public key length, certificate length
+RECORD_HEADER = struct.Struct(">HII")
+RECORD_CRC = struct.Struct(">I")
+MAX_RECORD_SIZE = 1 << 16  # Larger lengths are corruption, not a record still being written
+
+@contextmanager
+def _write_lock(path):
+    """Exclusive lock on path + ".lock" - one writer at a time, also across SMB clients"""
+    with open(f"{path}.lock", 'a+b') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)  # Retries for ~10s, then raises
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(f, fcntl.LOCK_UN)
+
+class KeyStore:
+    """
+    Single append-only file holding every user's DER public key and certificate
+    Readers mmap the file and keep an in-memory offset index, so a lookup
+    is a dict access - no per-user file opens on the shared PKI directory
+    """
+    def __init__(self, path, refresh_interval=1.0):
+        self.path = str(path)
+        self._index = {}  # username -> (record offset, pub offset, pub length, cert length)
+        self._file = None
+        self._map = None
+        self._scanned = 0
+        self._legacy = True  # Still in the records written before RECORD_MAGIC
+        self._lock = threading.Lock()
+        self._refresh_interval = refresh_interval
+        self._last_refresh = 0
+    
+    def exists(self):
+        """Check if the keystore file has been created"""
+        return os.path.exists(self.path)
+    
+    def append(self, username, pub_der, cert_der):
+        """Append (or replace) a user's public key and certificate"""
+        self.append_many([(username, pub_der, cert_der)])
+    
+    def append_many(self, entries):
+        """Append (username, public key DER, certificate DER) entries with one write and fsync"""
+        records = []
+        for username, pub_der, cert_der in entries:
+            name = username.encode('utf-8')
+            body = RECORD_HEADER.pack(len(name), len(pub_der), len(cert_der)) + name + bytes(pub_der) + bytes(cert_der)
+            records.append(RECORD_MAGIC + body + RECORD_CRC.pack(zlib.crc32(body)))
+        if not records:
+            return
+        
+        # O_APPEND alone is not atomic between clients on the SMB share
+        with _write_lock(self.path):
+            if not self.exists():
+                with open(self.path, 'xb') as f:
+                    f.write(MAGIC)
+            
+            with open(self.path, 'ab') as f:
+                f.write(b''.join(records))
+                f.flush()
+                os.fsync(f.fileno())
+        
+        self.refresh(force=True)
+    
+    def refresh(self, force=False):
+        """Map records appended since the last scan (throttled unless forced)"""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_refresh < self._refresh_interval:
+                return
+            self._last_refresh = now
+            
+            if self._file is None:
+                if not self.exists():
+                    return
+                self._file = open(self.path, 'rb')
+            
+            size = os.fstat(self._file.fileno()).st_size
+            if self._map is not None and size <= len(self._map):
+                return
+            if size <= len(MAGIC):
+                return
+            
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+            
+            if self._map[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{self.path} is not a chat keystore")
+            
+            self._scan()
+    
+    def _scan(self):
+        """Index new records - a later record for the same user replaces the earlier one"""
+        pos = max(self._scanned, len(MAGIC))
+        size = len(self._map)
+        
+        while pos + len(RECORD_MAGIC) + RECORD_HEADER.size <= size:
+            if self._map[pos:pos + len(RECORD_MAGIC)] == RECORD_MAGIC:
+                end = self._check_record(pos, size)
+                if end:
+                    self._legacy = False
+                    self._index_record(pos, pos + len(RECORD_MAGIC), size)
+                    pos = end
+                    continue
+                if end is None and self._next_record(pos + 1, size) is None:
+                    break  # Record still being written
+                # Writers append whole records one at a time, so a valid
+                # record after this one means this one was torn
+            elif self._legacy and self._map[pos] == 0:
+                # Record from before RECORD_MAGIC (username length < 256)
+                end = self._index_record(pos, pos, size)
+                if end is None:
+                    break
+                pos = end
+                continue
+            
+            next_pos = self._next_record(pos + 1, size)
+            if next_pos is None:
+                break
+            log.warning("Skipping %d damaged bytes at offset %d of %s", next_pos - pos, pos, self.path)
+            pos = next_pos
+        
+        self._scanned = pos
+    
+    def _check_record(self, pos, size):
+        """End of the checksummed record at pos, 0 if it is damaged, None if it runs past size"""
+        name_len, pub_len, cert_len = RECORD_HEADER.unpack_from(self._map, pos + len(RECORD_MAGIC))
+        body_end = pos + len(RECORD_MAGIC) + RECORD_HEADER.size + name_len + pub_len + cert_len
+        if body_end - pos > MAX_RECORD_SIZE:
+            return 0
+        if body_end + RECORD_CRC.size > size:
+            return None
+        (crc,) = RECORD_CRC.unpack_from(self._map, body_end)
+        if crc != zlib.crc32(self._map[pos + len(RECORD_MAGIC):body_end]):
+            return 0
+        return body_end + RECORD_CRC.size
+    
+    def _next_record(self, start, size):
+        """Offset of the first complete, valid record at or after start, or None"""
+        pos = self._map.find(RECORD_MAGIC, start)
+        while pos >= 0 and pos + len(RECORD_MAGIC) + RECORD_HEADER.size <= size:
+            if self._check_record(pos, size):
+                return pos
+            pos = self._map.find(RECORD_MAGIC, pos + 1)
+        return None
+    
+    def _index_record(self, pos, header_pos, size):
+        """Index the record whose header starts at header_pos, return its end (None if incomplete)"""
+        name_len, pub_len, cert_len = RECORD_HEADER.unpack_from(self._map, header_pos)
+        name_start = header_pos + RECORD_HEADER.size
+        end = name_start + name_len + pub_len + cert_len
+        if end > size:
+            return None  # Record still being written
+        
+        username = self._map[name_start:name_start + name_len].decode('utf-8', errors='replace')
+        self._index[username] = (pos, name_start + name_len, pub_len, cert_len)
+        return end
+    
+    def get(self, username):
+        """
+        Get (record offset, public key DER, certificate DER) for username, or None
+        The record offset changes whenever the user's certificate is re-issued
+        """
+        self.refresh()
+        entry = self._index.get(username)
+        if entry is None:
+            # Maybe registered since our last refresh
+            self.refresh(force=True)
+            entry = self._index.get(username)
+            if entry is None:
+                return None
+        
+        offset, pub_start, pub_len, cert_len = entry
+        with self._lock:
+            pub_der = self._map[pub_start:pub_start + pub_len]
+            cert_der = self._map[pub_start + pub_len:pub_start + pub_len + cert_len]
+        return offset, pub_der, cert_der
+    
+    def get_many(self, usernames):
+        """{username: get(username)} for the users that exist"""
+        entries = {}
+        for username in usernames:
+            entry = self.get(username)
+            if entry is not None:
+                entries[username] = entry
+        return entries
+    
+    def users(self):
+        """Get all usernames in the keystore"""
+        self.refresh()
+        return set(self._index)
+    
+    def close(self):
+        """Release the memory map and file handle"""
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._index.clear()
+            self._scanned = 0
+            self._legacy = True
\ No newline at end of file
@@ -1,11 +1,14 @@
 from ldap3 import Server, Connection, ALL, SUBTREE
 from ldap3.core.exceptions import LDAPException
+from logger import get_logger
 
 LDAP_SERVER = "ldap://192.168.92.128"
 ADMIN_DN = "cn=admin,dc=local"
 ADMIN_PWD = "Admin123"
 BASE_DN = "ou=users,dc=local"
 
+log = get_logger("ldap")
+
 class LDAPManager:
     def authenticate(self, user, pwd):
         """Authenticate user against LDAP Active Directory"""
@@ -55,7 +58,7 @@ class LDAPManager:
             return success
             
         except Exception as e:
-            print(f"Registration error: {e}")
+            log.error("Registration error: %s", e)
             return False
     
     def _get_next_uid(self, conn):
@@ -0,0 +1,62 @@
+import logging
+import os
+import threading
+import time
+
+LOG_FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let through at most `rate` records per message template every `per` seconds
+    Suppressed records are counted and reported with the next one let through
+    """
+    def __init__(self, rate=5, per=10.0):
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self._windows = {}  # (logger, template) -> [window start, passed, suppressed]
+        self._lock = threading.Lock()
+    
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.per:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+                return True
+            
+            if window[1] < self.rate:
+                window[1] += 1
+                return True
+            
+            window[2] += 1
+            return False
+
+_configured = False
+_configure_lock = threading.Lock()
+
+def _configure():
+    """Set up the 'chat' logger tree once (level from CHAT_LOG_LEVEL)"""
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handler.addFilter(RateLimitFilter())
+        
+        root = logging.getLogger("chat")
+        root.addHandler(handler)
+        root.setLevel(os.environ.get("CHAT_LOG_LEVEL", "INFO").upper())
+        root.propagate = False
+        _configured = True
+
+def get_logger(name):
+    """Get a leveled, rate-limited logger for a chat module"""
+    _configure()
+    return logging.getLogger(f"chat.{name}")
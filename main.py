@@ -1,4 +1,7 @@
+import startup
 from ui.login import LoginApp
 
+startup.mark("imports done")
+
 if __name__ == "__main__":
     LoginApp().run()
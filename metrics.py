@@ -0,0 +1,201 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds (Prometheus "le" upper bounds)
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter:
+    """Monotonically increasing value"""
+    kind = "counter"
+    
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._value = 0
+        self._lock = threading.Lock()
+    
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+    
+    @property
+    def value(self):
+        return self._value
+    
+    def samples(self):
+        return [(self.name, self._value)]
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+    kind = "gauge"
+    
+    def dec(self, amount=1):
+        self.inc(-amount)
+    
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+class Histogram:
+    """Distribution of observed values in fixed buckets"""
+    kind = "histogram"
+    
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+    
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+    
+    @contextmanager
+    def time(self):
+        """Observe the duration of a with-block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+    
+    @property
+    def count(self):
+        return self._count
+    
+    def samples(self):
+        with self._lock:
+            counts, total, count = list(self._counts), self._sum, self._count
+        
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            le = "+Inf" if bound == float('inf') else repr(bound)
+            samples.append((f'{self.name}_bucket{{le="{le}"}}', cumulative))
+        samples.append((f"{self.name}_sum", total))
+        samples.append((f"{self.name}_count", count))
+        return samples
+
+class Registry:
+    """Named metrics rendered in the Prometheus text exposition format"""
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+    
+    def _get_or_create(self, cls, name, help_text, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, help_text, **kwargs)
+                self._metrics[name] = metric
+            elif type(metric) is not cls:
+                raise ValueError(f"Metric {name} already registered as {metric.kind}")
+            return metric
+    
+    def counter(self, name, help_text):
+        return self._get_or_create(Counter, name, help_text)
+    
+    def gauge(self, name, help_text):
+        return self._get_or_create(Gauge, name, help_text)
+    
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help_text, buckets=buckets)
+    
+    def get(self, name):
+        return self._metrics.get(name)
+    
+    def render(self):
+        """All metrics as Prometheus text"""
+        lines = []
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample, value in metric.samples():
+                lines.append(f"{sample} {value}")
+        return "\n".join(lines) + "\n"
+    
+    def write_textfile(self, path):
+        """Atomically write metrics for node_exporter's textfile collector"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+REGISTRY = Registry()
+
+def counter(name, help_text):
+    """Get or create a counter in the default registry"""
+    return REGISTRY.counter(name, help_text)
+
+def gauge(name, help_text):
+    """Get or create a gauge in the default registry"""
+    return REGISTRY.gauge(name, help_text)
+
+def histogram(name, help_text, buckets=DEFAULT_BUCKETS):
+    """Get or create a histogram in the default registry"""
+    return REGISTRY.histogram(name, help_text, buckets)
+
+def start_http_server(port, host="127.0.0.1", registry=REGISTRY):
+    """Serve /metrics on a local port from a daemon thread"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            pass  # Keep scrapes out of the chat log
+    
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def start_textfile_writer(path, interval=15, registry=REGISTRY):
+    """Rewrite the metrics text file every interval seconds from a daemon thread"""
+    def writer():
+        while True:
+            try:
+                registry.write_textfile(path)
+            except OSError:
+                pass
+            time.sleep(interval)
+    
+    threading.Thread(target=writer, daemon=True).start()
+
+_exporter_started = False
+
+def start_exporter():
+    """
+    Start exporters configured by environment (once per process)
+    CHAT_METRICS_PORT - serve http://127.0.0.1:<port>/metrics
+    CHAT_METRICS_FILE - write a Prometheus text file
+    """
+    global _exporter_started
+    if _exporter_started:
+        return
+    _exporter_started = True
+    
+    port = os.environ.get("CHAT_METRICS_PORT")
+    if port:
+        start_http_server(int(port))
+    
+    path = os.environ.get("CHAT_METRICS_FILE")
+    if path:
+        start_textfile_writer(path)
\ No newline at end of file
@@ -0,0 +1,74 @@
+import sqlite3
+import threading
+from pathlib import Path
+
+# Local, per-machine directory (PKI_PATH may be a shared drive)
+OUTBOX_PATH = Path.home() / ".chat"
+
+# Rows read per replay batch
+REPLAY_BATCH = 500
+
+class Outbox:
+    """
+    Disk-backed store of framed messages not yet accepted by the broker
+    SQLite in WAL mode with synchronous=NORMAL: each add is one small commit
+    that survives a process crash, and the OS batches the actual fsyncs.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " recipient TEXT NOT NULL,"
+            " priority INTEGER NOT NULL,"
+            " body BLOB NOT NULL)"
+        )
+    
+    @classmethod
+    def for_user(cls, username):
+        """Default outbox file for a user"""
+        return cls(OUTBOX_PATH / f"outbox_{username}.db")
+    
+    def add(self, recipient, priority, body):
+        """Store a framed message, return its row id"""
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO outbox (recipient, priority, body) VALUES (?, ?, ?)",
+                (recipient, priority, bytes(body))
+            )
+            return cursor.lastrowid
+    
+    def remove(self, row_ids):
+        """Forget delivered messages (one transaction for the whole batch)"""
+        if not row_ids:
+            return
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany("DELETE FROM outbox WHERE id = ?", [(row_id,) for row_id in row_ids])
+            self._db.execute("COMMIT")
+    
+    def pending(self, after_id=0, limit=REPLAY_BATCH):
+        """Oldest undelivered messages as (id, recipient, priority, body)"""
+        with self._lock:
+            return self._db.execute(
+                "SELECT id, recipient, priority, body FROM outbox WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id, limit)
+            ).fetchall()
+    
+    def last_id(self):
+        """Highest row id currently stored (0 if empty)"""
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(MAX(id), 0) FROM outbox").fetchone()[0]
+    
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+    
+    def close(self):
+        with self._lock:
+            self._db.close()
\ No newline at end of file
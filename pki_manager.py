@@ -2,10 +2,17 @@ from pathlib import Path
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import rsa, ed25519, x25519
 from cryptography.hazmat.backends import default_backend
-from datetime import datetime, timedelta
+from cryptography.exceptions import InvalidSignature
+from datetime import datetime, timedelta, timezone
+import os
 import platform
+import shutil
+import threading
+import time
+from keystore import KeyStore
+from logger import get_logger
 
 
 if platform.system() == "Windows":
@@ -13,33 +20,180 @@ if platform.system() == "Windows":
 else:
     PKI_PATH = Path.home() / "Documents" / "chat_pki"
 
+log = get_logger("pki")
+
+# Key algorithms - "rsa" or "x25519" for users, "rsa" or "ed25519" for the CA
+# X25519/Ed25519 keys generate in microseconds and give much smaller ciphertext
+USER_KEY_TYPE = "rsa"
+CA_KEY_TYPE = "rsa"
+
+# Who signs user certificates: "service" asks the CA signing daemon
+# (ca_service.py) over RabbitMQ, so clients never read ca.key; "local" signs
+# in process with ca.key from PKI_PATH (the daemon itself, tests, benchmarks)
+CA_SIGNING = os.environ.get("CHAT_CA_SIGNING", "service")
+
+# Where certificates are looked up: "directory" asks the key directory
+# service (key_directory.py) and caches the answers, so clients need no PKI
+# share; "keystore" reads keystore.db on PKI_PATH. Unset: "keystore" when
+# signing locally, "directory" otherwise
+KEY_SOURCE = os.environ.get("CHAT_KEY_SOURCE")
+
+# Directory clients have no PKI share, so the CA certificate the key
+# directory returns is checked against one shipped with the client: the
+# SHA-256 fingerprint of ca.crt (CHAT_CA_FINGERPRINT, hex with or without
+# colons - "openssl x509 -noout -fingerprint -sha256 -in ca.crt") or a copy
+# of ca.crt itself (CHAT_CA_CERT, then the directory is not asked)
+CA_FINGERPRINT = os.environ.get("CHAT_CA_FINGERPRINT", "")
+CA_CERT_FILE = os.environ.get("CHAT_CA_CERT")
+
+# Private keys of directory clients stay on this machine
+KEY_PATH = Path.home() / ".chat" / "keys"
+
+def generate_key(key_type, rsa_bits=2048):
+    """Generate a private key of the given algorithm"""
+    if key_type == "rsa":
+        return rsa.generate_private_key(
+            public_exponent=65537,
+            key_size=rsa_bits,
+            backend=default_backend()
+        )
+    if key_type == "x25519":
+        return x25519.X25519PrivateKey.generate()
+    if key_type == "ed25519":
+        return ed25519.Ed25519PrivateKey.generate()
+    raise ValueError(f"Unsupported key type: {key_type}")
+
+def ca_fingerprint(cert):
+    """SHA-256 fingerprint of a certificate, lowercase hex"""
+    return cert.fingerprint(hashes.SHA256()).hex()
+
+def signing_hash(ca_key):
+    """Ed25519 signs without a separate digest; RSA uses SHA256"""
+    if isinstance(ca_key, ed25519.Ed25519PrivateKey):
+        return None
+    return hashes.SHA256()
+
+def public_key_der(key):
+    """SubjectPublicKeyInfo DER of a private or public key"""
+    if hasattr(key, 'public_key'):
+        key = key.public_key()
+    return key.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+
+def load_ca():
+    """Load the CA private key and certificate from PKI_PATH"""
+    with open(PKI_PATH / "ca.key", 'rb') as f:
+        ca_key = serialization.load_pem_private_key(
+            f.read(), password=None, backend=default_backend()
+        )
+    
+    with open(PKI_PATH / "ca.crt", 'rb') as f:
+        ca_cert = x509.load_pem_x509_certificate(
+            f.read(), default_backend()
+        )
+    return ca_key, ca_cert
+
+def issue_certificate(username, public_key, ca_key, ca_cert):
+    """Certificate (DER) binding username to public_key, signed by the CA"""
+    subject = x509.Name([
+        x509.NameAttribute(NameOID.COUNTRY_NAME, "TN"),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, "ChatApp"),
+        x509.NameAttribute(NameOID.COMMON_NAME, username),
+    ])
+    
+    user_cert = x509.CertificateBuilder().subject_name(
+        subject
+    ).issuer_name(
+        ca_cert.subject  # Signed by CA
+    ).public_key(
+        public_key
+    ).serial_number(
+        x509.random_serial_number()
+    ).not_valid_before(
+        datetime.now(timezone.utc)
+    ).not_valid_after(
+        datetime.now(timezone.utc) + timedelta(days=365)  # 1 year
+    ).sign(ca_key, signing_hash(ca_key), default_backend())  # Signed with CA's private key
+    
+    return user_cert.public_bytes(serialization.Encoding.DER)
+
 class PKIManager:
-    def __init__(self):
+    def __init__(self, signing=None, key_source=None):
         """Initialize PKI - uses existing CA if available"""
+        self.signing = signing or CA_SIGNING
+        self.key_source = key_source or KEY_SOURCE or ("keystore" if self.signing == "local" else "directory")
+        self._ca_cert = None
+        self._ca_mtime = None
+        self._ca_checked = 0
+        self._key_cache = {}  # username -> (keystore record offset, fingerprint)
+        self._verified = {}   # (username, fingerprint) -> (not_valid_after, DER public key)
+        self._cache_lock = threading.Lock()
+        
+        if self.key_source == "directory":
+            if self.signing == "local":
+                raise ValueError("Local signing needs the keystore on PKI_PATH")
+            # Nothing on the PKI share - certificates and the CA come from the directory
+            from key_directory import KeyDirectory, KEY_CACHE_FILE
+            self.keystore = KeyDirectory(KEY_CACHE_FILE)
+            return
+        
         if not PKI_PATH.exists():
-            print(f"Creating PKI directory: {PKI_PATH}")
+            log.info("Creating PKI directory: %s", PKI_PATH)
             PKI_PATH.mkdir(parents=True, exist_ok=True)
         
         ca_key_path = PKI_PATH / "ca.key"
         ca_crt_path = PKI_PATH / "ca.crt"
         
-        if ca_key_path.exists() and ca_crt_path.exists():
-            print(f"✓ Using existing CA certificate from {PKI_PATH}")
+        if self.signing != "local":
+            # Only the signing service has (and creates) the CA key
+            if not ca_crt_path.exists():
+                log.warning("CA certificate not found in %s - is the CA signing service set up?", PKI_PATH)
+        elif ca_key_path.exists() and ca_crt_path.exists():
+            log.info("Using existing CA certificate from %s", PKI_PATH)
         else:
-            print("CA certificate not found, creating new one...")
+            log.info("CA certificate not found, creating new one...")
             self.create_ca()
+        
+        # All public keys and certificates live in one keystore file
+        self.keystore = KeyStore(PKI_PATH / "keystore.db")
+        if not self.keystore.exists():
+            self._migrate_legacy_layout()
+    
+    def _migrate_legacy_layout(self):
+        """Import certificates from the old one-file-per-user layout into the keystore"""
+        migrated = 0
+        for crt_path in sorted(PKI_PATH.glob("*.crt")):
+            username = crt_path.stem
+            if username == "ca":
+                continue
+            
+            try:
+                with open(crt_path, 'rb') as f:
+                    cert = x509.load_pem_x509_certificate(f.read(), default_backend())
+                self.keystore.append(
+                    username,
+                    cert.public_key().public_bytes(
+                        encoding=serialization.Encoding.DER,
+                        format=serialization.PublicFormat.SubjectPublicKeyInfo
+                    ),
+                    cert.public_bytes(serialization.Encoding.DER)
+                )
+                migrated += 1
+            except Exception as e:
+                log.warning("Skipping %s during keystore migration: %s", crt_path.name, e)
+        
+        if migrated:
+            log.info("Migrated %d certificate(s) into %s", migrated, self.keystore.path)
     
-    def create_ca(self):
+    def create_ca(self, key_type=None):
         """Create NEW Certificate Authority (only if doesn't exist)"""
         ca_key_path = PKI_PATH / "ca.key"
         ca_crt_path = PKI_PATH / "ca.crt"
         
         # Generate CA private key
-        ca_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=4096,
-            backend=default_backend()
-        )
+        ca_key = generate_key(key_type or CA_KEY_TYPE, rsa_bits=4096)
         
         # Save CA private key
         with open(ca_key_path, 'wb') as f:
@@ -65,41 +219,52 @@ class PKIManager:
         ).serial_number(
             x509.random_serial_number()
         ).not_valid_before(
-            datetime.utcnow()
+            datetime.now(timezone.utc)
         ).not_valid_after(
-            datetime.utcnow() + timedelta(days=3650)  # 10 years
-        ).sign(ca_key, hashes.SHA256(), default_backend())
+            datetime.now(timezone.utc) + timedelta(days=3650)  # 10 years
+        ).sign(ca_key, signing_hash(ca_key), default_backend())
         
         # Save CA certificate
         with open(ca_crt_path, 'wb') as f:
             f.write(ca_cert.public_bytes(serialization.Encoding.PEM))
         
-        print(f"✓ NEW CA certificate created at {PKI_PATH}")
+        log.info("NEW CA certificate created at %s", PKI_PATH)
+        log.info("CA fingerprint for directory clients: CHAT_CA_FINGERPRINT=%s", ca_fingerprint(ca_cert))
     
-    def create_user_cert(self, username):
+    def create_user_cert(self, username, key_type=None, password=None):
         """
         Create user certificate SIGNED BY existing CA
         Each user gets their own certificate signed by the ONE CA
+        key_type selects the user key algorithm (defaults to USER_KEY_TYPE);
+        the signing service authenticates the request with password (LDAP)
         """
-        user_key_path = PKI_PATH / f"{username}.key"
-        user_crt_path = PKI_PATH / f"{username}.crt"
-        user_pub_path = PKI_PATH / f"{username}_pub.pem"
+        user_key_path = Path(self.get_user_key_path(username))
         
         # Check if user certificate already exists
-        if user_key_path.exists() and user_crt_path.exists() and user_pub_path.exists():
-            print(f"✓ Certificate already exists for {username}")
+        if user_key_path.exists() and self.keystore.get(username) is not None:
+            log.info("Certificate already exists for %s", username)
             return True
         
-        print(f"Creating new certificate for {username}...")
+        log.info("Creating new certificate for %s...", username)
         
-        # Generate user private key
-        user_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-            backend=default_backend()
-        )
+        # Generate user private key - it never leaves this machine
+        user_key = generate_key(key_type or USER_KEY_TYPE)
+        
+        if self.signing == "local":
+            ca_key, ca_cert = load_ca()
+            cert_der = issue_certificate(username, user_key.public_key(), ca_key, ca_cert)
+            # Publish public key and certificate in the shared keystore
+            self.keystore.append(username, public_key_der(user_key), cert_der)
+        else:
+            # The signing service publishes the certificate in the keystore itself
+            from ca_service import request_certificate
+            with self._cache_lock:
+                ca_cert = self._load_ca_cert()
+            request_certificate(username, user_key, password, ca_cert)
+            self.keystore.refresh(force=True)
         
-        # Save user private key
+        # Save user private key once its certificate exists
+        user_key_path.parent.mkdir(parents=True, exist_ok=True)
         with open(user_key_path, 'wb') as f:
             f.write(user_key.private_bytes(
                 encoding=serialization.Encoding.PEM,
@@ -107,66 +272,145 @@ class PKIManager:
                 encryption_algorithm=serialization.NoEncryption()
             ))
         
-        # Save user public key (for RSA encryption)
-        with open(user_pub_path, 'wb') as f:
-            f.write(user_key.public_key().public_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PublicFormat.SubjectPublicKeyInfo
-            ))
+        log.info("Certificate created for %s (signed by CA)", username)
+        return True
+    
+    def get_user_key_path(self, username):
+        """Get path to user's private key"""
+        if self.key_source == "keystore":
+            return str(PKI_PATH / f"{username}.key")
+        
+        path = KEY_PATH / f"{username}.key"
+        if not path.exists():
+            # Keys created on the PKI share move to this machine on first use
+            legacy = PKI_PATH / f"{username}.key"
+            try:
+                if legacy.exists():
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.copyfile(legacy, path)
+                    log.info("Copied private key for %s from %s to %s", username, PKI_PATH, KEY_PATH)
+            except OSError as e:
+                log.warning("Cannot copy private key for %s from the PKI share: %s", username, e)
+        return str(path)
+    
+    def list_users(self):
+        """Get all users with a published certificate"""
+        return self.keystore.users()
+    
+    def prefetch_public_keys(self, usernames):
+        """Look up many certificates at once (one directory request for a group send)"""
+        self.keystore.get_many(usernames)
+    
+    def _load_ca_cert(self):
+        """Load CA certificate, re-reading only if the file changed"""
+        if self.key_source == "directory":
+            if self._ca_cert is None:
+                self._ca_cert = self._trusted_ca_cert()
+            return self._ca_cert
+        
+        # Avoid a stat on the shared drive for every lookup
+        if self._ca_cert is not None and time.monotonic() - self._ca_checked < 60:
+            return self._ca_cert
+        self._ca_checked = time.monotonic()
         
-        # Load the ONE CA key and certificate
-        ca_key_path = PKI_PATH / "ca.key"
         ca_crt_path = PKI_PATH / "ca.crt"
+        mtime = ca_crt_path.stat().st_mtime
         
-        with open(ca_key_path, 'rb') as f:
-            ca_key = serialization.load_pem_private_key(
-                f.read(), password=None, backend=default_backend()
-            )
+        if self._ca_cert is None or self._ca_mtime != mtime:
+            with open(ca_crt_path, 'rb') as f:
+                self._ca_cert = x509.load_pem_x509_certificate(
+                    f.read(), default_backend()
+                )
+            self._ca_mtime = mtime
+            # A new CA invalidates everything verified against the old one
+            self._key_cache.clear()
+            self._verified.clear()
         
-        with open(ca_crt_path, 'rb') as f:
-            ca_cert = x509.load_pem_x509_certificate(
-                f.read(), default_backend()
-            )
+        return self._ca_cert
+    
+    def _trusted_ca_cert(self):
+        """CA certificate shipped with the client, or the directory's if it matches the pinned fingerprint"""
+        if CA_CERT_FILE:
+            with open(CA_CERT_FILE, 'rb') as f:
+                return x509.load_pem_x509_certificate(f.read(), default_backend())
         
-        # Create user certificate SIGNED BY CA
-        subject = x509.Name([
-            x509.NameAttribute(NameOID.COUNTRY_NAME, "TN"),
-            x509.NameAttribute(NameOID.ORGANIZATION_NAME, "ChatApp"),
-            x509.NameAttribute(NameOID.COMMON_NAME, username),
-        ])
+        expected = CA_FINGERPRINT.replace(':', '').replace(' ', '').lower()
+        if not expected:
+            raise ValueError("No trusted CA configured - set CHAT_CA_FINGERPRINT (or CHAT_CA_CERT)")
+        # A cached copy that does not match may be outdated - ask the directory once more
+        for force in (False, True):
+            cert = x509.load_pem_x509_certificate(self.keystore.ca_certificate(force), default_backend())
+            if ca_fingerprint(cert) == expected:
+                return cert
+        raise ValueError(f"The key directory's CA certificate ({ca_fingerprint(cert)}) "
+                         f"does not match CHAT_CA_FINGERPRINT")
+    
+    def _verify_user_cert(self, username, cert):
+        """Check user certificate is signed by our CA, not expired, and issued to username"""
+        ca_cert = self._load_ca_cert()
         
-        user_cert = x509.CertificateBuilder().subject_name(
-            subject
-        ).issuer_name(
-            ca_cert.subject  # Signed by CA
-        ).public_key(
-            user_key.public_key()
-        ).serial_number(
-            x509.random_serial_number()
-        ).not_valid_before(
-            datetime.utcnow()
-        ).not_valid_after(
-            datetime.utcnow() + timedelta(days=365)  # 1 year
-        ).sign(ca_key, hashes.SHA256(), default_backend())  # Signed with CA's private key
+        if cert.issuer != ca_cert.subject:
+            raise ValueError(f"Certificate for {username} was not issued by ChatAppCA")
         
-        # Save user certificate
-        with open(user_crt_path, 'wb') as f:
-            f.write(user_cert.public_bytes(serialization.Encoding.PEM))
+        try:
+            # Handles both RSA and Ed25519 CA signatures
+            cert.verify_directly_issued_by(ca_cert)
+        except (InvalidSignature, ValueError, TypeError):
+            raise ValueError(f"Certificate for {username} has an invalid CA signature")
         
-        print(f"✓ Certificate created for {username} (signed by CA)")
-        return True
-    
-    def get_user_key_path(self, username):
-        """Get path to user's private key"""
-        return str(PKI_PATH / f"{username}.key")
+        now = datetime.now(timezone.utc)
+        if now < cert.not_valid_before_utc or now > cert.not_valid_after_utc:
+            raise ValueError(f"Certificate for {username} is expired or not yet valid")
+        
+        common_names = cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+        if not common_names or common_names[0].value != username:
+            raise ValueError(f"Certificate subject does not match {username}")
     
-    def get_user_pubkey_path(self, username):
-        """Get path to user's public key"""
-        return str(PKI_PATH / f"{username}_pub.pem")
+    def get_user_public_key(self, username):
+        """
+        Get recipient's public key (DER) from their CA-verified certificate
+        Verification runs once per name and certificate - results are memoized
+        by (username, certificate fingerprint) and keystore record (or directory
+        ETag), so a certificate verified for one name is not accepted for another.
+        Returns None if no certificate.
+        """
+        entry = self.keystore.get(username)
+        if entry is None:
+            return None
+        offset, stored_pub_der, cert_der = entry
+        
+        with self._cache_lock:
+            self._load_ca_cert()
+            
+            cached = self._key_cache.get(username)
+            if cached and cached[0] == offset:
+                verified_key = (username, cached[1])
+                verified = self._verified.get(verified_key)
+                if verified and datetime.now(timezone.utc) <= verified[0]:
+                    return verified[1]
+                # Expired since it was cached - verify again below (and fail)
+                self._verified.pop(verified_key, None)
+                del self._key_cache[username]
+            
+            cert = x509.load_der_x509_certificate(cert_der, default_backend())
+            
+            fingerprint = cert.fingerprint(hashes.SHA256())
+            verified_key = (username, fingerprint)
+            
+            if verified_key not in self._verified:
+                self._verify_user_cert(username, cert)
+                pub_der = cert.public_key().public_bytes(
+                    encoding=serialization.Encoding.DER,
+                    format=serialization.PublicFormat.SubjectPublicKeyInfo
+                )
+                if pub_der != stored_pub_der:
+                    raise ValueError(f"Keystore public key for {username} does not match certificate")
+                self._verified[verified_key] = (cert.not_valid_after_utc, pub_der)
+            
+            self._key_cache[username] = (offset, fingerprint)
+            return self._verified[verified_key][1]
     
     def verify_cert(self, username):
         """Check if user certificate exists"""
-        cert_path = PKI_PATH / f"{username}.crt"
-        key_path = PKI_PATH / f"{username}.key"
-        pub_path = PKI_PATH / f"{username}_pub.pem"
-        return cert_path.exists() and key_path.exists() and pub_path.exists()
\ No newline at end of file
+        key_path = Path(self.get_user_key_path(username))
+        return key_path.exists() and self.keystore.get(username) is not None
\ No newline at end of file
@@ -1,360 +1,634 @@
 import pika
 import json
+import os
+import random
 import threading
 import time
-from queue import Queue
+from transport import Transport
+from send_queue import SendQueue, SendQueueFull, SendQueueClosed, PRIORITY_CONTROL, PRIORITY_CHAT, PRIORITY_BULK
+from wire_format import pack_message, CONTENT_TYPE
+from outbox import Outbox
+from hash_ring import HashRing
+from logger import get_logger
+import metrics
 
 RABBITMQ_HOST = "192.168.92.1"
+# Cluster nodes, e.g. CHAT_RABBITMQ_NODES="10.0.0.1,10.0.0.2,10.0.0.3".
+# Each user queue is placed on the node its name hashes to (see HashRing)
+RABBITMQ_NODES = [node.strip() for node in os.environ.get("CHAT_RABBITMQ_NODES", RABBITMQ_HOST).split(",") if node.strip()]
 RABBITMQ_USER = "chatuser"  
 RABBITMQ_PASS = "chat123" 
 
-class MQ:
-    def __init__(self, user):
-        """Initialize RabbitMQ connection (AMQP protocol)"""
-        self.username = user
+log = get_logger("mq")
+
+# How long send_message blocks on a full queue before rejecting the message
+SEND_TIMEOUT = 2.0
+
+# Delivered messages are deleted from the outbox in batches of this size
+OUTBOX_ACK_BATCH = 100
+
+# Reconnect backoff: random delay in [0, min(MAX, BASE * 2^attempt)] seconds,
+# so clients dropped by a broker restart do not reconnect in lockstep
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+
+# "quorum" replicates user queues so they survive losing their node. Only
+# applies to newly declared queues - an existing queue cannot change type
+QUEUE_TYPE = os.environ.get("CHAT_QUEUE_TYPE", "classic")
+
+# Broker-side bounds for user queues, so accounts that never come back cannot
+# grow broker memory without limit (0 / "" disables a setting). Dropping the
+# oldest messages loses only those - every session message carries its key
+QUEUE_MESSAGE_TTL_MS = int(os.environ.get("CHAT_QUEUE_TTL_MS", 7 * 24 * 3600 * 1000))
+QUEUE_MAX_LENGTH = int(os.environ.get("CHAT_QUEUE_MAX_LENGTH", 10000))
+QUEUE_OVERFLOW = os.environ.get("CHAT_QUEUE_OVERFLOW", "drop-head")  # or "reject-publish"
+QUEUE_EXPIRES_MS = int(os.environ.get("CHAT_QUEUE_EXPIRES_MS", 30 * 24 * 3600 * 1000))  # Delete unused queues
+QUEUE_LAZY = True  # Classic queues keep messages on disk, not in RAM
+
+# Expired and overflowed messages go here (itself bounded) instead of vanishing
+DEAD_LETTER_EXCHANGE = os.environ.get("CHAT_DEAD_LETTER_EXCHANGE", "chat_dead_letter")
+DEAD_LETTER_QUEUE = "chat_dead_letter"
+DEAD_LETTER_TTL_MS = 7 * 24 * 3600 * 1000
+DEAD_LETTER_MAX_LENGTH = 100000
+
+SEND_QUEUE_DEPTH = metrics.gauge("chat_send_queue_depth", "Messages waiting in the outbound send queue")
+SEND_REJECTED = metrics.counter("chat_send_rejected_total", "Messages rejected because the send queue was full")
+PUBLISH_SECONDS = metrics.histogram("chat_publish_seconds", "Time to publish one chat message, including any reconnect")
+MESSAGES_SENT = metrics.counter("chat_messages_sent_total", "Chat messages published")
+SEND_FAILURES = metrics.counter("chat_send_failures_total", "Chat messages left in the outbox after all retries")
+OUTBOX_REPLAYED = metrics.counter("chat_outbox_replayed_total", "Messages from a previous run delivered from the outbox")
+RECONNECTS = metrics.counter("chat_reconnects_total", "Broker reconnections after the initial connect")
+MESSAGES_RECEIVED = metrics.counter("chat_messages_received_total", "Chat messages consumed")
+CONSUMER_LAG_SECONDS = metrics.histogram(
+    "chat_consumer_lag_seconds", "Time from publish to consume (1 s resolution, cross-host clocks)"
+)
+
+def backoff_delay(attempt):
+    """Capped exponential backoff with full jitter"""
+    return random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * (2 ** attempt)))
+
+class TransportClosed(Exception):
+    """The transport was closed while waiting for a connection"""
+
+class QueueUnavailable(Exception):
+    """The recipient's classic queue lives on a cluster node that is down"""
+
+class ConnectionSupervisor:
+    """
+    Owns one pika connection and channel, used from a single thread
+    A failed operation reports the loss with mark_lost(); the next
+    get_channel() reconnects after a jittered backoff and re-runs
+    setup(channel) to restore declared topology and consumers.
+    Nothing is probed per publish.
+    """
+    def __init__(self, name, open_connection, setup, stopping):
+        self.name = name
         self.conn = None
         self.channel = None
-        self.consuming = False
-        self._lock = threading.Lock()
-        self._send_queue = Queue()
+        self._open_connection = open_connection
+        self._setup = setup
+        self._stopping = stopping
+        self._connected_once = False
+        self._failures = 0
+        self._retry_at = 0  # monotonic time of the next allowed attempt
+    
+    @property
+    def connected(self):
+        return self.channel is not None and self.conn.is_open and self.channel.is_open
+    
+    def get_channel(self, max_attempts=None):
+        """Current channel, waiting out backoff and (re)connecting if needed"""
+        attempt = 0
+        while not self.connected:
+            self.close()
+            if self._stopping.is_set():
+                raise TransportClosed(f"{self.name} connection is closing")
+            
+            delay = self._retry_at - time.monotonic()
+            if delay > 0:
+                log.info("%s reconnecting in %.1fs", self.name, delay)
+                if self._stopping.wait(delay):
+                    raise TransportClosed(f"{self.name} connection is closing")
+            
+            attempt += 1
+            try:
+                self._connect()
+            except Exception as e:
+                self._schedule_retry()
+                if max_attempts is not None and attempt >= max_attempts:
+                    raise
+                log.warning("%s connect attempt %d failed: %s", self.name, attempt, e)
+        return self.channel
+    
+    def try_channel(self):
+        """Current channel, or None while down and backing off (never waits)"""
+        if self.connected:
+            return self.channel
+        
+        self.close()
+        if self._stopping.is_set():
+            raise TransportClosed(f"{self.name} connection is closing")
+        if time.monotonic() < self._retry_at:
+            return None
+        
+        try:
+            self._connect()
+            return self.channel
+        except Exception as e:
+            self._schedule_retry()
+            log.warning("%s connect failed: %s", self.name, e)
+            return None
+    
+    def _schedule_retry(self):
+        self._retry_at = time.monotonic() + backoff_delay(self._failures)
+        self._failures += 1
+    
+    def _connect(self):
+        conn = self._open_connection()
+        try:
+            channel = conn.channel()
+            self._setup(channel)
+        except Exception:
+            _close_quietly(conn)
+            raise
+        
+        self.conn, self.channel = conn, channel
+        self._failures = 0
+        if self._connected_once:
+            RECONNECTS.inc()
+            log.info("%s connection re-established", self.name)
+        self._connected_once = True
+    
+    def mark_lost(self, error=None):
+        """Drop the connection after a failure; reconnects wait a jittered delay"""
+        log.warning("%s connection lost: %s", self.name, error)
+        self.close()
+        self._schedule_retry()
+    
+    def close(self):
+        _close_quietly(self.channel)
+        _close_quietly(self.conn)
+        self.channel = None
+        self.conn = None
+
+def queue_arguments():
+    """x-arguments for user queues - must be identical everywhere a queue is declared"""
+    arguments = {}
+    if QUEUE_TYPE == "quorum":
+        # Replicated; leader on the node we declare from (the owning node)
+        arguments['x-queue-type'] = 'quorum'
+        arguments['x-queue-leader-locator'] = 'client-local'
+    elif QUEUE_LAZY:
+        arguments['x-queue-mode'] = 'lazy'
+    if QUEUE_MESSAGE_TTL_MS:
+        arguments['x-message-ttl'] = QUEUE_MESSAGE_TTL_MS
+    if QUEUE_MAX_LENGTH:
+        arguments['x-max-length'] = QUEUE_MAX_LENGTH
+        arguments['x-overflow'] = QUEUE_OVERFLOW
+    if QUEUE_EXPIRES_MS:
+        arguments['x-expires'] = QUEUE_EXPIRES_MS
+    if DEAD_LETTER_EXCHANGE:
+        arguments['x-dead-letter-exchange'] = DEAD_LETTER_EXCHANGE
+    return arguments
+
+def queue_policy_command():
+    """
+    rabbitmqctl command applying the same limits to queues declared before
+    they existed (a queue's arguments cannot be changed, a policy can)
+    """
+    definition = {}
+    for argument, value in queue_arguments().items():
+        key = argument[2:]  # x-message-ttl -> message-ttl
+        if key not in ('queue-type', 'queue-leader-locator'):
+            definition[key] = value
+    return (f"rabbitmqctl set_policy --apply-to queues --priority 0 chat-user-queues "
+            f"'^user_' '{json.dumps(definition)}'")
+
+def _declare_user_queue(channel, queue):
+    """
+    Declare a user queue with queue_arguments()
+    A queue created by an older client with other arguments makes the broker
+    close the channel (406), so declare on a throwaway channel and keep using
+    the existing queue - queue_policy_command() migrates its limits.
+    A durable classic queue whose home node is down answers 404; the
+    connection we declared on is healthy, so that is QueueUnavailable.
+    """
+    declare_channel = channel.connection.channel()
+    try:
+        declare_channel.queue_declare(queue=queue, durable=True, arguments=queue_arguments())
+    except pika.exceptions.ChannelClosedByBroker as e:
+        if e.reply_code == 404:
+            raise QueueUnavailable(f"Queue {queue} is on a node that is down: {e.reply_text}") from e
+        if e.reply_code != 406:
+            raise
+        log.warning("Queue %s exists with different arguments, using it as is. "
+                    "Apply the limits with: %s", queue, queue_policy_command())
+    finally:
+        _close_quietly(declare_channel)
+
+def _declare_dead_letter(channel):
+    """Bounded dead-letter exchange and queue for expired/overflowed messages"""
+    if not DEAD_LETTER_EXCHANGE:
+        return
+    channel.exchange_declare(exchange=DEAD_LETTER_EXCHANGE, exchange_type='fanout', durable=True)
+    channel.queue_declare(queue=DEAD_LETTER_QUEUE, durable=True, arguments={
+        'x-message-ttl': DEAD_LETTER_TTL_MS,
+        'x-max-length': DEAD_LETTER_MAX_LENGTH,
+        'x-queue-mode': 'lazy'
+    })
+    channel.queue_bind(queue=DEAD_LETTER_QUEUE, exchange=DEAD_LETTER_EXCHANGE)
+
+def _close_quietly(resource):
+    """Close a pika connection or channel, ignoring errors"""
+    try:
+        if resource is not None and resource.is_open:
+            resource.close()
+    except Exception:
+        pass
+
+def open_connection(host, heartbeat=300, username=None, password=None):
+    """Open a new connection to one RabbitMQ node (also used by ca_service, which has its own account)"""
+    username = username or RABBITMQ_USER
+    password = password or RABBITMQ_PASS
+    try:
+        # Create credentials
+        credentials = pika.PlainCredentials(username, password)
+        
+        # Single attempt - retries and backoff belong to ConnectionSupervisor
+        parameters = pika.ConnectionParameters(
+            host=host,
+            port=5672,
+            credentials=credentials,
+            connection_attempts=1,
+            socket_timeout=10,
+            heartbeat=heartbeat,
+            blocked_connection_timeout=300,
+            frame_max=131072
+        )
+        
+        conn = pika.BlockingConnection(parameters)
+        log.info("Connected to RabbitMQ %s as %s", host, username)
+        return conn
+    
+    except pika.exceptions.ProbableAuthenticationError:
+        raise Exception(
+            f"RabbitMQ Authentication Failed!\n\n"
+            f"Current credentials:\n"
+            f"  Username: {username}\n"
+            f"  Password: {password}\n\n"
+            f"Solutions:\n"
+            f"1. Use default guest/guest (only works on localhost)\n"
+            f"2. Create a new user on RabbitMQ host:\n"
+            f"   rabbitmqctl add_user myuser mypassword\n"
+            f"   rabbitmqctl set_permissions -p / myuser '.*' '.*' '.*'\n"
+            f"3. Update RABBITMQ_USER and RABBITMQ_PASS in rabbitmq_manager.py"
+        )
+    except pika.exceptions.AMQPConnectionError as e:
+        raise Exception(
+            f"Cannot connect to RabbitMQ at {host}:5672\n\n"
+            f"Please check:\n"
+            f"1. RabbitMQ is running\n"
+            f"2. Firewall allows port 5672\n"
+            f"3. RabbitMQ is listening on 0.0.0.0:5672\n\n"
+            f"Error: {e}"
+        )
+
+def open_first(nodes, heartbeat=300, username=None, password=None):
+    """Connect to the first reachable node, in failover order"""
+    error = None
+    for node in nodes:
+        try:
+            return open_connection(node, heartbeat, username, password)
+        except Exception as e:
+            log.warning("Node %s unreachable: %s", node, e)
+            error = e
+    raise error
+
+class MQ(Transport):
+    """RabbitMQ transport - per-user durable queues and a presence fanout exchange"""
+    def __init__(self, user, outbox=None, nodes=None):
+        """Initialize RabbitMQ connection (AMQP protocol)"""
+        super().__init__(user)
+        self._ring = HashRing(nodes or RABBITMQ_NODES)
+        if len(self._ring.nodes) > 1 and QUEUE_TYPE != "quorum":
+            log.warning("Classic queues on %d nodes: a user's messages wait in the outbox while "
+                        "their queue's node is down. Set CHAT_QUEUE_TYPE=quorum to replicate queues",
+                        len(self._ring.nodes))
+        self._outbox = outbox or Outbox.for_user(user)
+        self._replay_upto = self._outbox.last_id()  # Left over from a previous run
+        self.queue_name = f"user_{user}"
+        self._lock = threading.Lock()  # Publishing: send worker vs close()
+        self._send_queue = SendQueue()
         self._send_thread = None
-        self._reconnect_interval = 5
-        self._last_heartbeat = time.time()
+        self._declared_queues = {}  # node -> recipient queues declared on its connection
         
-        self._connect()
+        # Each thread that talks to the broker owns its own connections
+        # (pika is not thread-safe): the send worker has one publisher per
+        # node, listen* consume from our queue's node
+        self._publishers = {}
+        self._connect_first_publisher()
         self._start_send_worker()
-        self._start_heartbeat_monitor()
     
-    def _start_heartbeat_monitor(self):
-        """Monitor connection health and reconnect if needed"""
-        def monitor():
-            while self.consuming:
-                try:
-                    time.sleep(10)  # Check every 10 seconds
-                    
-                    with self._lock:
-                        if self.conn is None or self.conn.is_closed:
-                            print("⚠️ Connection lost, reconnecting...")
-                            self._connect()
-                        elif self.channel is None or self.channel.is_closed:
-                            print("⚠️ Channel lost, recreating...")
-                            self._recreate_channel()
-                    
-                except Exception as e:
-                    print(f"Heartbeat monitor error: {e}")
+    def _publisher(self, node):
+        """Publisher connection to one node (created on first use)"""
+        supervisor = self._publishers.get(node)
+        if supervisor is None:
+            supervisor = self._publishers[node] = ConnectionSupervisor(
+                f"publisher {node}",
+                lambda: open_connection(node),
+                lambda channel: self._declare_publisher(node, channel),
+                self._stopping
+            )
+        return supervisor
+    
+    def _connect_first_publisher(self):
+        """Fail fast (e.g. at login) unless some node in our failover order is reachable"""
+        error = None
+        for node in self._ring.nodes_for(self.username):
+            try:
+                self._publisher(node).get_channel(max_attempts=2)
+                return
+            except Exception as e:
+                error = e
+        raise error
+    
+    def _publish_channel(self, user):
+        """(node, channel) for publishing to user - the owning node, or the next live one"""
+        nodes = self._ring.nodes_for(user)
+        for node in nodes:
+            channel = self._publisher(node).try_channel()
+            if channel is not None:
+                return node, channel
         
-        threading.Thread(target=monitor, daemon=True).start()
+        # Every node is down - wait for the owner to come back
+        return nodes[0], self._publisher(nodes[0]).get_channel()
     
     def _start_send_worker(self):
         """Start background thread to handle sending messages"""
         def worker():
+            acked = []  # Outbox rows published but not yet deleted
+            
+            # Resume delivery of messages a previous run never got out
+            self._replay_outbox(acked)
+            
             while True:
                 try:
-                    # Get message from queue (blocking with timeout)
-                    item = self._send_queue.get(timeout=1)
-                    
-                    if item is None:  # Shutdown signal
+                    # Highest priority first; None once closed and drained
+                    entry = self._send_queue.get()
+                    if entry is None:
                         break
                     
-                    to_user, encrypted_msg = item
-                    
-                    # Retry mechanism for sending
-                    success = False
-                    for attempt in range(3):
-                        try:
-                            self._send_message_internal(to_user, encrypted_msg)
-                            success = True
-                            break
-                        except Exception as e:
-                            print(f"Send attempt {attempt + 1} failed: {e}")
-                            if attempt < 2:
-                                time.sleep(1)
-                                with self._lock:
-                                    self._connect()
-                    
-                    if not success:
-                        print(f"❌ Failed to send message to {to_user} after 3 attempts")
+                    _, (kind, target, payload) = entry
+                    SEND_QUEUE_DEPTH.set(len(self._send_queue))
                     
-                    self._send_queue.task_done()
+                    if kind == 'presence':
+                        self._deliver(kind, target, payload)
+                    else:
+                        row_id, body = payload
+                        if self._deliver(kind, target, body) and row_id is not None:
+                            acked.append(row_id)
                     
-                    # Small delay to prevent overwhelming connection
-                    time.sleep(0.05)
+                    # Batch outbox deletes; flush whenever the queue runs dry
+                    if len(acked) >= OUTBOX_ACK_BATCH or not len(self._send_queue):
+                        self._outbox.remove(acked)
+                        acked.clear()
                     
                 except Exception as e:
-                    if "Empty" not in str(type(e).__name__):
-                        print(f"Send worker error: {e}")
+                    log.error("Send worker error: %s", e)
                     continue
+            
+            self._outbox.remove(acked)
         
         self._send_thread = threading.Thread(target=worker, daemon=True)
         self._send_thread.start()
     
-    def _connect(self):
-        """Create connection to RabbitMQ with better parameters"""
-        try:
-            # Close existing connections first
-            self._close_connection_internal()
-            
-            # Create credentials
-            credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-            
-            # Connection parameters with improved settings
-            parameters = pika.ConnectionParameters(
-                host=RABBITMQ_HOST,
-                port=5672,
-                credentials=credentials,
-                connection_attempts=3,
-                retry_delay=2,
-                socket_timeout=10,
-                heartbeat=300,  # Heartbeat every 5 minutes
-                blocked_connection_timeout=300,
-                frame_max=131072
-            )
-            
-            self.conn = pika.BlockingConnection(parameters)
-            self.channel = self.conn.channel()
-            
-            # Set QoS to prevent overwhelming
-            self.channel.basic_qos(prefetch_count=10)
-            
-            # Create user's personal queue with proper durability
-            self.queue_name = f"user_{self.username}"
-            self.channel.queue_declare(queue=self.queue_name, durable=True)
-            
-            # Create presence exchange
-            self.channel.exchange_declare(
-                exchange='chat_presence',
-                exchange_type='fanout',
-                durable=False
-            )
-            
-            self._last_heartbeat = time.time()
-            print(f"✓ Connected to RabbitMQ as {RABBITMQ_USER}")
-            
-        except pika.exceptions.ProbableAuthenticationError:
-            raise Exception(
-                f"RabbitMQ Authentication Failed!\n\n"
-                f"Current credentials:\n"
-                f"  Username: {RABBITMQ_USER}\n"
-                f"  Password: {RABBITMQ_PASS}\n\n"
-                f"Solutions:\n"
-                f"1. Use default guest/guest (only works on localhost)\n"
-                f"2. Create a new user on RabbitMQ host:\n"
-                f"   rabbitmqctl add_user myuser mypassword\n"
-                f"   rabbitmqctl set_permissions -p / myuser '.*' '.*' '.*'\n"
-                f"3. Update RABBITMQ_USER and RABBITMQ_PASS in rabbitmq_manager.py"
-            )
-        except pika.exceptions.AMQPConnectionError as e:
-            raise Exception(
-                f"Cannot connect to RabbitMQ at {RABBITMQ_HOST}:5672\n\n"
-                f"Please check:\n"
-                f"1. RabbitMQ is running\n"
-                f"2. Firewall allows port 5672\n"
-                f"3. RabbitMQ is listening on 0.0.0.0:5672\n\n"
-                f"Error: {e}"
-            )
-    
-    def _recreate_channel(self):
-        """Recreate channel if it was closed"""
-        try:
-            if self.conn and self.conn.is_open:
-                self.channel = self.conn.channel()
-                self.channel.basic_qos(prefetch_count=10)
-                self.channel.queue_declare(queue=self.queue_name, durable=True)
-                print("✓ Channel recreated")
-            else:
-                self._connect()
-        except Exception as e:
-            print(f"Failed to recreate channel: {e}")
-            self._connect()
-    
-    def _close_connection_internal(self):
-        """Internal method to close connection"""
-        try:
-            if self.channel and self.channel.is_open:
-                self.channel.close()
-        except:
-            pass
+    def _deliver(self, kind, target, payload):
+        """Publish with retries - reconnect backoff happens in get_channel"""
+        for attempt in range(3):
+            try:
+                with self._lock:
+                    if kind == 'presence':
+                        self._publish_presence(payload)
+                    else:
+                        self._send_message_internal(target, payload)
+                return True
+            except TransportClosed:
+                break
+            except QueueUnavailable as e:
+                log.warning("%s", e)  # Retrying now would get the same answer
+                break
+            except Exception as e:
+                log.warning("Send attempt %d failed: %s", attempt + 1, e)
         
-        try:
-            if self.conn and self.conn.is_open:
-                self.conn.close()
-        except:
-            pass
+        # Messages stay in the outbox and go out on the next start
+        SEND_FAILURES.inc()
+        log.error("Failed to send %s to %s", kind, target)
+        if kind == 'message' and self.on_undelivered:
+            self.on_undelivered(target)
+        return False
+    
+    def _replay_outbox(self, acked):
+        """Publish outbox rows written before this run, oldest first"""
+        last_id = 0
+        while last_id < self._replay_upto and not self._stopping.is_set():
+            rows = self._outbox.pending(after_id=last_id)
+            if not rows:
+                break
+            for row_id, recipient, priority, body in rows:
+                if row_id > self._replay_upto:
+                    return
+                last_id = row_id
+                if self._deliver('message', recipient, body):
+                    acked.append(row_id)
+                    OUTBOX_REPLAYED.inc()
+            self._outbox.remove(acked)
+            acked.clear()
         
-        self.channel = None
-        self.conn = None
+        if last_id:
+            log.info("Outbox replay finished")
     
-    def _ensure_connection(self):
-        """Ensure connection is alive, reconnect if needed"""
-        try:
-            if self.conn is None or self.conn.is_closed:
-                print("Connection is closed, reconnecting...")
-                self._connect()
-            elif self.channel is None or self.channel.is_closed:
-                print("Channel is closed, recreating...")
-                self._recreate_channel()
-            else:
-                # Test connection by sending heartbeat
-                try:
-                    self.conn.process_data_events(time_limit=0)
-                except:
-                    print("Connection test failed, reconnecting...")
-                    self._connect()
-        except Exception as e:
-            print(f"Connection check error: {e}")
-            self._connect()
+    def _declare_publisher(self, node, channel):
+        """Topology needed before publishing - re-run after every reconnect"""
+        # Create presence exchange
+        channel.exchange_declare(
+            exchange='chat_presence',
+            exchange_type='fanout',
+            durable=False
+        )
+        _declare_dead_letter(channel)
+        self._declared_queues[node] = set()
     
-    def send_message(self, to_user, encrypted_msg):
-        """Queue message for sending (non-blocking)"""
-        self._send_queue.put((to_user, encrypted_msg))
+    def send_message(self, to_user, encrypted_msg, priority=PRIORITY_CHAT):
+        """Queue message for sending - blocks while the queue is full, raises SendQueueFull after SEND_TIMEOUT"""
+        # Framed once, so a replay after a crash keeps the same message id
+        body = pack_message(self.username, encrypted_msg)
+        # Bulk (file chunks) skips the outbox - transfers resume from the receiver's ack instead
+        row_id = None if priority == PRIORITY_BULK else self._outbox.add(to_user, priority, body)
+        try:
+            self._send_queue.put(('message', to_user, (row_id, body)), priority, timeout=SEND_TIMEOUT)
+        except (SendQueueFull, SendQueueClosed):
+            if row_id is not None:
+                self._outbox.remove([row_id])  # The caller sees the rejection
+            SEND_REJECTED.inc()
+            raise
+        SEND_QUEUE_DEPTH.set(len(self._send_queue))
     
-    def _send_message_internal(self, to_user, encrypted_msg):
-        """Internal method to actually send message"""
-        with self._lock:
-            self._ensure_connection()
-            
-            to_queue = f"user_{to_user}"
-            
-            # Declare recipient's queue
-            self.channel.queue_declare(queue=to_queue, durable=True)
-            
-            message = json.dumps({
-                'from': self.username,
-                'message': encrypted_msg.hex()
-            })
-            
-            self.channel.basic_publish(
-                exchange='',
-                routing_key=to_queue,
-                body=message,
-                properties=pika.BasicProperties(
-                    delivery_mode=2,  # Make message persistent
-                    content_type='application/json'
-                )
-            )
+    def _send_message_internal(self, to_user, message):
+        """Internal method to actually send a framed message (send worker thread)"""
+        with PUBLISH_SECONDS.time():
+            node, channel = self._publish_channel(to_user)
             
-            print(f"✓ Message sent to {to_user}")
-    
-    def listen(self, callback):
-        """Listen for incoming messages with improved error handling"""
-        self.consuming = True
-        consecutive_errors = 0
-        max_consecutive_errors = 10
-        
-        while self.consuming:
             try:
-                with self._lock:
-                    self._ensure_connection()
+                # Declare recipient's queue once per connection - on its owning node
+                to_queue = f"user_{to_user}"
+                declared = self._declared_queues[node]
+                if to_queue not in declared:
+                    _declare_user_queue(channel, to_queue)
+                    declared.add(to_queue)
                 
-                def safe_callback(ch, method, properties, body):
-                    try:
-                        callback(ch, method, properties, body)
-                    except Exception as e:
-                        print(f"Error in message callback: {e}")
-                        import traceback
-                        traceback.print_exc()
-                
-                # Set up consumer
-                consumer_tag = self.channel.basic_consume(
-                    queue=self.queue_name,
-                    on_message_callback=safe_callback,
-                    auto_ack=True
+                channel.basic_publish(
+                    exchange='',
+                    routing_key=to_queue,
+                    body=message,
+                    properties=pika.BasicProperties(
+                        delivery_mode=2,  # Make message persistent
+                        content_type=CONTENT_TYPE,
+                        timestamp=int(time.time())  # For consumer lag
+                    )
                 )
-                
-                print(f"✓ Listening on queue: {self.queue_name}")
-                consecutive_errors = 0
-                
-                # Process events
-                while self.consuming:
-                    try:
-                        self.conn.process_data_events(time_limit=1)
-                        
-                        # Check if connection is still alive
-                        if self.conn.is_closed:
-                            print("⚠️ Connection closed during listening")
-                            break
-                        
-                        self._last_heartbeat = time.time()
-                        
-                    except KeyboardInterrupt:
-                        print("Interrupted by user")
-                        self.consuming = False
-                        break
-                    except Exception as e:
-                        print(f"Error during message processing: {e}")
-                        break
-                
-                # Clean up consumer
-                try:
-                    if self.channel and self.channel.is_open:
-                        self.channel.basic_cancel(consumer_tag)
-                except:
-                    pass
-                    
+            except QueueUnavailable:
+                raise  # Our connection is fine - only the queue's node is down
             except Exception as e:
-                consecutive_errors += 1
-                print(f"Listen error ({consecutive_errors}/{max_consecutive_errors}): {e}")
-                
-                if consecutive_errors >= max_consecutive_errors:
-                    print("❌ Too many consecutive errors, stopping listener")
+                self._publishers[node].mark_lost(e)
+                raise
+            
+            MESSAGES_SENT.inc()
+            log.debug("Message sent to %s", to_user)
+    
+    def _consume(self, supervisor):
+        """Pump a consumer connection on this thread until close, reconnecting on loss"""
+        try:
+            while not self._stopping.is_set():
+                try:
+                    supervisor.get_channel()
+                    supervisor.conn.process_data_events(time_limit=1)
+                except TransportClosed:
                     break
-                
-                if self.consuming:
-                    wait_time = min(5, consecutive_errors)
-                    print(f"Reconnecting in {wait_time} seconds...")
-                    time.sleep(wait_time)
-                else:
+                except KeyboardInterrupt:
+                    log.info("Interrupted by user")
                     break
+                except Exception as e:
+                    if self._stopping.is_set():
+                        break
+                    supervisor.mark_lost(e)
+        finally:
+            supervisor.close()
     
-    def announce_presence(self, status='online'):
-        """Announce user presence (online/offline)"""
-        max_retries = 3
+    def listen(self, callback):
+        """Listen for incoming messages (blocks until close), callback(body)"""
+        def on_message(ch, method, properties, body):
+            MESSAGES_RECEIVED.inc()
+            if properties is not None and properties.timestamp:
+                CONSUMER_LAG_SECONDS.observe(max(0, time.time() - properties.timestamp))
+            try:
+                callback(body)
+            except Exception:
+                log.exception("Error in message callback")
         
-        for retry in range(max_retries):
+        def setup(channel):
+            # Set QoS to prevent overwhelming
+            channel.basic_qos(prefetch_count=10)
+            _declare_user_queue(channel, self.queue_name)
+            channel.basic_consume(queue=self.queue_name, on_message_callback=on_message, auto_ack=True)
+            log.info("Listening on queue: %s", self.queue_name)
+        
+        # Consume on the node owning our queue; fail over in ring order
+        nodes = self._ring.nodes_for(self.username)
+        self._consume(ConnectionSupervisor(
+            "consumer", lambda: open_first(nodes), setup, self._stopping
+        ))
+    
+    def listen_presence(self, callback):
+        """
+        Listen for presence announcements (blocks until close)
+        callback(user, status, instance) runs on the calling thread
+        """
+        def on_presence(ch, method, properties, body):
             try:
-                with self._lock:
-                    self._ensure_connection()
-                    
-                    message = json.dumps({
-                        'user': self.username,
-                        'status': status
-                    })
-                    
-                    self.channel.basic_publish(
-                        exchange='chat_presence',
-                        routing_key='',
-                        body=message,
-                        properties=pika.BasicProperties(
-                            delivery_mode=1,
-                            content_type='application/json'
-                        )
-                    )
-                    return
-                    
+                data = json.loads(body.decode())
+                callback(data['user'], data['status'], data.get('instance'))
             except Exception as e:
-                print(f"Presence announcement error (attempt {retry + 1}): {e}")
-                if retry < max_retries - 1:
-                    time.sleep(0.5)
+                log.warning("Error processing presence: %s", e)
+        
+        def setup(channel):
+            # Bind a fresh exclusive queue to the presence exchange
+            channel.exchange_declare(exchange='chat_presence', exchange_type='fanout')
+            result = channel.queue_declare(queue='', exclusive=True)
+            queue_name = result.method.queue
+            channel.queue_bind(exchange='chat_presence', queue=queue_name)
+            channel.basic_consume(queue=queue_name, on_message_callback=on_presence, auto_ack=True)
+            log.info("Listening for presence updates...")
+        
+        # Separate connection so presence never waits on the message channel
+        nodes = self._ring.nodes_for(self.username)
+        self._consume(ConnectionSupervisor(
+            "presence", lambda: open_first(nodes, heartbeat=600), setup, self._stopping
+        ))
+    
+    def announce_presence(self, status='online'):
+        """Announce user presence (online/offline) ahead of queued chat messages"""
+        try:
+            self._send_queue.put(('presence', None, status), PRIORITY_CONTROL)
+        except SendQueueClosed:
+            log.debug("Not announcing %s, connection is closing", status)
+    
+    def _publish_presence(self, status):
+        """Publish a presence announcement to the fanout exchange"""
+        node, channel = self._publish_channel(self.username)
+        
+        message = json.dumps({
+            'user': self.username,
+            'status': status,
+            'instance': self.instance_id
+        })
+        
+        try:
+            channel.basic_publish(
+                exchange='chat_presence',
+                routing_key='',
+                body=message,
+                properties=pika.BasicProperties(
+                    delivery_mode=1,
+                    content_type='application/json'
+                )
+            )
+        except Exception as e:
+            self._publishers[node].mark_lost(e)
+            raise
     
     def close(self):
         """Close RabbitMQ connection gracefully"""
-        print("Closing RabbitMQ connection...")
-        self.consuming = False
+        log.info("Closing RabbitMQ connection...")
         
-        # Stop send worker
+        # Stop send worker once queued messages are out
+        self._send_queue.close()
         if self._send_thread and self._send_thread.is_alive():
-            self._send_queue.put(None)  # Shutdown signal
             self._send_thread.join(timeout=3)
+        if not self._send_thread.is_alive():
+            self._outbox.close()  # Anything undelivered is replayed next start
         
-        # Announce offline status
+        # Announce offline status after the last chat message
         try:
-            self.announce_presence('offline')
-            time.sleep(0.2)
+            with self._lock:
+                if any(publisher.connected for publisher in self._publishers.values()):
+                    self._publish_presence('offline')
         except Exception as e:
-            print(f"Error announcing offline status: {e}")
+            log.warning("Error announcing offline status: %s", e)
         
-        # Close connection
+        # Listener threads see this within a second and close their own connections
+        self._stopping.set()
         with self._lock:
-            self._close_connection_internal()
+            for publisher in self._publishers.values():
+                publisher.close()
         
-        print("✓ RabbitMQ connection closed")
\ No newline at end of file
+        log.info("RabbitMQ connection closed")
\ No newline at end of file
@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import deque
+
+# Priority classes, drained in this order
+PRIORITY_CONTROL = 0  # presence and other small control messages
+PRIORITY_CHAT = 1     # 1:1 and group messages
+PRIORITY_BULK = 2     # file chunks and other large transfers
+
+PRIORITY_NAMES = {PRIORITY_CONTROL: "control", PRIORITY_CHAT: "chat", PRIORITY_BULK: "bulk"}
+
+# Per-class capacity. Control is unbounded - it is a handful of tiny
+# messages and must never be starved or rejected by chat traffic
+DEFAULT_LIMITS = {PRIORITY_CONTROL: None, PRIORITY_CHAT: 1000, PRIORITY_BULK: 500}
+
+class SendQueueFull(Exception):
+    """The outbound queue stayed full for the whole timeout"""
+
+class SendQueueClosed(Exception):
+    """The outbound queue no longer accepts messages"""
+
+class SendQueue:
+    """
+    Bounded outbound queue with priority classes
+    put() blocks while its class is full (backpressure) and raises
+    SendQueueFull after timeout; get() always returns the highest priority item.
+    """
+    def __init__(self, limits=None):
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self._queues = {priority: deque() for priority in self.limits}
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self.closed = False
+    
+    def put(self, item, priority=PRIORITY_CHAT, timeout=None):
+        """Add item, waiting up to timeout seconds for room (0 = reject at once)"""
+        queue = self._queues[priority]
+        limit = self.limits[priority]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        
+        with self._not_full:
+            while not self.closed and limit is not None and len(queue) >= limit:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise SendQueueFull(
+                        f"Send queue full ({limit} {PRIORITY_NAMES.get(priority, priority)} messages waiting)"
+                    )
+                self._not_full.wait(remaining)
+            
+            if self.closed:
+                raise SendQueueClosed("Send queue is closed")
+            queue.append(item)
+            self._not_empty.notify()
+    
+    def get(self, timeout=None):
+        """Remove and return (priority, item); None once closed and drained or on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        
+        with self._not_empty:
+            while True:
+                for priority in sorted(self._queues):
+                    queue = self._queues[priority]
+                    if queue:
+                        item = queue.popleft()
+                        self._not_full.notify_all()
+                        return priority, item
+                
+                if self.closed:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._not_empty.wait(remaining)
+    
+    def close(self):
+        """Stop accepting items; get() drains what is left, then returns None"""
+        with self._lock:
+            self.closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+    
+    def depth(self, priority=None):
+        """Items waiting in one class, or in total"""
+        with self._lock:
+            if priority is not None:
+                return len(self._queues[priority])
+            return sum(len(queue) for queue in self._queues.values())
+    
+    def __len__(self):
+        return self.depth()
\ No newline at end of file
@@ -0,0 +1,460 @@
+import os
+import sqlite3
+import struct
+import threading
+import time
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from crypto_manager import (encrypt_bytes, decrypt_bytes, decrypt,
+                            authenticate, verify_authenticator, can_authenticate, is_x25519)
+from compression import compress, decompress, CODEC_NONE
+import metrics
+
+# Envelope types (first byte of every session message)
+SESSION_KEY = 0x01         # Wrapped session key followed by a message
+SESSION_DATA = 0x02        # Message under an already established session (older senders)
+SESSION_KEY_SIGNED = 0x03  # SESSION_KEY plus its creation time and the sender's signature (or X25519 MAC)
+
+# Top bits of the type byte say where the message goes, so a receiver can
+# file it without decrypting. Covered by the AAD like the rest of the header
+ROUTE_NONE = 0x00     # Unknown (older sender) - decrypt to find out
+ROUTE_CHAT = 0x40     # 1:1 conversation
+ROUTE_GROUP = 0x80    # Group chat
+ROUTE_CONTROL = 0xC0  # Client-to-client control (file offers and acks)
+ROUTE_MASK = 0xC0
+TYPE_MASK = 0x3F
+
+# Refuse unauthenticated sessions and pre-session messages from peers whose
+# keys could have authenticated them (CHAT_REQUIRE_AUTHENTICATED=0 accepts them).
+# Those that could not be (X25519 sender, RSA recipient) are accepted but
+# reported as unverified - CHAT_ACCEPT_UNVERIFIED=0 refuses them too
+REQUIRE_AUTHENTICATED = os.environ.get("CHAT_REQUIRE_AUTHENTICATED", "1") == "1"
+ACCEPT_UNVERIFIED = os.environ.get("CHAT_ACCEPT_UNVERIFIED", "1") == "1"
+
+# Rotate a peer's session key after this many messages or seconds
+SESSION_MAX_MESSAGES = 1000
+SESSION_MAX_AGE = 3600
+
+# Inbound sessions kept per peer (current + previous for in-flight messages)
+MAX_INBOUND_PER_PEER = 2
+
+# Inbound session keys are also kept on disk (InboundKeyStore) for as long
+# as their messages can wait in our queue, with the highest accepted counter
+# saved every INBOUND_SAVE_EVERY messages and when a session leaves memory
+INBOUND_KEY_TTL = 7 * 24 * 3600
+INBOUND_SAVE_EVERY = 100
+
+# A signed session key older than this is refused: its session would have
+# been kept (with its replay counter) in the key store until then, so an
+# older key message can only be a replay
+SESSION_KEY_MAX_AGE = INBOUND_KEY_TTL
+
+# Messages may arrive out of order (the send queue drains chat before bulk),
+# so accept any unseen counter up to this far behind the highest one
+REPLAY_WINDOW = 1024
+
+HEADER = struct.Struct(">B8s")   # envelope type, session id
+KEY_TIME = struct.Struct(">Q")    # signed session key creation time (unix seconds)
+KEY_LENGTH = struct.Struct(">H")  # wrapped session key length
+AUTH_LENGTH = struct.Struct(">H") # signature / MAC length
+COUNTER = struct.Struct(">Q")     # message counter, also the AES-GCM nonce
+
+ENCRYPT_SECONDS = metrics.histogram("chat_encrypt_seconds", "Time to encrypt one chat message")
+DECRYPT_SECONDS = metrics.histogram("chat_decrypt_seconds", "Time to decrypt one chat message")
+SESSIONS_STARTED = metrics.counter("chat_sessions_started_total", "Outbound sessions established (asymmetric key wraps)")
+SESSIONS_REJECTED = metrics.counter("chat_sessions_rejected_total", "Inbound sessions refused (bad or missing sender signature)")
+
+class _OutboundSession:
+    """Session key we use to send to one peer"""
+    def __init__(self, session_id, key, wrapped_key, key_header):
+        self.session_id = session_id
+        self.aead = AESGCM(key)
+        self.wrapped_key = wrapped_key
+        self.key_header = key_header  # Envelope header of every message
+        self.counter = 0
+        self.created = time.monotonic()
+    
+    def expired(self):
+        """Check if the key must be rotated"""
+        return (self.counter >= SESSION_MAX_MESSAGES or
+                time.monotonic() - self.created >= SESSION_MAX_AGE)
+
+class _InboundSession:
+    """Session key a peer uses to send to us (verified: the sender's key vouched for it)"""
+    def __init__(self, key, last_counter=0, verified=True):
+        self.aead = AESGCM(key)
+        self.verified = verified
+        self.last_counter = last_counter  # Highest counter accepted
+        # Bit i set: counter last_counter - i was accepted. A session restored
+        # from disk treats everything up to its saved counter as seen
+        self.seen = (1 << REPLAY_WINDOW) - 1 if last_counter else 0
+        self.saved_counter = last_counter
+    
+    def is_replay(self, counter):
+        """Check counter against the sliding anti-replay window"""
+        if counter > self.last_counter:
+            return False
+        offset = self.last_counter - counter
+        return offset >= REPLAY_WINDOW or bool(self.seen >> offset & 1)
+    
+    def accept(self, counter):
+        """Record an authenticated counter"""
+        if counter > self.last_counter:
+            shift = counter - self.last_counter
+            # A jump past the window forgets it all - never shift by a huge counter
+            self.seen = (self.seen << shift | 1) & ((1 << REPLAY_WINDOW) - 1) if shift < REPLAY_WINDOW else 1
+            self.last_counter = counter
+        else:
+            self.seen |= 1 << (self.last_counter - counter)
+
+def _nonce(counter):
+    """96-bit GCM nonce from the per-session message counter"""
+    return bytes(4) + COUNTER.pack(counter)
+
+def route_of(data):
+    """Routing hint of a session message (ROUTE_NONE for anything else)"""
+    if not data or data[0] & TYPE_MASK not in (SESSION_KEY, SESSION_DATA, SESSION_KEY_SIGNED):
+        return ROUTE_NONE
+    return data[0] & ROUTE_MASK
+
+class SealedMessage:
+    """
+    Session message not yet decrypted - open() decrypts it
+    Holds the session's cipher, so it stays readable after the session is
+    rotated out. The GCM tag is checked by open(), not on arrival, so only
+    open() records the counter (on_open) - a forgery cannot use it up.
+    """
+    __slots__ = ('aead', 'counter', 'aad', 'cipher_text', 'verified', 'on_open')
+    
+    def __init__(self, aead, counter, aad, cipher_text, verified=True, on_open=None):
+        self.aead = aead
+        self.counter = counter
+        self.aad = aad
+        self.cipher_text = cipher_text
+        self.verified = verified
+        self.on_open = on_open  # counter -> None, raises if it was already accepted
+    
+    def __len__(self):
+        return len(self.cipher_text)
+    
+    @DECRYPT_SECONDS.time()
+    def open(self):
+        plain = self.aead.decrypt(_nonce(self.counter), self.cipher_text, self.aad)
+        if self.on_open is not None:
+            self.on_open(self.counter)
+        return decompress(plain[0], plain[1:]).decode('utf-8')
+
+class InboundKeyStore:
+    """
+    Inbound session keys on local disk, so messages still queued under a
+    session can be read after a restart. Keys are kept as they arrived -
+    wrapped with our own public key - with the highest counter accepted.
+    path ":memory:" keeps them for the life of the process only.
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS inbound_sessions ("
+            " peer TEXT NOT NULL,"
+            " session_id BLOB NOT NULL,"
+            " wrapped_key BLOB NOT NULL,"
+            " last_counter INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " verified INTEGER NOT NULL DEFAULT 1,"
+            " PRIMARY KEY (peer, session_id))"
+        )
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(inbound_sessions)")]
+        if 'verified' not in columns:
+            self._db.execute("ALTER TABLE inbound_sessions ADD COLUMN verified INTEGER NOT NULL DEFAULT 1")
+        self._db.execute("DELETE FROM inbound_sessions WHERE created < ?", (time.time() - INBOUND_KEY_TTL,))
+    
+    @classmethod
+    def for_user(cls, username):
+        """Default key store for a user, next to its outbox"""
+        import outbox
+        outbox.OUTBOX_PATH.mkdir(parents=True, exist_ok=True)
+        return cls(outbox.OUTBOX_PATH / f"sessions_{username}.db")
+    
+    def add(self, peer, session_id, wrapped_key, verified=True):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO inbound_sessions VALUES (?, ?, ?, 0, ?, ?)",
+                (peer, bytes(session_id), bytes(wrapped_key), time.time(), int(verified))
+            )
+    
+    def get(self, peer, session_id):
+        """(wrapped key, last accepted counter, verified) or None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT wrapped_key, last_counter, verified FROM inbound_sessions WHERE peer = ? AND session_id = ?",
+                (peer, bytes(session_id))
+            ).fetchone()
+        return row and (row[0], row[1], bool(row[2]))
+    
+    def save_counters(self, rows):
+        """Record (peer, session id, last counter) rows in one transaction"""
+        if not rows:
+            return
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "UPDATE inbound_sessions SET last_counter = MAX(last_counter, ?) WHERE peer = ? AND session_id = ?",
+                [(counter, peer, bytes(session_id)) for peer, session_id, counter in rows]
+            )
+            self._db.execute("COMMIT")
+    
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class SessionManager:
+    """
+    Per-peer symmetric sessions on top of crypto_manager
+    The first message to a peer carries a fresh AES-256 key wrapped with the
+    peer's public key (RSA or X25519) and signed with ours; every later
+    message is AES-GCM only. The AAD names sender and recipient, so once the
+    key is authenticated every message under it is too - one signature
+    check per session, not per message. Inbound sessions are kept in
+    key_store (in memory by default) once evicted, so their replay counters
+    outlive them; an InboundKeyStore on disk also survives a restart.
+    """
+    def __init__(self, username, priv_path, pubkey_resolver, key_store=None):
+        self.username = username
+        self.priv_path = priv_path
+        self.pubkey_resolver = pubkey_resolver  # username -> public key bytes or None
+        self.key_store = key_store if key_store is not None else InboundKeyStore(":memory:")
+        self._outbound = {}  # peer -> _OutboundSession
+        self._inbound = {}   # peer -> {session id: _InboundSession}
+        self._no_compression = set()  # Peers whose conversation opted out
+        self._lock = threading.Lock()
+    
+    def _aad(self, header, sender, recipient):
+        """Bind the envelope header and both usernames to the ciphertext"""
+        return bytes(header) + f"{sender}>{recipient}".encode('utf-8')
+    
+    def _new_outbound(self, peer):
+        """Start a new session with peer - the only asymmetric operation"""
+        pub_key = self.pubkey_resolver(peer)
+        if pub_key is None:
+            raise ValueError(f"Certificate not found for {peer}")
+        
+        key = AESGCM.generate_key(bit_length=256)
+        session_id = os.urandom(8)
+        wrapped_key = encrypt_bytes(key, pub_key)
+        
+        # Sign type, session id, creation time, wrapped key and both names
+        key_part = (HEADER.pack(SESSION_KEY_SIGNED, session_id) + KEY_TIME.pack(int(time.time())) +
+                    KEY_LENGTH.pack(len(wrapped_key)) + wrapped_key)
+        signature = authenticate(self._aad(key_part, self.username, peer), self.priv_path, pub_key)
+        if signature is not None:
+            key_header = key_part + AUTH_LENGTH.pack(len(signature)) + signature
+        else:
+            # X25519 sender, RSA recipient - no way to authenticate
+            key_header = HEADER.pack(SESSION_KEY, session_id) + KEY_LENGTH.pack(len(wrapped_key)) + wrapped_key
+        
+        session = _OutboundSession(session_id, key, wrapped_key, key_header)
+        self._outbound[peer] = session
+        SESSIONS_STARTED.inc()
+        return session
+    
+    def set_compression(self, peer, enabled):
+        """Opt a conversation in or out of pre-encryption compression"""
+        if enabled:
+            self._no_compression.discard(peer)
+        else:
+            self._no_compression.add(peer)
+    
+    @ENCRYPT_SECONDS.time()
+    def encrypt(self, peer, msg, route=ROUTE_NONE):
+        """Encrypt message for peer, establishing or rotating the session as needed"""
+        # Plaintext is codec byte + payload; compression must happen before encryption
+        if peer in self._no_compression:
+            codec, payload = CODEC_NONE, msg.encode('utf-8')
+        else:
+            codec, payload = compress(msg.encode('utf-8'))
+        plain = bytes([codec]) + payload
+        
+        with self._lock:
+            session = self._outbound.get(peer)
+            if session is None or session.expired():
+                session = self._new_outbound(peer)
+            
+            session.counter += 1
+            counter = session.counter
+            
+            # Every message carries the wrapped key: the broker drops the oldest
+            # messages of a full or expired queue (drop-head, message TTL), so
+            # the first one cannot be the only way into the session
+            header = bytes([session.key_header[0] | route]) + session.key_header[1:] + COUNTER.pack(counter)
+        
+        aad = self._aad(header, self.username, peer)
+        return header + session.aead.encrypt(_nonce(counter), plain, aad)
+    
+    def decrypt(self, peer, data):
+        """Decrypt message from peer (falls back to plain crypto_manager messages)"""
+        return self.decrypt_verified(peer, data)[0]
+    
+    @DECRYPT_SECONDS.time()
+    def decrypt_verified(self, peer, data):
+        """(text, verified) - verified is False if nothing proved peer sent it"""
+        if not data or data[0] & TYPE_MASK not in (SESSION_KEY, SESSION_DATA, SESSION_KEY_SIGNED):
+            return self._decrypt_legacy(peer, data), False
+        
+        try:
+            return self._decrypt_session(peer, data)
+        except Exception:
+            # A pre-session client's raw ciphertext can start with a type byte
+            try:
+                return self._decrypt_legacy(peer, data), False
+            except Exception:
+                pass
+            raise
+    
+    def seal(self, peer, data):
+        """
+        Take a session message from peer without decrypting it, return a
+        SealedMessage. Session keys are still unwrapped and authenticated
+        here (they may be rotated out before the message is read); the
+        counter is only checked against the replay window until opened
+        """
+        return self._decrypt_session(peer, data, defer=True)
+    
+    def _accept_opened(self, peer, session_id, session, counter):
+        """Record the counter of a SealedMessage whose tag checked out"""
+        with self._lock:
+            if session.is_replay(counter):
+                raise ValueError(f"Replayed message from {peer}")
+            session.accept(counter)
+            # An evicted session's counter is only kept in the key store
+            evicted = self._inbound.get(peer, {}).get(session_id) is not session
+            if evicted or session.last_counter - session.saved_counter >= INBOUND_SAVE_EVERY:
+                self._save_counters([(peer, session_id, session)])
+    
+    def _require_authentication(self, peer):
+        """Check if peer's key and ours could authenticate a session"""
+        if not REQUIRE_AUTHENTICATED:
+            return False
+        pub_key = self.pubkey_resolver(peer)
+        if pub_key is None:
+            return True
+        return can_authenticate(is_x25519(pub_key), is_x25519(self.priv_path))
+    
+    def _decrypt_legacy(self, peer, data):
+        """Pre-session message (public key encryption only, nothing proves the sender)"""
+        if self._require_authentication(peer) or not ACCEPT_UNVERIFIED:
+            raise ValueError(f"Unauthenticated message from {peer} refused")
+        return decrypt(data, self.priv_path)
+    
+    def _decrypt_session(self, peer, data, defer=False):
+        """(text, verified) of a SESSION_KEY or SESSION_DATA envelope (defer: a SealedMessage)"""
+        kind, session_id = HEADER.unpack_from(data)
+        kind &= TYPE_MASK
+        pos = HEADER.size
+        # Looked up outside the lock - it may ask the key directory. Not needed
+        # for a session we hold (an evicted one is restored from the key store)
+        known = session_id in self._inbound.get(peer, ())
+        pub_key = self.pubkey_resolver(peer) if kind == SESSION_KEY_SIGNED and not known else None
+        
+        with self._lock:
+            sessions = self._inbound.setdefault(peer, {})
+            
+            if kind in (SESSION_KEY, SESSION_KEY_SIGNED):
+                if kind == SESSION_KEY_SIGNED:
+                    (created,) = KEY_TIME.unpack_from(data, pos)
+                    pos += KEY_TIME.size
+                (key_length,) = KEY_LENGTH.unpack_from(data, pos)
+                pos += KEY_LENGTH.size
+                wrapped_key = data[pos:pos + key_length]
+                pos += key_length
+                
+                if kind == SESSION_KEY_SIGNED:
+                    (auth_length,) = AUTH_LENGTH.unpack_from(data, pos)
+                    # Signed without the routing bits - one key header serves every route
+                    signed = self._aad(bytes([kind]) + bytes(data[1:pos]), peer, self.username)
+                    signature = data[pos + AUTH_LENGTH.size:pos + AUTH_LENGTH.size + auth_length]
+                    pos += AUTH_LENGTH.size + auth_length
+                
+                if session_id not in sessions and self._restore(peer, sessions, session_id) is None:
+                    # Only a session the sender's certified key vouches for is accepted
+                    if kind == SESSION_KEY_SIGNED:
+                        if pub_key is None or not verify_authenticator(signed, signature, self.priv_path, pub_key):
+                            SESSIONS_REJECTED.inc()
+                            raise ValueError(f"Bad sender signature on session from {peer}")
+                        if time.time() - created > SESSION_KEY_MAX_AGE:
+                            # Its session left the key store long ago - a replay
+                            SESSIONS_REJECTED.inc()
+                            raise ValueError(f"Expired session key from {peer} refused")
+                    elif self._require_authentication(peer) or not ACCEPT_UNVERIFIED:
+                        SESSIONS_REJECTED.inc()
+                        raise ValueError(f"Unauthenticated session from {peer} refused")
+                    
+                    verified = kind == SESSION_KEY_SIGNED
+                    key = decrypt_bytes(wrapped_key, self.priv_path)
+                    self.key_store.add(peer, session_id, wrapped_key, verified)
+                    self._add_inbound(peer, sessions, session_id, _InboundSession(key, verified=verified))
+            
+            session = sessions.get(session_id) or self._restore(peer, sessions, session_id)
+            if session is None:
+                raise ValueError(f"Unknown session from {peer} (key message missed)")
+            
+            (counter,) = COUNTER.unpack_from(data, pos)
+            pos += COUNTER.size
+            if session.is_replay(counter):
+                raise ValueError(f"Replayed message from {peer}")
+            
+            aad = self._aad(data[:pos], peer, self.username)
+            if defer:
+                # Authenticated and counted when opened - a forgery fails then
+                on_open = lambda counter: self._accept_opened(peer, session_id, session, counter)
+                return SealedMessage(session.aead, counter, aad, bytes(data[pos:]), session.verified, on_open)
+            plain = session.aead.decrypt(_nonce(counter), data[pos:], aad)
+            session.accept(counter)
+            if session.last_counter - session.saved_counter >= INBOUND_SAVE_EVERY:
+                self._save_counters([(peer, session_id, session)])
+        
+        return decompress(plain[0], plain[1:]).decode('utf-8'), session.verified
+    
+    def _add_inbound(self, peer, sessions, session_id, session):
+        """Keep session in memory, evicting (and saving) the oldest from this peer"""
+        sessions[session_id] = session
+        evicted = []
+        while len(sessions) > MAX_INBOUND_PER_PEER:
+            old_id = next(iter(sessions))
+            evicted.append((peer, old_id, sessions.pop(old_id)))
+        self._save_counters(evicted)
+    
+    def _restore(self, peer, sessions, session_id):
+        """Bring a session back from the key store (caller holds the lock), or None"""
+        stored = self.key_store.get(peer, session_id)
+        if stored is None:
+            return None
+        wrapped_key, last_counter, verified = stored
+        session = _InboundSession(decrypt_bytes(wrapped_key, self.priv_path), last_counter, verified)
+        self._add_inbound(peer, sessions, session_id, session)
+        return session
+    
+    def _save_counters(self, entries):
+        """Persist (peer, session id, session) replay counters"""
+        rows = []
+        for peer, session_id, session in entries:
+            if session.last_counter > session.saved_counter:
+                rows.append((peer, session_id, session.last_counter))
+                session.saved_counter = session.last_counter
+        self.key_store.save_counters(rows)
+    
+    def close(self):
+        """Save replay counters and close the key store"""
+        with self._lock:
+            self._save_counters([
+                (peer, session_id, session)
+                for peer, sessions in self._inbound.items()
+                for session_id, session in sessions.items()
+            ])
+            self.key_store.close()
+    
+    def reset_peer(self, peer):
+        """Drop our sending session with peer (e.g. they restarted and lost it)"""
+        with self._lock:
+            self._outbound.pop(peer, None)
\ No newline at end of file
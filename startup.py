@@ -0,0 +1,49 @@
+import os
+import time
+from contextlib import contextmanager
+
+from logger import get_logger
+
+# Imported first by main.py, so this is (close to) process start
+_START = time.perf_counter()
+
+# CHAT_PROFILE_STARTUP=1 logs every startup step as it happens;
+# CHAT_STARTUP_EXIT=1 quits once the first window is drawn (for benchmarks)
+PROFILE = os.environ.get("CHAT_PROFILE_STARTUP") == "1"
+EXIT_AFTER_FIRST_WINDOW = os.environ.get("CHAT_STARTUP_EXIT") == "1"
+
+log = get_logger("startup")
+
+_marks = []   # (name, seconds since start)
+_phases = []  # (name, duration in seconds)
+
+def mark(name):
+    """Record that startup reached a point"""
+    elapsed = time.perf_counter() - _START
+    _marks.append((name, elapsed))
+    if PROFILE:
+        log.info("%-28s at %8.1f ms", name, elapsed * 1e3)
+
+@contextmanager
+def timed(name):
+    """Record how long a startup step (import, subsystem init) takes"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        _phases.append((name, duration))
+        if PROFILE:
+            log.info("%-28s took %6.1f ms", name, duration * 1e3)
+
+def marks():
+    return list(_marks)
+
+def phases():
+    return list(_phases)
+
+def report():
+    """One line per mark and phase, e.g. for CHAT_STARTUP_EXIT runs"""
+    lines = [f"mark  {name:<28}{elapsed * 1e3:>9.1f} ms" for name, elapsed in _marks]
+    lines += [f"phase {name:<28}{duration * 1e3:>9.1f} ms" for name, duration in _phases]
+    return "\n".join(lines)
\ No newline at end of file
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import key_directory
+import outbox
+import pki_manager
+
+@pytest.fixture
+def pki_path(tmp_path, monkeypatch):
+    """Empty PKI share, key directory cache and outbox under tmp_path"""
+    monkeypatch.setattr(pki_manager, "PKI_PATH", tmp_path / "pki")
+    monkeypatch.setattr(pki_manager, "KEY_PATH", tmp_path / "keys")
+    monkeypatch.setattr(pki_manager, "CA_KEY_TYPE", "ed25519")
+    monkeypatch.setattr(pki_manager, "CA_SIGNING", "local")
+    monkeypatch.setattr(key_directory, "KEY_CACHE_FILE", tmp_path / "key_cache.json")
+    monkeypatch.setattr(outbox, "OUTBOX_PATH", tmp_path / "outbox")
+    return tmp_path / "pki"
+
+@pytest.fixture
+def pki(pki_path):
+    """PKIManager signing locally with a fresh Ed25519 CA"""
+    return pki_manager.PKIManager(signing="local")
+
+@pytest.fixture
+def make_key(tmp_path):
+    """make_key(name, key_type) -> (private key path, public key DER)"""
+    from cryptography.hazmat.primitives import serialization
+    
+    def make(name, key_type="x25519"):
+        key = pki_manager.generate_key(key_type)
+        path = tmp_path / f"{name}.key"
+        path.write_bytes(key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        ))
+        return str(path), pki_manager.public_key_der(key)
+    return make
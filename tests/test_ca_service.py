@@ -0,0 +1,144 @@
+import base64
+import json
+import os
+import time
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+
+import ca_service
+import pki_manager
+import rabbitmq_manager
+from ca_service import CertificateSigner, build_request, build_challenge, seal_request, verify_challenge, CHALLENGE
+
+PASSWORDS = {"alice": "alice-pw", "bob": "bob-pw"}
+
+@pytest.fixture
+def signer(pki_path):
+    return CertificateSigner(authenticate=lambda user, password: PASSWORDS.get(user) == password)
+
+def sign(signer, body):
+    """The signing service's reply to one request"""
+    return signer.sign_batch([body])[0]
+
+def request(signer, username, key, password=None, **kwargs):
+    """Sealed request body, as request_certificate sends it"""
+    challenge = sign(signer, build_challenge(username))
+    verify_challenge(challenge, signer.ca_cert)
+    return seal_request(build_request(username, key, password, challenge, **kwargs), challenge)
+
+def test_requests_need_the_users_password(signer):
+    key = pki_manager.generate_key("rsa")
+    assert "Authentication failed" in sign(signer, request(signer, "alice", key))['error']
+    assert "Authentication failed" in sign(signer, request(signer, "alice", key, "bob-pw"))['error']
+    assert 'certificate' in sign(signer, request(signer, "alice", key, "alice-pw"))
+
+def test_requests_are_only_accepted_sealed(signer):
+    key = pki_manager.generate_key("rsa")
+    assert "must be encrypted" in sign(signer, build_request("alice", key, "alice-pw"))['error']
+    
+    body = request(signer, "alice", key, "alice-pw")
+    assert b"alice-pw" not in body
+    envelope = json.loads(body)
+    sealed = bytearray(base64.b64decode(envelope['sealed']))
+    sealed[0] ^= 1
+    envelope['sealed'] = base64.b64encode(bytes(sealed)).decode()
+    assert "could not be decrypted" in sign(signer, json.dumps(envelope).encode())['error']
+
+def test_challenge_not_signed_by_the_ca_is_refused(signer):
+    challenge = sign(signer, build_challenge("alice"))
+    impostor = ca_service.challenge_key(pki_manager.generate_key("ed25519"), base64.b64decode(challenge['challenge']))
+    challenge['public_key'] = base64.b64encode(impostor.public_key().public_bytes(
+        serialization.Encoding.Raw, serialization.PublicFormat.Raw
+    )).decode()
+    with pytest.raises(ValueError, match="not signed by the CA"):
+        verify_challenge(challenge, signer.ca_cert)
+
+def test_x25519_needs_proof_of_possession(signer):
+    key = pki_manager.generate_key("x25519")
+    challenge = sign(signer, build_challenge("alice"))
+    body = seal_request(build_request("alice", key, "alice-pw"), challenge)  # No challenge, no MAC
+    assert "proof of possession" in sign(signer, body)['error']
+    
+    # The MAC must come from the key being certified
+    forged = json.loads(build_request("alice", pki_manager.generate_key("x25519"), "alice-pw", challenge))
+    forged['public_key'] = base64.b64encode(pki_manager.public_key_der(key)).decode('ascii')
+    body = seal_request(json.dumps(forged).encode(), challenge)
+    assert "Proof of possession failed" in sign(signer, body)['error']
+    
+    assert 'certificate' in sign(signer, request(signer, "alice", key, "alice-pw"))
+
+def test_expired_challenge_is_refused(signer):
+    challenge = CHALLENGE.pack(int(time.time() - ca_service.CHALLENGE_TTL - 5), os.urandom(16))
+    public_key = ca_service.challenge_key(signer.ca_key, challenge).public_key().public_bytes(
+        serialization.Encoding.Raw, serialization.PublicFormat.Raw
+    )
+    reply = {'challenge': base64.b64encode(challenge).decode(), 'public_key': base64.b64encode(public_key).decode()}
+    body = seal_request(build_request("alice", pki_manager.generate_key("x25519"), "alice-pw", reply), reply)
+    assert "expired" in sign(signer, body)['error']
+
+def test_reissue_needs_renewal_or_approval(signer):
+    current = pki_manager.generate_key("ed25519")
+    assert 'certificate' in sign(signer, request(signer, "alice", current, "alice-pw"))
+    
+    # The password alone does not replace an existing certificate
+    assert "already has a certificate" in sign(signer, request(signer, "alice", pki_manager.generate_key("rsa"), "alice-pw"))['error']
+    stranger = pki_manager.generate_key("ed25519")
+    body = request(signer, "alice", pki_manager.generate_key("rsa"), "alice-pw", current_key=stranger)
+    assert "not signed by the current key" in sign(signer, body)['error']
+    
+    renewed = pki_manager.generate_key("x25519")
+    assert 'certificate' in sign(signer, request(signer, "alice", renewed, "alice-pw", current_key=current))
+    assert signer.pki.keystore.get("alice")[1] == pki_manager.public_key_der(renewed)
+    
+    signer.approvals.approve("alice")
+    assert 'certificate' in sign(signer, request(signer, "alice", pki_manager.generate_key("rsa"), "alice-pw"))
+    assert 'error' in sign(signer, request(signer, "alice", pki_manager.generate_key("rsa"), "alice-pw"))  # Used up
+
+def test_redelivered_request_for_the_current_key_is_answered(signer):
+    body = request(signer, "bob", pki_manager.generate_key("rsa"), "bob-pw")
+    assert 'certificate' in sign(signer, body)
+    assert 'certificate' in sign(signer, body)  # The signer died before acking it
+
+def test_one_certificate_per_user_per_batch(signer):
+    bodies = [request(signer, "bob", pki_manager.generate_key("rsa"), "bob-pw") for _ in range(2)]
+    first, second = signer.sign_batch(bodies)
+    assert 'certificate' in first and "in this batch" in second['error']
+
+class DroppingConnection:
+    """Broker connection (and channel) that fails its first poll if drop, like a broker restart"""
+    def __init__(self, signer, drop):
+        self.signer = signer
+        self.drop = drop
+        self.is_open = True
+    
+    def channel(self):
+        return self
+    
+    def queue_declare(self, queue, **kwargs):
+        pass
+    
+    def basic_qos(self, prefetch_count):
+        pass
+    
+    def basic_consume(self, queue, on_message_callback):
+        pass
+    
+    def process_data_events(self, time_limit):
+        if self.drop:
+            raise ConnectionResetError("broker restarted")
+        self.signer.stop()
+    
+    def close(self):
+        self.is_open = False
+
+def test_signer_reconnects_after_broker_failure(signer, monkeypatch):
+    connections = []
+    def connect(nodes, username=None, password=None):
+        connections.append(DroppingConnection(signer, drop=not connections))
+        return connections[-1]
+    monkeypatch.setattr(ca_service, "open_first", connect)
+    monkeypatch.setattr(rabbitmq_manager, "backoff_delay", lambda attempt: 0)
+    signer.run()
+    assert len(connections) == 2
+    assert not connections[0].is_open
@@ -0,0 +1,101 @@
+import pytest
+
+from chat_client import ChatClient, GROUP_CHAT
+from send_queue import SendQueueFull
+from transport import LoopbackHub, LoopbackTransport
+
+class FlakyTransport(LoopbackTransport):
+    """Loopback transport that rejects the next `reject` sends, like a full send queue"""
+    reject = 0
+    
+    def send_message(self, to_user, encrypted_msg, priority=None):
+        if self.reject:
+            self.reject -= 1
+            raise SendQueueFull("send queue full")
+        super().send_message(to_user, encrypted_msg)
+
+@pytest.fixture
+def clients(pki):
+    """clients(*names) -> {name: ChatClient} on one loopback hub, nothing listening"""
+    hub = LoopbackHub()
+    
+    def make(*names, key_type="x25519"):
+        result = {}
+        for name in names:
+            pki.create_user_cert(name, key_type=key_type)
+            result[name] = ChatClient(name, pki=pki, transport=FlakyTransport(hub, name))
+        return result
+    return make
+
+def deliver(client):
+    """Hand everything queued for client to its listener callback"""
+    inbox = client.transport.hub.inbox(client.username)
+    while inbox.items:
+        client._handle_message(inbox.items.popleft())
+
+def texts(client, conversation):
+    return [entry['text'] for entry in client.history(conversation)]
+
+def test_rejected_first_message_does_not_break_session(clients):
+    c = clients("alice", "bob")
+    c["alice"].transport.reject = 1
+    with pytest.raises(SendQueueFull):
+        c["alice"].send_message("bob", "lost")
+    for i in range(3):
+        c["alice"].send_message("bob", f"after {i}")
+    deliver(c["bob"])
+    assert texts(c["bob"], "alice") == ["after 0", "after 1", "after 2"]
+
+def test_unqueued_group_recipients_get_a_new_session(clients):
+    c = clients("alice", "bob", "carol")
+    c["alice"].transport.reject = 1  # publish_group stops at the first recipient
+    _, reached = c["alice"].send_group_message("lost")
+    assert reached == 0
+    c["alice"].send_group_message("again")
+    for name in ("bob", "carol"):
+        deliver(c[name])
+        assert texts(c[name], GROUP_CHAT) == ["again"]
+
+def test_undelivered_message_resets_session(clients):
+    c = clients("alice", "bob")
+    c["alice"].send_message("bob", "dropped by the broker")
+    c["alice"].transport.hub.inbox("bob").items.clear()
+    c["alice"].transport.on_undelivered("bob")  # What MQ does when it gives up
+    c["alice"].send_message("bob", "next")
+    deliver(c["bob"])
+    assert texts(c["bob"], "alice") == ["next"]
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_unverifiable_sender_is_flagged(clients, lazy):
+    alice = clients("alice", key_type="x25519")["alice"]  # X25519 cannot sign for an RSA recipient
+    bob = clients("bob", key_type="rsa")["bob"]
+    carol = clients("carol", key_type="rsa")["carol"]
+    bob.lazy_decrypt = lazy
+    alice.send_message("bob", "unsigned")
+    carol.send_message("bob", "signed")
+    deliver(bob)
+    assert [(e['text'], e.get('unverified', False)) for e in bob.history("alice")] == [("unsigned", True)]
+    assert [(e['text'], e.get('unverified', False)) for e in bob.history("carol")] == [("signed", False)]
+
+def test_lazy_message_id_is_seen_only_once_opened(clients):
+    c = clients("alice", "bob")
+    bob = c["bob"]
+    bob.lazy_decrypt = True
+    c["alice"].send_message("bob", "hello")
+    body = bob.transport.hub.inbox("bob").items[0]
+    deliver(bob)
+    bob._handle_message(body)  # Redelivered before it was read - stored once
+    message_id = bob.message_history["alice"][0]["message_id"]
+    assert message_id not in bob._seen_ids
+    assert texts(bob, "alice") == ["hello"]
+    assert message_id in bob._seen_ids
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_routing_ignores_message_text(clients, lazy):
+    c = clients("alice", "bob")
+    c["bob"].lazy_decrypt = lazy
+    c["alice"].send_message("bob", '[FILE] {"op": "offer"}')
+    c["alice"].send_message("bob", "[GROUP] carol: private")
+    deliver(c["bob"])
+    assert texts(c["bob"], "alice") == ['[FILE] {"op": "offer"}', "[GROUP] carol: private"]
+    assert texts(c["bob"], GROUP_CHAT) == []
@@ -0,0 +1,37 @@
+import dedup
+from dedup import RecentIds
+
+def test_ids_expire_after_the_window(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dedup.time, "monotonic", lambda: now[0])
+    ids = RecentIds(window=60)
+    ids.add(b"a")
+    now[0] += 30
+    ids.add(b"b")
+    assert b"a" in ids and b"b" in ids
+    now[0] += 31
+    assert b"a" not in ids
+    assert b"b" in ids
+    now[0] += 30
+    assert b"b" not in ids
+    assert len(ids) == 0
+
+def test_seeing_an_id_again_restarts_its_window(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dedup.time, "monotonic", lambda: now[0])
+    ids = RecentIds(window=60)
+    ids.add(b"a")
+    ids.add(b"b")
+    now[0] += 50
+    ids.add(b"a")
+    now[0] += 20
+    assert b"a" in ids
+    assert b"b" not in ids
+
+def test_oldest_ids_go_first_when_full():
+    ids = RecentIds(max_ids=3)
+    for message_id in (b"a", b"b", b"c", b"d"):
+        ids.add(message_id)
+    assert len(ids) == 3
+    assert b"a" not in ids
+    assert all(message_id in ids for message_id in (b"b", b"c", b"d"))
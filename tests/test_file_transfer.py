@@ -0,0 +1,99 @@
+import json
+import os
+import time
+
+import pytest
+
+import file_transfer
+from file_transfer import FileTransfers, FILE_PREFIX, CHUNK_SIZE
+
+class Link:
+    """Two FileTransfers wired back to back - control messages and chunks are delivered inline"""
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.events = {"alice": [], "bob": []}
+        self.drop_chunks_after = None
+        self.ends = {}
+        for name in ("alice", "bob"):
+            self.connect(name)
+    
+    def connect(self, name):
+        """(Re)start one end, as after a client restart"""
+        end = FileTransfers(name, self, lambda peer, text, name=name: self.control(name, peer, text),
+                            self.tmp_path / f"downloads_{name}")
+        end.on_event = self.events[name].append
+        self.ends[name] = end
+        return end
+    
+    def control(self, sender, peer, text):
+        self.ends[peer].handle_control(sender, text[len(FILE_PREFIX):])
+    
+    def send_message(self, peer, chunk, priority):
+        index = file_transfer.CHUNK_HEADER.unpack_from(chunk)[2]
+        if self.drop_chunks_after is None or index <= self.drop_chunks_after:
+            self.ends[peer].handle_chunk("alice", chunk)
+    
+    def wait(self, name, state, timeout=10):
+        """First event of name's in state, waiting for the background threads"""
+        for _ in range(int(timeout * 100)):
+            for event in self.events[name]:
+                if event['state'] == state:
+                    return event
+            time.sleep(0.01)
+        raise AssertionError(f"No {state} event for {name}: {self.events[name]}")
+
+@pytest.fixture
+def link(tmp_path):
+    return Link(tmp_path)
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / "data.bin"
+    path.write_bytes(os.urandom(40 * CHUNK_SIZE + 123))
+    return path
+
+def test_offer_waits_for_accept(link, data_file):
+    transfer_id = link.ends["alice"].send_file("bob", data_file)
+    offer = link.wait("bob", "offered")
+    assert offer['id'] == transfer_id and offer['peer'] == "alice"
+    assert not (link.tmp_path / "downloads_bob").exists()  # Nothing written before accepting
+    
+    assert link.ends["bob"].accept(transfer_id)
+    done = link.wait("bob", "done")
+    assert open(done['path'], 'rb').read() == data_file.read_bytes()
+    link.wait("alice", "done")
+
+def test_declined_offer(link, data_file):
+    transfer_id = link.ends["alice"].send_file("bob", data_file)
+    link.wait("bob", "offered")
+    assert link.ends["bob"].decline(transfer_id)
+    link.wait("alice", "declined")
+    assert link.ends["alice"].pending() == ([], [])
+    assert not link.ends["bob"].accept(transfer_id)
+
+@pytest.mark.parametrize("change", [
+    {'chunks': 1},                     # Does not match the size
+    {'chunk_size': CHUNK_SIZE * 2},    # Not our chunk layout
+    {'size': file_transfer.MAX_FILE_SIZE + 1},
+    {'key': "c2hvcnQ="},
+])
+def test_malformed_offer_is_refused(link, data_file, change):
+    transfer = file_transfer._OutgoingFile("bob", data_file)
+    transfer.sha256 = "0" * 64
+    offer = dict(transfer.offer(), **change)
+    link.ends["bob"].handle_control("alice", json.dumps(offer))
+    assert link.events["bob"] == []
+
+def test_resumed_download_checks_whole_file(link, data_file):
+    link.drop_chunks_after = 20  # Receiver "crashes" after chunk 20
+    transfer_id = link.ends["alice"].send_file("bob", data_file)
+    link.wait("bob", "offered")
+    link.ends["bob"].accept(transfer_id)
+    link.wait("bob", "progress")
+    link.ends["bob"].close()
+    
+    link.drop_chunks_after = None
+    bob = link.connect("bob")
+    assert bob.resume_incoming() == 1
+    done = link.wait("bob", "done")
+    assert open(done['path'], 'rb').read() == data_file.read_bytes()
@@ -0,0 +1,32 @@
+import pytest
+
+from hash_ring import HashRing
+
+NODES = ["rabbit1", "rabbit2", "rabbit3", "rabbit4"]
+USERS = [f"user{i}" for i in range(500)]
+
+def test_failover_order_lists_every_node_once():
+    ring = HashRing(NODES)
+    for user in USERS:
+        order = ring.nodes_for(user)
+        assert sorted(order) == sorted(NODES)
+        assert ring.node_for(user) == order[0]
+    # Same answer on every client
+    assert [HashRing(NODES).node_for(user) for user in USERS] == [ring.node_for(user) for user in USERS]
+
+def test_keys_spread_over_all_nodes():
+    ring = HashRing(NODES)
+    owners = [ring.node_for(user) for user in USERS]
+    assert all(owners.count(node) > len(USERS) / len(NODES) / 2 for node in NODES)
+
+def test_removing_a_node_fails_over_to_the_next_in_order():
+    ring = HashRing(NODES)
+    smaller = HashRing([node for node in NODES if node != "rabbit2"])
+    for user in USERS:
+        # Only rabbit2's users move, each to its next node in the old order
+        assert smaller.nodes_for(user) == [node for node in ring.nodes_for(user) if node != "rabbit2"]
+
+def test_single_node_and_duplicates():
+    assert HashRing(["rabbit1", "rabbit1"]).nodes_for("alice") == ["rabbit1"]
+    with pytest.raises(ValueError):
+        HashRing([])
@@ -0,0 +1,102 @@
+import pytest
+
+import key_directory
+import pki_manager
+import rabbitmq_manager
+from key_directory import KeyDirectory, KeyDirectoryService
+
+@pytest.fixture
+def directory_pki(pki, monkeypatch):
+    """
+    directory_pki() -> PKIManager reading certificates through a KeyDirectory
+    whose requests go straight to a KeyDirectoryService on the test keystore
+    """
+    service = KeyDirectoryService()
+    calls = []
+    
+    def make():
+        client = pki_manager.PKIManager(signing="service", key_source="directory")
+        def call_once(request):
+            calls.append(request)
+            return service.handle(request)
+        client.keystore._call_once = call_once
+        client.calls = calls
+        return client
+    monkeypatch.setattr(pki_manager, "CA_FINGERPRINT", pki_manager.ca_fingerprint(pki._load_ca_cert()))
+    return make
+
+class DroppingConnection:
+    """Broker connection (and channel) that fails its first poll if drop, like a broker restart"""
+    def __init__(self, service, drop):
+        self.service = service
+        self.drop = drop
+        self.is_open = True
+    
+    def channel(self):
+        return self
+    
+    def queue_declare(self, queue, **kwargs):
+        pass
+    
+    def basic_qos(self, prefetch_count):
+        pass
+    
+    def basic_consume(self, queue, on_message_callback):
+        pass
+    
+    def process_data_events(self, time_limit):
+        if self.drop:
+            raise ConnectionResetError("broker restarted")
+        self.service.stop()
+    
+    def close(self):
+        self.is_open = False
+
+def test_ca_from_directory_must_match_pin(pki, directory_pki, monkeypatch):
+    pki.create_user_cert("alice")
+    assert directory_pki().get_user_public_key("alice") is not None
+    
+    monkeypatch.setattr(pki_manager, "CA_FINGERPRINT", "00" * 32)
+    with pytest.raises(ValueError, match="does not match"):
+        directory_pki().get_user_public_key("alice")
+    
+    monkeypatch.setattr(pki_manager, "CA_FINGERPRINT", "")
+    with pytest.raises(ValueError, match="No trusted CA"):
+        directory_pki().get_user_public_key("alice")
+
+def test_shipped_ca_certificate_is_used(pki, directory_pki, monkeypatch):
+    pki.create_user_cert("alice")
+    monkeypatch.setattr(pki_manager, "CA_FINGERPRINT", "")
+    monkeypatch.setattr(pki_manager, "CA_CERT_FILE", str(pki_manager.PKI_PATH / "ca.crt"))
+    client = directory_pki()
+    assert client.get_user_public_key("alice") is not None
+    assert not any(request.get('ca') for request in client.calls)
+
+def test_unreachable_directory_is_not_asked_again(monkeypatch):
+    directory = KeyDirectory()
+    calls = []
+    def down(request):
+        calls.append(request)
+        raise TimeoutError("No reply from the key directory")
+    directory._call_once = down
+    
+    assert directory.get("bob") is None
+    assert directory.get_many(["bob", "carol"]) == {}
+    assert len(calls) == 1
+    
+    monkeypatch.setattr(key_directory, "DIRECTORY_RETRY", 0)
+    directory._retry_at = 0
+    directory.get("bob")
+    assert len(calls) == 2
+
+def test_service_reconnects_after_broker_failure(pki, monkeypatch):
+    service = KeyDirectoryService()
+    connections = []
+    def connect(nodes):
+        connections.append(DroppingConnection(service, drop=not connections))
+        return connections[-1]
+    monkeypatch.setattr(key_directory, "open_first", connect)
+    monkeypatch.setattr(rabbitmq_manager, "backoff_delay", lambda attempt: 0)
+    service.run()
+    assert len(connections) == 2
+    assert not connections[0].is_open
@@ -0,0 +1,78 @@
+import multiprocessing
+import os
+
+from keystore import KeyStore, MAGIC, RECORD_HEADER
+
+def _record(store, username):
+    entry = store.get(username)
+    return None if entry is None else (bytes(entry[1]), bytes(entry[2]))
+
+def test_append_and_replace(tmp_path):
+    store = KeyStore(tmp_path / "keystore.db")
+    store.append_many([("alice", b"pub-a", b"cert-a"), ("bob", b"pub-b", b"cert-b")])
+    store.append("alice", b"pub-a2", b"cert-a2")
+    
+    assert _record(store, "alice") == (b"pub-a2", b"cert-a2")
+    assert _record(store, "bob") == (b"pub-b", b"cert-b")
+    assert store.users() == {"alice", "bob"}
+
+def test_torn_append_is_skipped(tmp_path):
+    path = tmp_path / "keystore.db"
+    store = KeyStore(path)
+    store.append("alice", b"pub-a", b"cert-a")
+    
+    # A client died half way through its record
+    whole = path.read_bytes()
+    with open(path, 'ab') as f:
+        f.write(whole[len(MAGIC):len(MAGIC) + 12])
+    store.append("bob", b"pub-b", b"cert-b")
+    store.append("carol", b"pub-c", b"cert-c")
+    
+    reader = KeyStore(path)
+    assert _record(reader, "alice") == (b"pub-a", b"cert-a")
+    assert _record(reader, "bob") == (b"pub-b", b"cert-b")
+    assert _record(reader, "carol") == (b"pub-c", b"cert-c")
+
+def test_corrupted_record_fails_checksum(tmp_path):
+    path = tmp_path / "keystore.db"
+    store = KeyStore(path)
+    store.append("alice", b"pub-a", b"cert-a")
+    store.append("alice", b"pub-x", b"cert-x")
+    store.append("bob", b"pub-b", b"cert-b")
+    
+    data = bytearray(path.read_bytes())
+    data[data.index(b"cert-x")] ^= 0xFF
+    path.write_bytes(bytes(data))
+    
+    reader = KeyStore(path)
+    assert _record(reader, "alice") == (b"pub-a", b"cert-a")
+    assert _record(reader, "bob") == (b"pub-b", b"cert-b")
+
+def test_records_before_checksums_are_read(tmp_path):
+    path = tmp_path / "keystore.db"
+    legacy = b"".join(
+        RECORD_HEADER.pack(len(name), len(pub), len(cert)) + name + pub + cert
+        for name, pub, cert in [(b"alice", b"pub-a", b"cert-a"), (b"bob", b"pub-b", b"cert-b")]
+    )
+    path.write_bytes(MAGIC + legacy)
+    
+    KeyStore(path).append("carol", b"pub-c", b"cert-c")
+    reader = KeyStore(path)
+    assert _record(reader, "alice") == (b"pub-a", b"cert-a")
+    assert _record(reader, "bob") == (b"pub-b", b"cert-b")
+    assert _record(reader, "carol") == (b"pub-c", b"cert-c")
+
+def _writer(path, worker, count):
+    store = KeyStore(path)
+    for i in range(count):
+        store.append(f"w{worker}u{i}", os.urandom(40), os.urandom(300))
+
+def test_concurrent_writers(tmp_path):
+    path = str(tmp_path / "keystore.db")
+    workers = [multiprocessing.Process(target=_writer, args=(path, w, 25)) for w in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    
+    assert KeyStore(path).users() == {f"w{w}u{i}" for w in range(4) for i in range(25)}
@@ -0,0 +1,41 @@
+import rabbitmq_manager
+from outbox import Outbox
+from rabbitmq_manager import MQ
+
+def test_rows_survive_reopen_until_removed(tmp_path):
+    box = Outbox(tmp_path / "outbox.db")
+    first = box.add("bob", 1, b"one")
+    second = box.add("carol", 1, memoryview(b"two"))
+    box.close()
+    
+    box = Outbox(tmp_path / "outbox.db")
+    assert box.last_id() == second
+    assert box.pending() == [(first, "bob", 1, b"one"), (second, "carol", 1, b"two")]
+    box.remove([first])
+    assert box.pending() == [(second, "carol", 1, b"two")]
+    assert box.pending(after_id=second) == []
+    box.remove([second])
+    assert len(box) == 0
+
+def test_replay_removes_only_delivered_rows(tmp_path):
+    box = Outbox(tmp_path / "outbox.db")
+    for recipient in ("bob", "carol", "dave"):
+        box.add(recipient, 1, recipient.encode())
+    
+    # A restarted transport replays what the previous run left behind
+    transport = MQ.__new__(MQ)
+    rabbitmq_manager.Transport.__init__(transport, "alice")
+    transport._outbox = box
+    transport._replay_upto = box.last_id()
+    box.add("erin", 1, b"erin")  # Written by this run - the send worker's job, not replay's
+    delivered = []
+    def deliver(kind, recipient, body):
+        delivered.append(recipient)
+        return recipient != "carol"  # carol's node is down
+    transport._deliver = deliver
+    
+    acked = []
+    transport._replay_outbox(acked)
+    assert delivered == ["bob", "carol", "dave"]
+    box.remove(acked)  # The send worker deletes acked rows in batches
+    assert [recipient for _, recipient, _, _ in box.pending()] == ["carol", "erin"]
@@ -0,0 +1,40 @@
+import warnings
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import pki_manager
+
+def test_certificate_is_verified(pki):
+    pki.create_user_cert("alice", key_type="x25519")
+    entry = pki.keystore.get("alice")
+    assert pki.get_user_public_key("alice") == bytes(entry[1])
+    assert pki.get_user_public_key("nobody") is None
+
+def test_certificate_of_another_user_is_refused(pki):
+    pki.create_user_cert("alice", key_type="x25519")
+    _, pub_der, cert_der = pki.keystore.get("alice")
+    pki.keystore.append("carol", bytes(pub_der), bytes(cert_der))
+    
+    with pytest.raises(ValueError, match="does not match carol"):
+        pki.get_user_public_key("carol")
+    
+    # Still refused once alice's certificate is cached
+    pki.get_user_public_key("alice")
+    with pytest.raises(ValueError, match="does not match carol"):
+        pki.get_user_public_key("carol")
+
+def test_no_naive_datetime_warnings(pki):
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        pki.create_user_cert("alice", key_type="x25519")
+        pki.get_user_public_key("alice")
+
+def test_expired_cached_certificate_keeps_failing(pki, monkeypatch):
+    pki.create_user_cert("alice", key_type="x25519")
+    pki.get_user_public_key("alice")
+    later = datetime.now(timezone.utc) + timedelta(days=10 * 365)
+    monkeypatch.setattr(pki_manager, "datetime", type("datetime", (datetime,), {"now": staticmethod(lambda tz=None: later)}))
+    for _ in range(2):
+        with pytest.raises(ValueError, match="expired"):
+            pki.get_user_public_key("alice")
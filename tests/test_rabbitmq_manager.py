@@ -0,0 +1,69 @@
+import threading
+
+import pika
+import pytest
+
+import rabbitmq_manager
+from hash_ring import HashRing
+from rabbitmq_manager import MQ, QueueUnavailable
+
+class FakeChannel:
+    """Channel whose queue_declare answers with a broker error code"""
+    def __init__(self, declare_code=None):
+        self.declare_code = declare_code
+        self.published = []
+        self.connection = self
+        self.is_open = True
+    
+    def channel(self):
+        return self
+    
+    def queue_declare(self, queue, durable, arguments):
+        if self.declare_code:
+            raise pika.exceptions.ChannelClosedByBroker(self.declare_code, "NOT_FOUND - home node down")
+    
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append((routing_key, body))
+    
+    def close(self):
+        pass
+
+class FakePublisher:
+    def __init__(self, channel):
+        self.channel = channel
+        self.lost = 0
+    
+    def try_channel(self):
+        return self.channel
+    
+    def mark_lost(self, error=None):
+        self.lost += 1
+
+@pytest.fixture
+def mq():
+    """MQ with one fake publisher per node and no broker or send worker"""
+    def make(declare_code=None):
+        transport = MQ.__new__(MQ)
+        rabbitmq_manager.Transport.__init__(transport, "alice")
+        transport._ring = HashRing(["node1"])
+        transport._lock = threading.Lock()
+        transport._declared_queues = {"node1": set()}
+        transport._publishers = {"node1": FakePublisher(FakeChannel(declare_code))}
+        return transport
+    return make
+
+def test_queue_on_down_node_keeps_connection(mq):
+    transport = mq(declare_code=404)
+    undelivered = []
+    transport.on_undelivered = undelivered.append
+    with pytest.raises(QueueUnavailable):
+        transport._send_message_internal("bob", b"body")
+    assert not transport._deliver("message", "bob", b"body")
+    assert transport._publishers["node1"].lost == 0
+    assert undelivered == ["bob"]
+    assert "user_bob" not in transport._declared_queues["node1"]
+
+def test_queue_with_other_arguments_is_used(mq):
+    transport = mq(declare_code=406)
+    assert transport._deliver("message", "bob", b"body")
+    assert transport._publishers["node1"].channel.published == [("user_bob", b"body")]
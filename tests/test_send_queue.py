@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+
+from send_queue import SendQueue, SendQueueFull, SendQueueClosed, PRIORITY_CONTROL, PRIORITY_CHAT, PRIORITY_BULK
+
+def test_full_class_rejects_after_timeout():
+    queue = SendQueue({PRIORITY_CONTROL: None, PRIORITY_CHAT: 2, PRIORITY_BULK: 1})
+    queue.put("a")
+    queue.put("b")
+    with pytest.raises(SendQueueFull, match="2 chat messages"):
+        queue.put("c", timeout=0)
+    with pytest.raises(SendQueueFull):
+        queue.put("d", timeout=0.05)
+    # Other classes have their own room; control is never refused
+    queue.put("chunk", PRIORITY_BULK, timeout=0)
+    for i in range(10):
+        queue.put(f"presence {i}", PRIORITY_CONTROL, timeout=0)
+    assert queue.depth(PRIORITY_CHAT) == 2
+    assert len(queue) == 13
+
+def test_blocked_put_resumes_when_room_frees():
+    queue = SendQueue({PRIORITY_CHAT: 1})
+    queue.put("first")
+    done = threading.Event()
+    
+    def put_second():
+        queue.put("second", timeout=5)
+        done.set()
+    thread = threading.Thread(target=put_second)
+    thread.start()
+    assert not done.wait(0.05)  # Backpressure - the producer waits
+    assert queue.get() == (PRIORITY_CHAT, "first")
+    thread.join(5)
+    assert done.is_set()
+    assert queue.get() == (PRIORITY_CHAT, "second")
+
+def test_higher_priority_classes_go_first():
+    queue = SendQueue()
+    queue.put("chunk 1", PRIORITY_BULK)
+    queue.put("hello", PRIORITY_CHAT)
+    queue.put("chunk 2", PRIORITY_BULK)
+    queue.put("online", PRIORITY_CONTROL)
+    queue.put("world", PRIORITY_CHAT)
+    assert [queue.get(timeout=0)[1] for _ in range(5)] == ["online", "hello", "world", "chunk 1", "chunk 2"]
+    assert queue.get(timeout=0) is None
+
+def test_closed_queue_drains_then_stops():
+    queue = SendQueue()
+    queue.put("last")
+    queue.close()
+    with pytest.raises(SendQueueClosed):
+        queue.put("late")
+    assert queue.get() == (PRIORITY_CHAT, "last")
+    assert queue.get() is None
@@ -0,0 +1,168 @@
+import time
+
+import pytest
+
+import session_manager
+from session_manager import SessionManager, InboundKeyStore, HEADER, KEY_LENGTH, SESSION_KEY
+
+@pytest.fixture
+def pair(make_key):
+    """pair(alice_type, bob_type, **bob_kwargs) -> (alice, bob) session managers"""
+    def make(alice_type="x25519", bob_type="x25519", **bob_kwargs):
+        keys = {"alice": make_key("alice", alice_type), "bob": make_key("bob", bob_type)}
+        resolver = lambda user: keys[user][1] if user in keys else None
+        alice = SessionManager("alice", keys["alice"][0], resolver)
+        bob = SessionManager("bob", keys["bob"][0], resolver, **bob_kwargs)
+        return alice, bob
+    return make
+
+@pytest.mark.parametrize("alice_type,bob_type", [
+    ("rsa", "rsa"), ("rsa", "x25519"), ("x25519", "x25519"), ("x25519", "rsa")
+])
+def test_round_trip(pair, alice_type, bob_type):
+    alice, bob = pair(alice_type, bob_type)
+    for i in range(3):
+        assert bob.decrypt("alice", alice.encrypt("bob", f"hello {i}")) == f"hello {i}"
+
+def test_replay_is_rejected(pair):
+    alice, bob = pair()
+    first = alice.encrypt("bob", "one")
+    second = alice.encrypt("bob", "two")
+    bob.decrypt("alice", first)
+    bob.decrypt("alice", second)
+    with pytest.raises(ValueError, match="Replayed"):
+        bob.decrypt("alice", second)
+
+def test_reordered_messages_are_accepted(pair):
+    alice, bob = pair()
+    messages = [alice.encrypt("bob", str(i)) for i in range(5)]
+    assert bob.decrypt("alice", messages[0]) == "0"
+    assert [bob.decrypt("alice", m) for m in reversed(messages[1:])] == ["4", "3", "2", "1"]
+
+def test_tampered_message_fails(pair):
+    alice, bob = pair()
+    bob.decrypt("alice", alice.encrypt("bob", "one"))
+    data = bytearray(alice.encrypt("bob", "two"))
+    data[-1] ^= 1
+    with pytest.raises(Exception):
+        bob.decrypt("alice", bytes(data))
+
+def test_session_from_wrong_key_is_rejected(pair, make_key):
+    alice, bob = pair()
+    mallory_path, _ = make_key("mallory")
+    mallory = SessionManager("alice", mallory_path, alice.pubkey_resolver)  # Claims to be alice
+    with pytest.raises(ValueError, match="Bad sender signature"):
+        bob.decrypt("alice", mallory.encrypt("bob", "hi"))
+
+def test_unsigned_session_is_refused(pair):
+    alice, bob = pair()
+    alice.encrypt("bob", "warm up")
+    session = alice._outbound["bob"]
+    header = HEADER.pack(SESSION_KEY, session.session_id) + KEY_LENGTH.pack(len(session.wrapped_key)) + session.wrapped_key
+    session.key_header = header
+    session.counter = 0
+    with pytest.raises(ValueError, match="Unauthenticated session"):
+        bob.decrypt("alice", alice.encrypt("bob", "unsigned"))
+
+def test_sessions_survive_restart(pair, tmp_path):
+    alice, bob = pair(key_store=InboundKeyStore(tmp_path / "sessions.db"))
+    bob.decrypt("alice", alice.encrypt("bob", "before the crash"))
+    queued = [alice.encrypt("bob", f"queued {i}") for i in range(3)]
+    bob.close()
+    
+    restarted = SessionManager("bob", bob.priv_path, bob.pubkey_resolver, InboundKeyStore(tmp_path / "sessions.db"))
+    assert [restarted.decrypt("alice", m) for m in queued] == ["queued 0", "queued 1", "queued 2"]
+
+def test_replay_after_restart_is_rejected(pair, tmp_path):
+    alice, bob = pair(key_store=InboundKeyStore(tmp_path / "sessions.db"))
+    messages = [alice.encrypt("bob", str(i)) for i in range(3)]
+    for message in messages:
+        bob.decrypt("alice", message)
+    bob.close()
+    
+    restarted = SessionManager("bob", bob.priv_path, bob.pubkey_resolver, InboundKeyStore(tmp_path / "sessions.db"))
+    for message in messages:
+        with pytest.raises(ValueError, match="Replayed"):
+            restarted.decrypt("alice", message)
+
+def test_evicted_session_is_restored(pair, tmp_path, monkeypatch):
+    monkeypatch.setattr(session_manager, "SESSION_MAX_MESSAGES", 2)
+    alice, bob = pair(key_store=InboundKeyStore(tmp_path / "sessions.db"))
+    late = None
+    for i in range(8):
+        message = alice.encrypt("bob", str(i))
+        if i == 1:
+            late = message  # Held back while newer sessions arrive
+        else:
+            bob.decrypt("alice", message)
+    assert bob.decrypt("alice", late) == "1"
+
+@pytest.mark.parametrize("alice_type,bob_type,verified", [
+    ("rsa", "x25519", True), ("x25519", "x25519", True), ("x25519", "rsa", False)
+])
+def test_sessions_report_whether_the_sender_was_verified(pair, alice_type, bob_type, verified):
+    alice, bob = pair(alice_type, bob_type)
+    for text in ("first", "second"):
+        assert bob.decrypt_verified("alice", alice.encrypt("bob", text)) == (text, verified)
+
+def test_unverified_sessions_can_be_refused(pair, monkeypatch):
+    monkeypatch.setattr(session_manager, "ACCEPT_UNVERIFIED", False)
+    alice, bob = pair("x25519", "rsa")
+    with pytest.raises(ValueError, match="Unauthenticated session"):
+        bob.decrypt("alice", alice.encrypt("bob", "hi"))
+
+def test_replayed_key_of_evicted_session_is_rejected(pair, monkeypatch):
+    monkeypatch.setattr(session_manager, "SESSION_MAX_MESSAGES", 2)
+    alice, bob = pair()
+    messages = [alice.encrypt("bob", str(i)) for i in range(8)]
+    for message in messages:
+        bob.decrypt("alice", message)
+    with pytest.raises(ValueError, match="Replayed"):
+        bob.decrypt("alice", messages[0])  # Its session was evicted from memory
+
+def test_expired_session_key_is_rejected(pair, monkeypatch):
+    alice, bob = pair()
+    created = time.time() - session_manager.SESSION_KEY_MAX_AGE - 60
+    monkeypatch.setattr(session_manager.time, "time", lambda: created)
+    old = alice.encrypt("bob", "long ago")
+    monkeypatch.undo()
+    with pytest.raises(ValueError, match="Expired session key"):
+        bob.decrypt("alice", old)
+
+def test_forged_sealed_message_does_not_use_up_its_counter(pair):
+    alice, bob = pair()
+    bob.decrypt("alice", alice.encrypt("bob", "one"))
+    real = alice.encrypt("bob", "two")
+    forged = bytearray(real)
+    forged[-1] ^= 1
+    with pytest.raises(Exception):
+        bob.seal("alice", bytes(forged)).open()
+    sealed = bob.seal("alice", real)
+    assert sealed.open() == "two"
+    with pytest.raises(ValueError, match="Replayed"):
+        bob.seal("alice", real)
+
+def test_sealed_message_opens_once(pair):
+    alice, bob = pair()
+    data = alice.encrypt("bob", "once")
+    first, second = bob.seal("alice", data), bob.seal("alice", data)
+    assert first.open() == "once"
+    with pytest.raises(ValueError, match="Replayed"):
+        second.open()
+
+def test_huge_counter_jump_resets_replay_window():
+    session = session_manager._InboundSession(bytes(32))
+    session.accept(5)
+    session.accept(2 ** 62)
+    assert session.seen == 1
+    assert session.is_replay(2 ** 62) and not session.is_replay(2 ** 62 - 1)
+
+@pytest.mark.parametrize("defer", [False, True])
+def test_session_survives_losing_its_first_messages(pair, defer):
+    alice, bob = pair()
+    messages = [alice.encrypt("bob", str(i)) for i in range(5)]
+    # The broker dropped the head of bob's queue (max-length drop-head or TTL)
+    if defer:
+        assert [bob.seal("alice", m).open() for m in messages[2:]] == ["2", "3", "4"]
+    else:
+        assert [bob.decrypt("alice", m) for m in messages[2:]] == ["2", "3", "4"]
@@ -0,0 +1,30 @@
+import json
+
+import pytest
+
+from wire_format import pack_message, unpack_message, HEADER
+
+def test_round_trip():
+    cipher_text = bytes(range(256)) * 4
+    body = pack_message("zoë", cipher_text, message_id=b"\x01" * 16)
+    assert len(body) == HEADER.size + len("zoë".encode('utf-8')) + len(cipher_text)
+    sender, message_id, payload = unpack_message(body)
+    assert (sender, message_id, bytes(payload)) == ("zoë", b"\x01" * 16, cipher_text)
+    assert isinstance(payload, memoryview)  # Not copied out of the body
+
+def test_each_message_gets_its_own_id():
+    first = unpack_message(pack_message("alice", b"x"))[1]
+    second = unpack_message(pack_message("alice", b"x"))[1]
+    assert len(first) == 16 and first != second
+
+def test_legacy_json_messages_are_parsed():
+    body = json.dumps({"from": "alice", "message": b"\x00\xffcipher".hex()}).encode()
+    assert unpack_message(body) == ("alice", None, b"\x00\xffcipher")
+
+def test_bad_frames_are_refused():
+    with pytest.raises(ValueError, match="too long"):
+        pack_message("a" * 256, b"x")
+    body = bytearray(pack_message("alice", b"x"))
+    body[0] = 3
+    with pytest.raises(ValueError, match="Unsupported wire format version"):
+        unpack_message(bytes(body))
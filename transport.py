@@ -0,0 +1,191 @@
+import json
+import threading
+import uuid
+from collections import deque
+
+from wire_format import pack_message
+from send_queue import SendQueueFull, PRIORITY_CHAT
+from logger import get_logger
+
+log = get_logger("transport")
+
+# Re-announce 'online' this often so late joiners and restarted peers see us
+PRESENCE_INTERVAL = 30
+
+class Transport:
+    """
+    Message transport used by ChatClient
+    Implementations deliver framed ciphertext (see wire_format) between users
+    and fan presence announcements out to everyone:
+      send_message(to_user, data, priority) - queue one message; may block, then
+                                          raise SendQueueFull (backpressure)
+      publish_group(messages)             - queue (to_user, data) pairs
+      announce_presence(status)           - 'online' / 'offline'
+      listen(callback)                    - blocks, callback(body) per message
+      listen_presence(callback)           - blocks, callback(user, status, instance)
+      close()                             - announce offline and stop listeners
+    on_undelivered(to_user) is called when a queued message is given up on
+    (the sender must not assume the peer saw it, e.g. a session key).
+    """
+    def __init__(self, user):
+        self.username = user
+        self.instance_id = uuid.uuid4().hex  # Changes on every client start
+        self._stopping = threading.Event()  # Set by close()
+        self.on_undelivered = None
+    
+    def start_presence_heartbeat(self, interval=PRESENCE_INTERVAL):
+        """Announce 'online' now and every interval seconds from a daemon thread, until close"""
+        def beat():
+            while True:
+                try:
+                    self.announce_presence('online')
+                except Exception as e:
+                    log.warning("Presence announcement error: %s", e)
+                if self._stopping.wait(interval):
+                    return
+        
+        threading.Thread(target=beat, daemon=True).start()
+    
+    def send_message(self, to_user, encrypted_msg, priority=PRIORITY_CHAT):
+        raise NotImplementedError
+    
+    def publish_group(self, messages):
+        """Queue a message per recipient (each is encrypted separately), return how many were queued"""
+        count = 0
+        for to_user, encrypted_msg in messages:
+            try:
+                # Same class as 1:1 chat: both share each peer's session, whose
+                # first (key-carrying) message must not be overtaken
+                self.send_message(to_user, encrypted_msg, PRIORITY_CHAT)
+            except SendQueueFull as e:
+                log.warning("Group send stopped after %d recipients: %s", count, e)
+                break
+            count += 1
+        return count
+    
+    def announce_presence(self, status='online'):
+        raise NotImplementedError
+    
+    def listen(self, callback):
+        raise NotImplementedError
+    
+    def listen_presence(self, callback):
+        raise NotImplementedError
+    
+    def close(self):
+        raise NotImplementedError
+
+class _Inbox:
+    """Queued bodies plus a condition to wake only this inbox's listener"""
+    def __init__(self, lock):
+        self.items = deque()
+        self.cond = threading.Condition(lock)
+    
+    def push(self, body):
+        self.items.append(body)
+        self.cond.notify()
+
+class LoopbackHub:
+    """
+    In-process message switch shared by LoopbackTransports
+    Per-user queues keep messages until that user listens (like durable
+    broker queues); presence is fanned out to current listeners only.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inboxes = {}           # username -> _Inbox
+        self.presence_inboxes = {}  # transport -> _Inbox of presence bodies
+        self.delivered = 0
+        self.delivered_bytes = 0
+    
+    def transport(self, user):
+        """Create a transport for user on this hub"""
+        return LoopbackTransport(self, user)
+    
+    def inbox(self, user):
+        """Get or create a user's inbox (caller holds the hub lock)"""
+        inbox = self.inboxes.get(user)
+        if inbox is None:
+            inbox = self.inboxes[user] = _Inbox(self.lock)
+        return inbox
+    
+    def put(self, to_user, body):
+        with self.lock:
+            self.inbox(to_user).push(body)
+            self.delivered += 1
+            self.delivered_bytes += len(body)
+    
+    def broadcast(self, body):
+        with self.lock:
+            for inbox in self.presence_inboxes.values():
+                inbox.push(body)
+
+class LoopbackTransport(Transport):
+    """Zero-network transport for tests, benchmarks and deterministic load runs"""
+    def __init__(self, hub, user):
+        super().__init__(user)
+        self.hub = hub
+        self.closed = False
+    
+    def send_message(self, to_user, encrypted_msg, priority=PRIORITY_CHAT):
+        """Deliver immediately to the recipient's inbox"""
+        self.hub.put(to_user, pack_message(self.username, encrypted_msg))
+    
+    def announce_presence(self, status='online'):
+        self.hub.broadcast(json.dumps({
+            'user': self.username,
+            'status': status,
+            'instance': self.instance_id
+        }).encode('utf-8'))
+    
+    def _drain(self, inbox, handle):
+        """Hand queued bodies to handle until closed (runs on the caller's thread)"""
+        while True:
+            with self.hub.lock:
+                while not inbox.items and not self.closed:
+                    inbox.cond.wait()
+                if self.closed:
+                    return
+                bodies = list(inbox.items)
+                inbox.items.clear()
+            
+            # Callbacks run outside the hub lock
+            for body in bodies:
+                try:
+                    handle(body)
+                except Exception:
+                    log.exception("Error in message callback")
+    
+    def listen(self, callback):
+        with self.hub.lock:
+            inbox = self.hub.inbox(self.username)
+        self._drain(inbox, callback)
+    
+    def listen_presence(self, callback):
+        with self.hub.lock:
+            inbox = self.hub.presence_inboxes[self] = _Inbox(self.hub.lock)
+        
+        def on_presence(body):
+            data = json.loads(body.decode())
+            callback(data['user'], data['status'], data.get('instance'))
+        
+        try:
+            self._drain(inbox, on_presence)
+        finally:
+            with self.hub.lock:
+                self.hub.presence_inboxes.pop(self, None)
+    
+    def close(self):
+        if self.closed:
+            return
+        self.announce_presence('offline')
+        self._stopping.set()
+        with self.hub.lock:
+            self.closed = True
+            # Wake our listeners so they see closed
+            inbox = self.hub.inboxes.get(self.username)
+            if inbox is not None:
+                inbox.cond.notify_all()
+            presence = self.hub.presence_inboxes.get(self)
+            if presence is not None:
+                presence.cond.notify_all()
\ No newline at end of file
@@ -1,26 +1,64 @@
 import tkinter as tk
-from tkinter import ttk, scrolledtext, messagebox
-import threading
-import json
-from datetime import datetime
+from tkinter import ttk, scrolledtext, messagebox, filedialog
 import sys
 import os
+import threading
+import time
+from bisect import bisect
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from crypto_manager import encrypt, decrypt
-from rabbitmq_manager import MQ
-from pki_manager import PKIManager
+from chat_client import ChatClient, GROUP_CHAT
+from file_transfer import describe, format_size
+from logger import get_logger
+import metrics
+
+log = get_logger("chat")
+
+UI_RENDER_SECONDS = metrics.histogram("chat_ui_render_seconds", "Time spent rendering chat widgets on the Tk thread")
+UI_FRAME_LAG_SECONDS = metrics.histogram("chat_ui_frame_lag_seconds", "How late Tk timer ticks fire (UI thread stalls)")
+
+PRESENCE_BATCH_SIZE = metrics.histogram(
+    "chat_ui_presence_batch_size", "Presence updates applied per UI pass",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+
+# Tick used to measure UI responsiveness
+FRAME_PROBE_MS = 100
+
+# Presence updates arriving within this window are applied in one pass
+PRESENCE_FLUSH_MS = 100
+
+def stamp(entry):
+    """Timestamp line of a message, flagging one whose sender could not be verified"""
+    if entry.get('unverified'):
+        return f"{entry['timestamp']}  ⚠️ sender not verified"
+    return entry['timestamp']
 
 class ChatApp:
-    def __init__(self, username):
+    """Tk view over a ChatClient - all messaging logic lives in the client"""
+    def __init__(self, username, transport=None):
         self.username = username
         self.current_chat = None
-        self.active_users = {}
-        self.message_history = {}  # Store messages per user
         
-        self.pki = PKIManager()
-        self.mq = MQ(username)
+        metrics.start_exporter()
+        
+        self.client = ChatClient(username, transport=transport)
+        # Client callbacks arrive on listener threads - hop onto the Tk thread
+        self.client.on_message = lambda conversation, entry: self.root.after(
+            0, lambda: self.on_client_message(conversation, entry))
+        self.client.on_presence = lambda user, online, changed: self.queue_presence(user, online)
+        self.client.on_file = lambda event: self.root.after(0, lambda: self.on_file_event(event))
+        
+        # Latest status per user, waiting for the next flush_presence pass
+        self._pending_presence = {}
+        self._presence_lock = threading.Lock()
+        self._presence_flush_scheduled = False
+        
+        # Certificate lookups may wait on the key directory - never on the Tk thread.
+        # One worker, so sends stay in the order they were typed
+        self._worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-ui")
         
         self.root = tk.Tk()
         self.root.title(f"P2P Chat Room - {username}")
@@ -29,21 +67,17 @@ class ChatApp:
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         
         self.create_widgets()
-        self.start_message_listener()
-        self.start_presence_listener()
         
         # Announce presence and refresh users
         self.root.after(500, self.initial_setup)
     
     def initial_setup(self):
         """Initial setup after UI is ready"""
-        # Announce presence once initially
-        self.mq.announce_presence('online')
+        # Start listeners; presence is announced from a background thread
+        self.client.start()
         
         self.refresh_users()
-        
-        # Start periodic presence announcements every 30 seconds
-        self.announce_presence_periodically()
+        self.probe_frame_lag()
     
     def create_widgets(self):
         """Create chat interface"""
@@ -69,13 +103,15 @@ class ChatApp:
                 pady=15).pack(fill='x')
         
         # Group Chat Button (NEW)
-        tk.Button(sidebar, text="💬 Group Chat",
+        self.group_button = tk.Button(sidebar, text="💬 Group Chat",
                  bg='#27ae60', fg='white',
                  font=('Arial', 11, 'bold'),
                  command=self.open_group_chat,
                  relief='flat',
                  cursor='hand2',
-                 pady=12).pack(fill='x', padx=10, pady=(5, 10))
+                 pady=12)
+        self.group_button.pack(fill='x', padx=10, pady=(5, 10))
+        self.group_button.bind('<Enter>', lambda event: self.prefetch(GROUP_CHAT))
         
         # Active users label
         tk.Label(sidebar, text="Available Users",
@@ -91,8 +127,10 @@ class ChatApp:
         self.users_container = tk.Frame(list_frame, bg='#2c3e50')
         self.users_container.pack(fill='both', expand=True)
         
-        # Keep track of user buttons
+        # Keep track of user buttons (user_order is sorted, same order as the rows)
         self.user_buttons = {}
+        self.user_order = []
+        self.no_users_label = None
         
         # Refresh users button
         tk.Button(sidebar, text="🔄 Refresh Users",
@@ -176,6 +214,20 @@ class ChatApp:
         )
         self.send_button.pack(side='right', fill='y', padx=2, pady=2)
         
+        # Attach button - 1:1 chats only
+        self.file_button = tk.Button(
+            input_frame,
+            text="📎",
+            bg='#3498db',
+            fg='white',
+            font=('Arial', 12),
+            command=self.send_file,
+            width=3,
+            relief='flat',
+            cursor='hand2'
+        )
+        self.file_button.pack(side='right', fill='y', padx=2, pady=2)
+        
         # Messages area - PACK LAST so it fills remaining space
         self.messages_text = scrolledtext.ScrolledText(
             chat,
@@ -243,6 +295,7 @@ class ChatApp:
         self.message_entry.insert('1.0', self.input_placeholder)
         self.message_entry.config(fg='#95a5a6', state='disabled')
         self.send_button.config(bg='#95a5a6', state='disabled')
+        self.file_button.config(bg='#95a5a6', state='disabled')
     
     def on_enter_key(self, event):
         """Handle Enter key - send message (Shift+Enter for newline)"""
@@ -257,79 +310,106 @@ class ChatApp:
             self.send_message()
             return 'break'
     
+    @UI_RENDER_SECONDS.time()
     def refresh_users(self):
         """Get list of registered users from PKI directory"""
         # Clear existing user buttons
         for widget in self.users_container.winfo_children():
             widget.destroy()
         self.user_buttons.clear()
+        self.user_order = []
+        self.no_users_label = None
         
         try:
-            from pki_manager import PKI_PATH
-            
-            users = set()
-            for file in PKI_PATH.glob("*.crt"):
-                username = file.stem
-                if username != "ca" and username != self.username:
-                    users.add(username)
+            users = self.client.list_users()
             
             if not users:
-                tk.Label(
+                self.no_users_label = tk.Label(
                     self.users_container,
                     text="No users found",
                     bg='#2c3e50',
                     fg='#95a5a6',
                     font=('Arial', 10, 'italic'),
                     pady=10
-                ).pack()
+                )
+                self.no_users_label.pack()
                 self.add_info_message_to_chat("No other users registered yet.")
                 return
             
             # Create button for each user
             for user in sorted(users):
-                is_online = self.active_users.get(user, False)
-                
-                # Create user button
-                user_frame = tk.Frame(self.users_container, bg='#2c3e50')
-                user_frame.pack(fill='x', padx=5, pady=2)
-                
-                # Status indicator (colored circle)
-                status_color = '#27ae60' if is_online else '#95a5a6'
-                status_canvas = tk.Canvas(user_frame, width=12, height=12, 
-                                         bg='#2c3e50', highlightthickness=0)
-                status_canvas.pack(side='left', padx=(5, 8))
-                status_canvas.create_oval(2, 2, 10, 10, fill=status_color, outline=status_color)
-                
-                # Username button
-                btn = tk.Button(
-                    user_frame,
-                    text=user,
-                    bg='#2c3e50',
-                    fg='white',
-                    font=('Arial', 10),
-                    relief='flat',
-                    anchor='w',
-                    cursor='hand2',
-                    command=lambda u=user: self.open_chat(u)
-                )
-                btn.pack(side='left', fill='x', expand=True)
-                
-                # Store references
-                self.user_buttons[user] = {
-                    'frame': user_frame,
-                    'canvas': status_canvas,
-                    'button': btn
-                }
-                
-                if user not in self.active_users:
-                    self.active_users[user] = False
+                self.add_user_row(user)
             
             # Add info to chat
             self.add_info_message_to_chat(f"Found {len(users)} registered user(s)")
             
         except Exception as e:
             messagebox.showerror("Error", f"Failed to refresh users: {e}")
-            print(f"Refresh users error: {e}")
+            log.error("Refresh users error: %s", e)
+    
+    def add_user_row(self, user):
+        """Insert one user into the sidebar at its sorted position"""
+        if self.no_users_label is not None:
+            self.no_users_label.destroy()
+            self.no_users_label = None
+        
+        index = bisect(self.user_order, user)
+        is_online = self.client.is_online(user)
+        
+        # Create user button
+        user_frame = tk.Frame(self.users_container, bg='#2c3e50')
+        if index < len(self.user_order):
+            user_frame.pack(fill='x', padx=5, pady=2, before=self.user_buttons[self.user_order[index]]['frame'])
+        else:
+            user_frame.pack(fill='x', padx=5, pady=2)
+        
+        # Status indicator (colored circle)
+        status_color = '#27ae60' if is_online else '#95a5a6'
+        status_canvas = tk.Canvas(user_frame, width=12, height=12, 
+                                 bg='#2c3e50', highlightthickness=0)
+        status_canvas.pack(side='left', padx=(5, 8))
+        status_canvas.create_oval(2, 2, 10, 10, fill=status_color, outline=status_color)
+        
+        # Username button
+        btn = tk.Button(
+            user_frame,
+            text=self.unread_label(user),
+            bg='#2c3e50',
+            fg='white',
+            font=('Arial', 10),
+            relief='flat',
+            anchor='w',
+            cursor='hand2',
+            command=lambda u=user: self.open_chat(u)
+        )
+        btn.pack(side='left', fill='x', expand=True)
+        btn.bind('<Enter>', lambda event, u=user: self.prefetch(u))
+        
+        # Store references
+        self.user_order.insert(index, user)
+        self.user_buttons[user] = {
+            'frame': user_frame,
+            'canvas': status_canvas,
+            'button': btn
+        }
+    
+    def unread_label(self, conversation):
+        """Sidebar text for a conversation, with its unread count"""
+        name = "💬 Group Chat" if conversation == GROUP_CHAT else conversation
+        count = self.client.unread_count(conversation)
+        return f"{name} ({count})" if count else name
+    
+    def update_unread(self, conversation):
+        """Refresh the unread count shown for a conversation"""
+        if conversation == GROUP_CHAT:
+            self.group_button.config(text=self.unread_label(GROUP_CHAT))
+        elif conversation in self.user_buttons:
+            self.user_buttons[conversation]['button'].config(text=self.unread_label(conversation))
+    
+    def prefetch(self, conversation):
+        """Pointer is over a conversation - decrypt its unread messages before the click"""
+        if self.client.lazy_decrypt and self.client.unread_count(conversation):
+            self.client.prefetch(conversation)
     
     def add_info_message_to_chat(self, text):
         """Add info message to chat area"""
@@ -340,13 +420,42 @@ class ChatApp:
             self.messages_text.insert('end', f"ℹ️  {text}\n", 'info')
             self.messages_text.config(state='disabled')
     
-    def update_user_status(self, username, online):
-        """Update user's online/offline status in the list"""
-        if username == self.username:
-            return
-        
-        self.active_users[username] = online
+    def queue_presence(self, username, online):
+        """Client presence callback (listener thread) - buffer and schedule one UI pass"""
+        with self._presence_lock:
+            self._pending_presence[username] = online
+            if self._presence_flush_scheduled:
+                return
+            self._presence_flush_scheduled = True
+        self.root.after(PRESENCE_FLUSH_MS, self.flush_presence)
+    
+    @UI_RENDER_SECONDS.time()
+    def flush_presence(self):
+        """Apply all buffered presence updates - a login storm costs one pass, not N rebuilds"""
+        with self._presence_lock:
+            pending = self._pending_presence
+            self._pending_presence = {}
+            self._presence_flush_scheduled = False
+        
+        PRESENCE_BATCH_SIZE.observe(len(pending))
+        # Users new to the list are verified on the worker, which then adds their rows
+        new_users = [username for username, online in pending.items()
+                     if online and username not in self.user_buttons]
+        if new_users:
+            self._worker.submit(self.look_up_users, new_users)
+        for username, online in pending.items():
+            # One unverifiable certificate must not lose the rest of the batch
+            try:
+                self.update_user_status(username, online, update_header=False)
+            except Exception as e:
+                log.warning("Presence update for %s failed: %s", username, e)
         
+        # Update chat header once if the current chat changed
+        if self.current_chat in pending:
+            self.update_chat_status()
+    
+    def update_user_status(self, username, online, update_header=True):
+        """Update user's online/offline status in the list"""
         # Update user button if it exists
         if username in self.user_buttons:
             try:
@@ -359,19 +468,44 @@ class ChatApp:
                     canvas.create_oval(2, 2, 10, 10, fill=status_color, outline=status_color)
                 else:
                     # Canvas was destroyed, remove from tracking
-                    del self.user_buttons[username]
+                    self.forget_user_row(username)
             except tk.TclError:
                 # Widget was destroyed, remove from tracking
-                if username in self.user_buttons:
-                    del self.user_buttons[username]
+                self.forget_user_row(username)
             
             # Update chat header if this is current chat
-            if self.current_chat == username:
+            if update_header and self.current_chat == username:
                 self.update_chat_status()
-        else:
-            # User not in list yet, refresh to add them
-            if online:
-                self.refresh_users()
+    
+    def look_up_users(self, usernames):
+        """Worker thread - verify new users' certificates (one directory request), then add their rows"""
+        try:
+            self.client.prefetch_users(usernames)
+        except Exception as e:
+            log.warning("Prefetching %d certificates failed: %s", len(usernames), e)
+        found = []
+        for username in usernames:
+            # One unverifiable certificate must not keep the others out of the list
+            try:
+                if self.client.has_user(username):
+                    found.append(username)
+            except Exception as e:
+                log.warning("Not listing %s: %s", username, e)
+        if found:
+            self.root.after(0, self.add_user_rows, found)
+    
+    @UI_RENDER_SECONDS.time()
+    def add_user_rows(self, usernames):
+        """Insert just the new users' rows instead of rebuilding the list"""
+        for username in usernames:
+            if username not in self.user_buttons:
+                self.add_user_row(username)
+    
+    def forget_user_row(self, username):
+        """Stop tracking a user whose widgets are gone"""
+        self.user_buttons.pop(username, None)
+        if username in self.user_order:
+            self.user_order.remove(username)
     
     def update_chat_status(self):
         """Update the status label for current chat"""
@@ -381,7 +515,7 @@ class ChatApp:
             return
         
         # Group chat has special status
-        if self.current_chat == "__GROUP_CHAT__":
+        if self.current_chat == GROUP_CHAT:
             self.status_label.config(
                 text="● Public room - All users can see your messages",
                 fg='#27ae60'
@@ -391,7 +525,7 @@ class ChatApp:
         
         # Regular private chat
         self.chat_header.config(bg='#3498db')
-        is_online = self.active_users.get(self.current_chat, False)
+        is_online = self.client.is_online(self.current_chat)
         if is_online:
             self.status_label.config(
                 text="● Online - Messages delivered instantly",
@@ -403,6 +537,7 @@ class ChatApp:
                 fg='#95a5a6'
             )
     
+    @UI_RENDER_SECONDS.time()
     def open_chat(self, username):
         """Open chat with selected user - preserves message history"""
         # Don't reload if already in this chat
@@ -410,6 +545,8 @@ class ChatApp:
             return
             
         self.current_chat = username
+        self.client.mark_read(username)
+        self.update_unread(username)
         self.chat_header.config(text=f"💬 Chat with {username}")
         self.update_chat_status()
         
@@ -417,26 +554,27 @@ class ChatApp:
         self.message_entry.config(state='normal', fg='#2c3e50')
         self.message_entry.delete(1.0, 'end')
         self.send_button.config(state='normal', bg='#3498db')
+        self.file_button.config(state='normal', bg='#3498db')
         
         # Clear and restore messages from history
         self.messages_text.config(state='normal')
         self.messages_text.delete(1.0, 'end')
         
         # Initialize history for this user if doesn't exist
-        if username not in self.message_history:
-            self.message_history[username] = []
+        history = self.client.history(username)
+        if not history:
             self.add_info_message(f"Started chat with {username}")
-            self.add_info_message("🔒 Messages encrypted with RSA")
+            self.add_info_message("🔒 Messages end-to-end encrypted")
             
             # Show offline warning if user is offline
-            if not self.active_users.get(username, False):
+            if not self.client.is_online(username):
                 self.messages_text.insert('end', 
                     "\n⚠️  User is currently offline. Your messages will be delivered when they come online.\n",
                     'warning'
                 )
         else:
             # Restore message history
-            for msg_data in self.message_history[username]:
+            for msg_data in history:
                 msg_type = msg_data['type']
                 if msg_type == 'info':
                     self.messages_text.insert('end', f"ℹ️  {msg_data['text']}\n", 'info')
@@ -451,19 +589,22 @@ class ChatApp:
                     time_tag = 'time_sent' if msg_type == 'sent' else 'time_received'
                     
                     self.messages_text.insert('end', f"  {msg_data['text']}  ", msg_type)
-                    self.messages_text.insert('end', f"\n{msg_data['timestamp']}\n", time_tag)
+                    self.messages_text.insert('end', f"\n{stamp(msg_data)}\n", time_tag)
         
         self.messages_text.config(state='disabled')
         self.messages_text.see('end')
         self.message_entry.focus()
     
+    @UI_RENDER_SECONDS.time()
     def open_group_chat(self):
         """Open group chat room where everyone can see messages"""
         # Use special identifier for group chat
-        if self.current_chat == "__GROUP_CHAT__":
+        if self.current_chat == GROUP_CHAT:
             return
         
-        self.current_chat = "__GROUP_CHAT__"
+        self.current_chat = GROUP_CHAT
+        self.client.mark_read(GROUP_CHAT)
+        self.update_unread(GROUP_CHAT)
         self.chat_header.config(text="💬 Group Chat", bg='#27ae60')
         self.status_label.config(
             text="● Public room - All users can see your messages",
@@ -474,19 +615,20 @@ class ChatApp:
         self.message_entry.config(state='normal', fg='#2c3e50')
         self.message_entry.delete(1.0, 'end')
         self.send_button.config(state='normal', bg='#27ae60')
+        self.file_button.config(state='disabled', bg='#95a5a6')
         
         # Clear and restore messages from history
         self.messages_text.config(state='normal')
         self.messages_text.delete(1.0, 'end')
         
         # Initialize history for group chat if doesn't exist
-        if "__GROUP_CHAT__" not in self.message_history:
-            self.message_history["__GROUP_CHAT__"] = []
+        history = self.client.history(GROUP_CHAT)
+        if not history:
             self.add_info_message("Welcome to Group Chat!")
             self.add_info_message("📢 Everyone can see messages here")
         else:
             # Restore group chat history
-            for msg_data in self.message_history["__GROUP_CHAT__"]:
+            for msg_data in history:
                 msg_type = msg_data['type']
                 if msg_type == 'info':
                     self.messages_text.insert('end', f"ℹ️  {msg_data['text']}\n", 'info')
@@ -505,14 +647,14 @@ class ChatApp:
                         self.messages_text.insert('end', f"\n{msg_data['timestamp']}\n", 'time_sent')
                     else:
                         self.messages_text.insert('end', f"{sender}: {msg_data['text']}  ", 'received')
-                        self.messages_text.insert('end', f"\n{msg_data['timestamp']}\n", 'time_received')
+                        self.messages_text.insert('end', f"\n{stamp(msg_data)}\n", 'time_received')
         
         self.messages_text.config(state='disabled')
         self.messages_text.see('end')
         self.message_entry.focus()
     
     def send_message(self):
-        """Send encrypted message using RSA"""
+        """Send end-to-end encrypted message"""
         if not self.current_chat:
             messagebox.showwarning("No Chat", "Please select a user first")
             return
@@ -522,102 +664,113 @@ class ChatApp:
             return
         
         # Handle group chat differently
-        if self.current_chat == "__GROUP_CHAT__":
+        if self.current_chat == GROUP_CHAT:
             self.send_group_message(message)
             return
         
+        # Clear input now - a failed send puts the message back
+        self.message_entry.delete(1.0, 'end')
+        self._worker.submit(self._send_to_user, self.current_chat, message)
+    
+    def _send_to_user(self, chat, message):
+        """Worker thread - verify the recipient, encrypt and queue, then report on the Tk thread"""
         try:
-            # Get recipient's public key
-            recipient_pubkey = self.pki.get_user_pubkey_path(self.current_chat)
-            
-            if not os.path.exists(recipient_pubkey):
-                messagebox.showerror("Error",
-                    f"Public key not found for {self.current_chat}\n"
+            # Recipient's certificate must be verifiable against the CA
+            if not self.client.has_user(chat):
+                self.root.after(0, self.on_send_failed, message,
+                    f"Certificate not found for {chat}\n"
                     f"They may need to register first.")
                 return
             
-            # Encrypt with RSA
-            encrypted = encrypt(message, recipient_pubkey)
-            
-            # Send via RabbitMQ (queued by background worker)
-            self.mq.send_message(self.current_chat, encrypted)
-            
-            # Display with timestamp
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            self.add_message(message, 'sent', timestamp)
-            
-            # Show delivery status
-            is_online = self.active_users.get(self.current_chat, False)
-            if is_online:
-                self.add_info_message("✓ Delivered")
-            else:
-                self.add_info_message("✓ Sent (queued for delivery)")
-            
-            # Clear input
-            self.message_entry.delete(1.0, 'end')
-            
-            print(f"[SENT] To {self.current_chat}: {message}")
-            
+            # Encrypt and queue for the background sender
+            entry = self.client.send_message(chat, message)
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to send message:\n{e}")
-            print(f"Send error: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("Send error")
+            self.root.after(0, self.on_send_failed, message, f"Failed to send message:\n{e}")
+            return
+        self.root.after(0, self.on_message_sent, chat, message, entry)
+    
+    def on_message_sent(self, chat, message, entry):
+        """Show a message the worker has queued (the client already keeps it in history)"""
+        if self.current_chat != chat:
+            return
+        
+        # Display with timestamp
+        self.add_message(message, 'sent', entry['timestamp'])
+        
+        # Show delivery status
+        if self.client.is_online(chat):
+            self.add_info_message("✓ Delivered")
+        else:
+            self.add_info_message("✓ Sent (queued for delivery)")
+    
+    def on_send_failed(self, message, error):
+        """Put an unsent message back in the input box and say why"""
+        if not self.message_entry.get(1.0, 'end').strip():
+            self.message_entry.insert(1.0, message)
+        messagebox.showerror("Error", error)
+    
+    def send_file(self):
+        """Pick a file and stream it to the current chat in the background"""
+        if not self.current_chat or self.current_chat == GROUP_CHAT:
+            return
+        
+        path = filedialog.askopenfilename(parent=self.root, title=f"Send file to {self.current_chat}")
+        if not path:
+            return
+        
+        self._worker.submit(self._send_file_to_user, self.current_chat, path)
+    
+    def _send_file_to_user(self, chat, path):
+        """Worker thread - verify the recipient; hashing, the offer and the chunks run on their own threads"""
+        try:
+            if not self.client.has_user(chat):
+                self.root.after(0, messagebox.showerror, "Error", f"Certificate not found for {chat}")
+                return
+            self.client.send_file(chat, path)
+        except Exception as e:
+            log.exception("File send error")
+            self.root.after(0, messagebox.showerror, "Error", f"Failed to send file:\n{e}")
+    
+    def on_file_event(self, event):
+        """Show transfer start/end lines (already in client history) for the open chat"""
+        text = describe(event)
+        if not text:
+            return
+        if event['peer'] != self.current_chat:
+            if event['direction'] == 'in':
+                self.show_notification(event['peer'])
+        else:
+            self.messages_text.config(state='normal')
+            if self.messages_text.get(1.0, 'end').strip():
+                self.messages_text.insert('end', '\n')
+            self.messages_text.insert('end', f"ℹ️  {text}\n", 'info')
+            self.messages_text.config(state='disabled')
+            self.messages_text.see('end')
+        
+        if event['state'] == 'offered' and event['direction'] == 'in':
+            self.ask_file_offer(event)
+    
+    def ask_file_offer(self, event):
+        """Nothing is downloaded until the user accepts the offer"""
+        if messagebox.askyesno("Incoming file",
+                               f"{event['peer']} wants to send you {event['name']} "
+                               f"({format_size(event['size'])}).\n\nAccept?"):
+            self.client.accept_file(event['id'])
+        else:
+            self.client.decline_file(event['id'])
     
     def send_group_message(self, message):
         """Send message to group chat (broadcasts to all users)"""
         try:
-            # Get all registered users
-            from pki_manager import PKI_PATH
-            
-            users = set()
-            for file in PKI_PATH.glob("*.crt"):
-                username = file.stem
-                if username != "ca" and username != self.username:
-                    users.add(username)
+            entry, sent_count = self.client.send_group_message(message)
             
-            if not users:
+            if entry is None:
                 self.add_info_message("⚠️ No other users registered")
                 return
             
-            # Broadcast to all users
-            sent_count = 0
-            for user in users:
-                try:
-                    # Get user's public key
-                    user_pubkey = self.pki.get_user_pubkey_path(user)
-                    
-                    if os.path.exists(user_pubkey):
-                        # Create group message with sender info
-                        group_msg = f"[GROUP] {self.username}: {message}"
-                        encrypted = encrypt(group_msg, user_pubkey)
-                        self.mq.send_message(user, encrypted)
-                        sent_count += 1
-                except Exception as e:
-                    print(f"Failed to send to {user}: {e}")
-            
-            # Display with timestamp
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            
-            # Save to history with sender info
-            if "__GROUP_CHAT__" not in self.message_history:
-                self.message_history["__GROUP_CHAT__"] = []
-            
-            self.message_history["__GROUP_CHAT__"].append({
-                'type': 'group',
-                'sender': self.username,
-                'text': message,
-                'timestamp': timestamp
-            })
-            
             # Display in chat
-            self.messages_text.config(state='normal')
-            if self.messages_text.get(1.0, 'end').strip():
-                self.messages_text.insert('end', '\n')
-            self.messages_text.insert('end', f"You: {message}  ", 'sent')
-            self.messages_text.insert('end', f"\n{timestamp}\n", 'time_sent')
-            self.messages_text.config(state='disabled')
-            self.messages_text.see('end')
+            self.add_group_message(f"You: {message}", entry['timestamp'], 'sent')
             
             # Show status
             self.add_info_message(f"✓ Sent to {sent_count} user(s)")
@@ -625,16 +778,13 @@ class ChatApp:
             # Clear input
             self.message_entry.delete(1.0, 'end')
             
-            print(f"[GROUP] Broadcast to {sent_count} users: {message}")
-            
         except Exception as e:
             messagebox.showerror("Error", f"Failed to send group message:\n{e}")
-            print(f"Group send error: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("Group send error")
     
+    @UI_RENDER_SECONDS.time()
     def add_message(self, text, msg_type, timestamp):
-        """Add message with timestamp and save to history"""
+        """Add message bubble with timestamp (history is kept by the client)"""
         self.messages_text.config(state='normal')
         
         if self.messages_text.get(1.0, 'end').strip():
@@ -650,17 +800,6 @@ class ChatApp:
         
         self.messages_text.config(state='disabled')
         self.messages_text.see('end')
-        
-        # Save to history
-        if self.current_chat:
-            if self.current_chat not in self.message_history:
-                self.message_history[self.current_chat] = []
-            
-            self.message_history[self.current_chat].append({
-                'type': msg_type,
-                'text': text,
-                'timestamp': timestamp
-            })
     
     def add_info_message(self, text):
         """Add info message and save to history"""
@@ -672,166 +811,57 @@ class ChatApp:
         
         # Save to history
         if self.current_chat:
-            if self.current_chat not in self.message_history:
-                self.message_history[self.current_chat] = []
-            
-            self.message_history[self.current_chat].append({
+            self.client.add_history(self.current_chat, {
                 'type': 'info',
                 'text': text,
                 'timestamp': None
             })
     
-    def announce_presence_periodically(self):
-        """Periodically announce presence to keep everyone updated"""
-        try:
-            self.mq.announce_presence('online')
-        except Exception as e:
-            print(f"Presence announcement error: {e}")
-        
-        # Re-announce every 30 seconds
-        self.root.after(30000, self.announce_presence_periodically)
-    
-    def start_message_listener(self):
-        """Listen for incoming messages in background"""
-        def listen():
-            def callback(ch, method, properties, body):
-                try:
-                    data = json.loads(body.decode())
-                    sender = data['from']
-                    encrypted_hex = data['message']
-                    encrypted_msg = bytes.fromhex(encrypted_hex)
-                    
-                    # Decrypt with RSA
-                    my_privkey = self.pki.get_user_key_path(self.username)
-                    decrypted = decrypt(encrypted_msg, my_privkey)
-                    
-                    # Check if it's a group message
-                    is_group_msg = decrypted.startswith("[GROUP] ")
-                    
-                    if is_group_msg:
-                        # Parse group message
-                        # Format: [GROUP] sender: message
-                        decrypted = decrypted[8:]  # Remove "[GROUP] " prefix
-                        
-                        # Display with timestamp
-                        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        
-                        print(f"[GROUP RECEIVED] {decrypted}")
-                        
-                        # Store in group chat history
-                        if "__GROUP_CHAT__" not in self.message_history:
-                            self.message_history["__GROUP_CHAT__"] = []
-                        
-                        self.message_history["__GROUP_CHAT__"].append({
-                            'type': 'group',
-                            'sender': sender,
-                            'text': decrypted.split(': ', 1)[1] if ': ' in decrypted else decrypted,
-                            'timestamp': timestamp
-                        })
-                        
-                        # Display if in group chat
-                        if self.current_chat == "__GROUP_CHAT__":
-                            self.root.after(0, lambda d=decrypted, t=timestamp: self.add_group_message(d, t))
-                        else:
-                            # Show notification
-                            self.root.after(0, lambda: self.show_notification("Group Chat"))
-                    else:
-                        # Regular private message
-                        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        
-                        print(f"[RECEIVED] From {sender}: {decrypted}")
-                        
-                        # Store message in history even if not in current chat
-                        if sender not in self.message_history:
-                            self.message_history[sender] = []
-                        
-                        self.message_history[sender].append({
-                            'type': 'received',
-                            'text': decrypted,
-                            'timestamp': timestamp
-                        })
-                        
-                        # Display if this is the current chat
-                        if sender == self.current_chat:
-                            self.root.after(0, lambda: self.add_message(
-                                decrypted, 'received', timestamp
-                            ))
-                        else:
-                            # Show notification
-                            self.root.after(0, lambda: self.show_notification(sender))
-                        
-                except Exception as e:
-                    print(f"Error receiving message: {e}")
-                    import traceback
-                    traceback.print_exc()
-            
-            self.mq.listen(callback)
+    def probe_frame_lag(self, due=None):
+        """Record how late each timer tick runs - any blocking on the Tk thread shows up here"""
+        now = time.perf_counter()
+        if due is not None:
+            UI_FRAME_LAG_SECONDS.observe(max(0.0, now - due))
+        self.root.after(FRAME_PROBE_MS, self.probe_frame_lag, now + FRAME_PROBE_MS / 1000)
+    
+    def on_client_message(self, conversation, entry):
+        """Show a received message (already in client history) or notify"""
+        if conversation != self.current_chat:
+            # Show notification
+            self.update_unread(conversation)
+            self.show_notification("Group Chat" if conversation == GROUP_CHAT else conversation)
+            return
         
-        threading.Thread(target=listen, daemon=True).start()
+        # Open conversation: decrypt now if it arrived sealed
+        self.client.mark_read(conversation)
+        self.client.open_entries([entry])
+        if entry['type'] == 'warning':
+            self.messages_text.config(state='normal')
+            self.messages_text.insert('end', f"\n{entry['text']}\n", 'warning')
+            self.messages_text.config(state='disabled')
+        elif conversation == GROUP_CHAT:
+            self.add_group_message(f"{entry['sender']}: {entry['text']}", stamp(entry))
+        else:
+            self.add_message(entry['text'], 'received', stamp(entry))
     
-    def add_group_message(self, full_message, timestamp):
+    @UI_RENDER_SECONDS.time()
+    def add_group_message(self, full_message, timestamp, msg_type='received'):
         """Add group message to chat display"""
         self.messages_text.config(state='normal')
         
         if self.messages_text.get(1.0, 'end').strip():
             self.messages_text.insert('end', '\n')
         
+        # Use appropriate timestamp tag
+        time_tag = 'time_sent' if msg_type == 'sent' else 'time_received'
+        
         # Display group message
-        self.messages_text.insert('end', f"{full_message}  ", 'received')
-        self.messages_text.insert('end', f"\n{timestamp}\n", 'time_received')
+        self.messages_text.insert('end', f"{full_message}  ", msg_type)
+        self.messages_text.insert('end', f"\n{timestamp}\n", time_tag)
         
         self.messages_text.config(state='disabled')
         self.messages_text.see('end')
     
-    def start_presence_listener(self):
-        """Listen for presence announcements"""
-        def listen():
-            try:
-                import pika
-                from rabbitmq_manager import RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS
-                
-                credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-                parameters = pika.ConnectionParameters(
-                    host=RABBITMQ_HOST,
-                    port=5672,
-                    credentials=credentials,
-                    heartbeat=600
-                )
-                
-                connection = pika.BlockingConnection(parameters)
-                channel = connection.channel()
-                
-                # Bind to presence exchange
-                channel.exchange_declare(exchange='chat_presence', exchange_type='fanout')
-                result = channel.queue_declare(queue='', exclusive=True)
-                queue_name = result.method.queue
-                channel.queue_bind(exchange='chat_presence', queue=queue_name)
-                
-                def callback(ch, method, properties, body):
-                    try:
-                        data = json.loads(body.decode())
-                        user = data['user']
-                        status = data['status']
-                        
-                        is_online = (status == 'online')
-                        
-                        print(f"Presence update: {user} is now {status}")
-                        
-                        # Update UI in main thread
-                        self.root.after(0, lambda: self.update_user_status(user, is_online))
-                        
-                    except Exception as e:
-                        print(f"Error processing presence: {e}")
-                
-                channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=True)
-                print("✓ Listening for presence updates...")
-                channel.start_consuming()
-                
-            except Exception as e:
-                print(f"Presence listener error: {e}")
-        
-        threading.Thread(target=listen, daemon=True).start()
-    
     def show_notification(self, sender):
         """Show notification for new message"""
         self.root.title(f"💬 New message from {sender}")
@@ -845,9 +875,9 @@ class ChatApp:
     
     def on_closing(self):
         """Handle window close"""
+        self._worker.shutdown(wait=False)
         try:
-            self.mq.announce_presence('offline')
-            self.mq.close()
+            self.client.close()
         except:
             pass
         
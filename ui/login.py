@@ -2,11 +2,11 @@ import tkinter as tk
 from tkinter import ttk, messagebox
 import sys
 import os
+import threading
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from ldap_manager import LDAPManager
-from pki_manager import PKIManager
+import startup
 
 class LoginApp:
     def __init__(self):
@@ -16,11 +16,41 @@ class LoginApp:
         self.root.resizable(False, False)
         self.root.configure(bg='#ecf0f1')
         
-        self.ldap = LDAPManager()
-        self.pki = PKIManager()
+        # ldap3/cryptography imports and CA setup are deferred until the
+        # window is up (see _warm_up) or first use, whichever comes first
+        self._ldap = None
+        self._pki = None
+        self._init_lock = threading.Lock()
         
         self.create_widgets()
     
+    @property
+    def ldap(self):
+        with self._init_lock:
+            if self._ldap is None:
+                with startup.timed("LDAPManager"):
+                    from ldap_manager import LDAPManager
+                    self._ldap = LDAPManager()
+            return self._ldap
+    
+    @property
+    def pki(self):
+        with self._init_lock:
+            if self._pki is None:
+                with startup.timed("PKIManager"):
+                    from pki_manager import PKIManager
+                    self._pki = PKIManager()  # May create the CA
+            return self._pki
+    
+    def _warm_up(self):
+        """Load LDAP and PKI in the background while the user types"""
+        try:
+            self.ldap
+            self.pki
+        except Exception as e:
+            # Surfaces again, with a dialog, on first real use
+            startup.log.warning("Background init failed: %s", e)
+    
     def create_widgets(self):
         """Create modern login interface"""
         # Header
@@ -230,11 +260,12 @@ class LoginApp:
                 if not self.pki.verify_cert(username):
                     self.login_status.config(text="Creating certificate...", foreground='#3498db')
                     self.root.update()
-                    self.pki.create_user_cert(username)
+                    self.pki.create_user_cert(username, password=password)
                 
                 # Try to open chat
                 try:
-                    from ui.chat import ChatApp
+                    with startup.timed("import ui.chat"):
+                        from ui.chat import ChatApp
                     self.root.destroy()
                     ChatApp(username).run()
                 except Exception as e:
@@ -373,7 +404,7 @@ class LoginApp:
                 self.reg_status.config(text="Creating certificate...", foreground='#3498db')
                 self.root.update()
                 
-                if self.pki.create_user_cert(username):
+                if self.pki.create_user_cert(username, password=password):
                     self.reg_status.config(
                         text="✅ Registration successful! Please login.",
                         foreground='#27ae60'
@@ -423,8 +454,18 @@ class LoginApp:
                 f"An error occurred during registration:\n\n{type(e).__name__}: {e}"
             )
     
+    def _on_first_window(self):
+        """Runs once the login window has been drawn"""
+        startup.mark("first window")
+        if startup.EXIT_AFTER_FIRST_WINDOW:
+            print(startup.report())
+            self.root.destroy()
+            return
+        threading.Thread(target=self._warm_up, daemon=True).start()
+    
     def run(self):
         """Start the application"""
+        self.root.after_idle(self._on_first_window)
         self.root.mainloop()
 
 if __name__ == "__main__":
@@ -0,0 +1,39 @@
+import json
+import struct
+import uuid
+
+# Binary chat message framing (AMQP body):
+#   version (1) | message id (16) | sender length (1) | sender (utf-8) | ciphertext
+WIRE_VERSION = 2
+CONTENT_TYPE = "application/x-chat-v2"
+HEADER = struct.Struct(">B16sB")
+
+def pack_message(sender, cipher_text, message_id=None):
+    """Frame ciphertext with sender and message id - no hex or JSON encoding"""
+    sender_bytes = sender.encode('utf-8')
+    if len(sender_bytes) > 255:
+        raise ValueError("Sender name too long for wire format")
+    
+    message_id = message_id or uuid.uuid4().bytes
+    return HEADER.pack(WIRE_VERSION, message_id, len(sender_bytes)) + sender_bytes + cipher_text
+
+def unpack_message(body):
+    """
+    Parse a message body into (sender, message id, ciphertext)
+    The ciphertext is a memoryview into body - no copy is made.
+    Old JSON/hex messages are still accepted (message id is None).
+    """
+    view = memoryview(body)
+    
+    if view[:1] == b'{':
+        # Version 1: {"from": ..., "message": "<hex>"}
+        data = json.loads(bytes(view))
+        return data['from'], None, bytes.fromhex(data['message'])
+    
+    version, message_id, sender_length = HEADER.unpack_from(view)
+    if version != WIRE_VERSION:
+        raise ValueError(f"Unsupported wire format version: {version}")
+    
+    start = HEADER.size
+    sender = str(view[start:start + sender_length], 'utf-8')
+    return sender, message_id, view[start + sender_length:]
\ No newline at end of file